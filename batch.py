@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+# K個の試合(アリーナ)を(K,N,3)の配列にまとめて，全アリーナを1回の配列計算で1ステップ進める
+# bit carのパラメータを少しずつ変えた試合をまとめて実行する(パラメータスイープ)ときに使う
+#   python batch.py torque 400 600 800 --arenas 100 --cpu-num 8 --filed-size 20 50
+#   python batch.py torque 400 600 800 --swept --delta-t 0.2      (連続衝突判定で粗いステップにする)
+#   python batch.py torque 400 600 800 --unordered                (衝突の組を同時に計算して速くする．結果は本体のゲームと変わる)
+#   python hitbit.py sweep ...
+
+import sys
+import time
+import argparse
+import numpy as np
+
+from world import World
+from collision import VectorizedCollision, SweptCollision, dot3
+from controller import AutoController
+from simulation import Simulation, Car, CAR_PRESETS, PRESET_CARS, CPU_NUM_LIST, FILED_NUM_LIST, FILED_FRICTION, GRAVITY
+
+def arenaView(name, *shape):
+    # Worldの(K*N, ...)の配列を(K, N, ...)として参照するプロパティ(コピーせずに書き込める)
+    def get(self):
+        return getattr(self.world, name).reshape((self.arena_num, self.player_num) + shape)
+    def set(self, value):
+        get(self)[...] = value
+    return property(get, set)
+
+class BatchWorld:
+    # arena_num個のアリーナにplayer_num台ずつのbitを置き，全員の状態を1つのWorldの配列で保持する
+    # アリーナkのs番目のbitはWorldの k*player_num + s 行になる
+    def __init__(self, arena_num, player_num, friction_mode=World.FRICTION_SUBSTEP, seed=None):
+        self.arena_num = arena_num      # アリーナ数 K
+        self.player_num = player_num    # 1アリーナあたりのbit数 N
+        self.world = World(friction_mode, seed)
+        self.world.addRows(arena_num * player_num)
+
+        # アリーナごとのフィールド
+        self.filed_size = np.full(arena_num, float(FILED_NUM_LIST[0]))  # フィールドサイズ [m]
+        self.filed_friction = np.full(arena_num, FILED_FRICTION)        # 摩擦係数
+        self.gravity = GRAVITY                                          # 重力加速度(全アリーナ共通)
+
+    # 状態とパラメータの(K, N, ...)のビュー
+    position = arenaView('position', 3)
+    velocity = arenaView('velocity', 3)
+    direction = arenaView('direction', 3)
+    alive = arenaView('alive')
+    input_key = arenaView('input_key', 4)
+    torque = arenaView('torque')
+    max_speed = arenaView('max_speed')
+    rotation = arenaView('rotation')
+    mass = arenaView('mass')
+    bounce = arenaView('bounce')
+    size = arenaView('size')
+
+    def rows(self, arenas):
+        # アリーナの全bitのWorldでの行番号((len(arenas), N)の配列)
+        return np.asarray(arenas)[:,None] * self.player_num + np.arange(self.player_num)
+
+    def setCar(self, arena, slot, car):
+        # arenaはアリーナの番号か番号の配列(複数のアリーナの同じ番号のbitをまとめて設定する)
+        self.world.setCar(np.asarray(arena) * self.player_num + slot, car)
+
+    def place(self, arena, filed_size, theta=0, filed_friction=FILED_FRICTION):
+        # Simulation.setupと同じようにアリーナのbitを円形に配置する
+        self.filed_size[arena] = filed_size
+        self.filed_friction[arena] = filed_friction
+        theta = np.cumsum(np.r_[theta, np.full(self.player_num - 1, 2*np.pi / self.player_num)]) # setupと同じ順に足す
+        x = np.cos(theta)
+        y = np.sin(theta)
+        self.position[arena] = np.stack([(filed_size / 4) * x, (filed_size / 4) * y, np.zeros_like(x)], axis=1)
+        self.velocity[arena] = 0
+        self.direction[arena] = np.stack([-x, -y, np.zeros_like(x)], axis=1)
+        self.alive[arena] = True
+        self.world.refreshAlive()
+        self.input_key[arena] = False
+
+    def aliveCount(self):
+        return np.count_nonzero(self.alive, axis=1) # アリーナごとの生存数
+
+    def step(self, delta_t, arenas=None):
+        # arenas(アリーナのマスク)の生存しているbitを全アリーナまとめて更新する
+        alive = self.alive if arenas is None else self.alive & arenas[:,None]
+        index = np.flatnonzero(alive)
+        self.world.step(
+            np.repeat(self.filed_size, self.player_num),        # 行ごとのフィールドサイズ
+            np.repeat(self.filed_friction, self.player_num),    # 行ごとの摩擦係数
+            self.gravity, delta_t, index=index
+        )
+
+class BatchCollision(VectorizedCollision):
+    # 同じアリーナのbit同士だけを(K,N,N)の配列でまとめて衝突計算する
+    # ordered=True(BatchSimulationの既定)のときは本体のゲーム(SequentialCollision)と同じ順番で処理する
+    # ordered=Falseは全ての組を同時に計算する速度優先の設定で，3台以上が絡む衝突の結果が本体のゲームと変わる
+    def resolve(self, batch, arenas):
+        arenas = np.flatnonzero(arenas)
+        position = batch.position[arenas]
+        offset = position[:,None,:,:] - position[:,:,None,:]    # offset[a,i,j] = x_j - x_i
+        distance = np.sqrt(dot3(offset, offset))
+        size = batch.size[arenas]
+        r_in = np.abs(size[:,:,None] + size[:,None,:])
+        alive = batch.alive[arenas]                             # 落下済みのbitは除く
+
+        # 衝突している組(i > j)をアリーナ, i, j の昇順で取り出す
+        hit = (distance <= r_in) & alive[:,:,None] & alive[:,None,:]
+        hit_a, hit_i, hit_j = np.nonzero(np.tril(hit, -1))
+        sub_x = offset[hit_a, hit_i, hit_j]
+        distance = distance[hit_a, hit_i, hit_j]
+        r_in = r_in[hit_a, hit_i, hit_j]
+
+        # Worldの行番号に直して，VectorizedCollisionと同じ更新式で計算する
+        row_i = arenas[hit_a] * batch.player_num + hit_i
+        row_j = arenas[hit_a] * batch.player_num + hit_j
+        if len(row_i) > 0:
+            self.apply(batch.world, row_i, row_j, sub_x, distance, r_in)
+        return row_i, row_j # 衝突した組(Worldの行番号)
+
+class BatchSweptCollision(SweptCollision):
+    # 同じアリーナのbit同士の全ての組を候補にして，SweptCollisionと同じ連続衝突判定をする
+    def resolve(self, batch, arenas):
+        rows = batch.rows(np.flatnonzero(arenas))
+        alive = batch.world.alive[rows]     # 落下済みのbitは除く
+        i, j = np.tril_indices(batch.player_num, -1)
+        keep = alive[:,i] & alive[:,j]
+        return self.solve(batch.world, rows[:,i][keep], rows[:,j][keep])   # 衝突した組(Worldの行番号)
+
+class BatchAutoController(AutoController):
+    # 同じアリーナの相手だけを狙うオートコントロール
+    def control(self, batch, arenas):
+        arenas = np.flatnonzero(arenas)
+        position = batch.position[arenas]
+        n = batch.player_num
+
+        # アリーナごとに一番近いplayerを探す．相手が場外のとき，相手が自分であるときは除く
+        sub = position[:,None,:,:] - position[:,:,None,:]
+        distance = np.sqrt(dot3(sub, sub))
+        distance = np.where(position[:,None,:,2] < 0, np.inf, distance)
+        distance[:, np.arange(n), np.arange(n)] = np.inf
+        nearest = np.argmin(distance, axis=2)
+        found = np.isfinite(np.take_along_axis(distance, nearest[:,:,None], axis=2)[:,:,0])
+        nearest[~found] = n - 1     # 相手がいないときは従来通りアリーナの最後のplayerを照準にする
+
+        rows = batch.rows(arenas)
+        keys = self.steer(batch.world, rows.ravel(), (rows[:,:1] + nearest).ravel(), found.ravel())
+        keys[~batch.world.alive[rows.ravel()]] = False  # 落下済みのbitの入力キーは全てOFF
+        batch.world.input_key[rows.ravel()] = keys
+        return keys
+
+class BatchSimulation:
+    # 全アリーナの試合を描画なしでまとめて進める(決着がついたアリーナはそこで止まる)
+    def __init__(self, batch, collision=None, controller=None, delta_t=Simulation.DELTA_T):
+        self.batch = batch
+        if collision is None:
+            collision = BatchCollision(ordered=True, delta_t=delta_t)
+        if controller is None:
+            controller = BatchAutoController()
+        self.collision = collision      # アリーナごとの衝突計算
+        self.controller = controller    # アリーナごとの入力キーの計算
+        self.delta_t = delta_t          # 1ステップの時間[sec]
+        self.tick = 0                   # 経過ステップ数
+
+        # 試合結果の記録((K, N)の配列，Simulationと同じ)
+        shape = (batch.arena_num, batch.player_num)
+        self.death_tick = np.full(shape, -1)            # 落下したステップ(生存中は-1)
+        self.last_hit = np.full(shape, -1)              # 最後に衝突した相手の番号(いなければ-1)
+        self.knocked_out_by = np.full(shape, -1)        # 落下させた相手の番号
+        self.finish_tick = np.full(batch.arena_num, -1) # 決着がついたステップ(試合中は-1)
+
+    def running(self):
+        # 試合中のアリーナのマスク(生存者が2人以上)
+        return self.batch.aliveCount() >= 2
+
+    def isFinished(self):
+        return not self.running().any()
+
+    def winner(self):
+        # アリーナごとの勝者の番号(生存者が1人でなければ-1)
+        alive = self.batch.alive
+        return np.where(np.count_nonzero(alive, axis=1) == 1, np.argmax(alive, axis=1), -1)
+
+    def step(self, n=1):
+        n_player = self.batch.player_num
+        for i in range(n):
+            arenas = self.running()
+            if not arenas.any():
+                return
+
+            # 衝突コントロール
+            hit_i, hit_j = self.collision.resolve(self.batch, arenas)
+            last_hit = self.last_hit.reshape(-1)
+            last_hit[hit_i] = hit_j % n_player
+            last_hit[hit_j] = hit_i % n_player
+
+            # オートコントロール
+            self.controller.control(self.batch, arenas)
+
+            # 全アリーナの状態をまとめて更新
+            alive = self.batch.alive.copy()
+            self.batch.step(self.delta_t, arenas)
+            self.tick += 1
+
+            # このステップで落下したbitと決着がついたアリーナを記録
+            dead = alive & ~self.batch.alive
+            self.death_tick[dead] = self.tick
+            self.knocked_out_by[dead] = self.last_hit[dead]
+            self.finish_tick[arenas & ~self.running()] = self.tick
+
+    def survivalTime(self):
+        # 各アリーナの各プレイヤーの生存時間[sec]
+        end = np.where(self.finish_tick < 0, self.tick, self.finish_tick)
+        tick = np.where(self.death_tick < 0, end[:,None], self.death_tick)
+        return tick * self.delta_t
+
+    def eliminations(self):
+        # 各アリーナの各プレイヤーが落下させた相手の数
+        n = self.batch.player_num
+        knocked = self.knocked_out_by + np.arange(self.batch.arena_num)[:,None] * n
+        knocked = knocked[self.knocked_out_by >= 0]
+        return np.bincount(knocked, minlength=self.batch.arena_num * n).reshape(-1, n)
+
+    def runUntilFinished(self, max_ticks=None):
+        # 全アリーナの決着がつくまで(またはmax_ticksステップまで)進めて，アリーナごとの勝者を返す
+        while not self.isFinished():
+            if max_ticks is not None and self.tick >= max_ticks:
+                break
+            self.step()
+        return self.winner()
+
+def sweep(name, values, arena_num, cpu_num, filed_size_list, car_index=0, seed=0,
+          delta_t=Simulation.DELTA_T, max_time=120, swept=False, ordered=True,
+          friction_mode=World.FRICTION_SUBSTEP):
+    # 1台目(番号0)のbit carのパラメータnameをvaluesの各値に変えて，値ごとにarena_num試合ずつ行う
+    # 相手は全てcar_indexのプリセットのまま．フィールドサイズはfiled_size_listを順番に使う
+    # swept=Trueのときは連続衝突判定を使う(delta_tを大きくしてもすり抜けない)
+    # ordered=Falseのときは衝突の組を同時に計算する(速いが，結果は本体のゲームと変わる)
+    rng = np.random.default_rng(seed)
+    batch = BatchWorld(len(values) * arena_num, cpu_num, friction_mode, seed)
+    for k in range(batch.arena_num):
+        for s in range(cpu_num):
+            batch.setCar(k, s, PRESET_CARS[car_index])
+        batch.place(k, filed_size_list[k % len(filed_size_list)], theta=rng.uniform(0, 2*np.pi))
+
+    # 値ごとにパラメータを変えたbit carを作り，World.setCarで車の種類の表にも登録する
+    base = PRESET_CARS[car_index]
+    for v, value in enumerate(values):
+        car = Car(*[getattr(base, field) for field in Car.__slots__])
+        setattr(car, name, value)
+        batch.setCar(np.arange(v * arena_num, (v + 1) * arena_num), 0, car)
+
+    sim = BatchSimulation(batch, BatchSweptCollision(delta_t) if swept else BatchCollision(ordered, delta_t), delta_t=delta_t)
+    winner = sim.runUntilFinished(max_ticks=int(max_time / delta_t))
+
+    # 値ごとに1台目の勝率，平均生存時間，平均撃墜数を集計する
+    win = (winner == 0).reshape(len(values), arena_num)
+    survival = sim.survivalTime()[:,0].reshape(len(values), arena_num)
+    knock = sim.eliminations()[:,0].reshape(len(values), arena_num)
+    return sim, [{
+        'value': value,
+        'win_rate': win[v].mean(),
+        'survival': survival[v].mean(),
+        'eliminations': knock[v].mean(),
+    } for v, value in enumerate(values)]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='hitbit sweep')
+    parser.add_argument('param', choices=['torque', 'max_speed', 'rotation', 'mass', 'bounce', 'size'])
+    parser.add_argument('values', type=float, nargs='+')                                # 試すパラメータの値
+    parser.add_argument('--arenas', type=int, default=100)                              # 値ごとの試合数
+    parser.add_argument('--cpu-num', type=int, default=CPU_NUM_LIST[0], choices=CPU_NUM_LIST)
+    parser.add_argument('--filed-size', type=int, nargs='+', default=[FILED_NUM_LIST[0]],
+                        choices=FILED_NUM_LIST)                                         # 順番に使うフィールドサイズ
+    parser.add_argument('--car', type=int, default=0, choices=range(len(CAR_PRESETS)))  # 元にするbit carのプリセット
+    parser.add_argument('--seed', type=int, default=0)                                  # 乱数の種
+    parser.add_argument('--delta-t', type=float, default=Simulation.DELTA_T)            # 更新速度[sec]
+    parser.add_argument('--max-time', type=float, default=120)                          # 1試合の上限時間[sec]
+    parser.add_argument('--swept', action='store_true')                                 # 連続衝突判定を使う
+    parser.add_argument('--unordered', action='store_true')                             # 衝突の組を同時に計算する(速度優先)
+    parser.add_argument('--analytic-friction', action='store_true')                     # 摩擦を解析解で計算する(速度優先)
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    sim, rows = sweep(args.param, args.values, args.arenas, args.cpu_num, args.filed_size,
+                      args.car, args.seed, args.delta_t, args.max_time, args.swept,
+                      not args.unordered,
+                      World.FRICTION_ANALYTIC if args.analytic_friction else World.FRICTION_SUBSTEP)
+    elapsed = time.perf_counter() - start
+
+    print('%d arenas x %d bits, %d ticks in %.1fs (%.0f arena-ticks/sec)' % (
+        sim.batch.arena_num, sim.batch.player_num, sim.tick, elapsed, sim.batch.arena_num * sim.tick / elapsed
+    ))
+    print('%10s %9s %10s %8s' % (args.param, 'win rate', 'survival', 'KO'))
+    for row in rows:
+        print('%10g %8.1f%% %9.1fs %8.2f' % (row['value'], 100 * row['win_rate'], row['survival'], row['eliminations']))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+import jit
+
+def dot3(a, b):
+    # 3次元ベクトルの内積
+    # 1組ずつでも配列でまとめてでも同じ順番で計算されるので，どちらの衝突計算でも結果が一致する
+    return a[...,0]*b[...,0] + a[...,1]*b[...,1] + a[...,2]*b[...,2]
+
+class BruteForceBroadPhase:
+    # 全ての組み合わせを候補とする(従来の while j < i の走査と同じ)
+    def pairs(self, world, rows=None, margin=0):
+        # i > j の組を i, j の昇順で返す．rows(昇順の行番号)を指定したときはその行の間の組だけを返す
+        if rows is None:
+            return np.tril_indices(world.count, -1)
+        pair_i, pair_j = np.tril_indices(len(rows), -1)
+        return rows[pair_i], rows[pair_j]
+
+class GridBroadPhase:
+    # 一様グリッド(空間ハッシュ)で近くにいる組だけを候補とする
+    BITS = 21                   # 1軸あたりのセル番号のビット数
+    OFFSET = 1 << (BITS - 1)    # セル番号を正の数にするためのオフセット
+
+    # 自分のセルと隣接する26セル
+    NEIGHBORS = [(dx, dy, dz) for dx in (-1, 0, 1) for dy in (-1, 0, 1) for dz in (-1, 0, 1)]
+
+    def __init__(self, cell_size=None):
+        self.cell_size = cell_size  # セルの一辺 [m]，Noneなら一番大きいbitに合わせる
+
+    def pairs(self, world, rows=None, margin=0):
+        # i > j の組を i, j の昇順で返す．rows(昇順の行番号)を指定したときはその行の間の組だけを返す
+        # marginを指定したときは，中心間の距離が接触する距離 + margin以下の組を全て含める
+        position = world.position if rows is None else world.position[rows]
+        size = world.size if rows is None else world.size[rows]
+        n = len(position)
+        if n < 2:
+            return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp)
+
+        # 一番大きいbit同士が接触する距離をセルの一辺とすれば，衝突相手は必ず隣接セルにいる
+        cell_size = self.cell_size
+        if cell_size is None:
+            cell_size = 2 * np.abs(size).max()
+        cell_size += margin
+
+        # 各bitのセル番号を1つの整数(キー)にまとめて，キーの順に並べる
+        limit = (1 << GridBroadPhase.BITS) - 2
+        cell = np.floor(position / cell_size).astype(np.int64) + GridBroadPhase.OFFSET
+        cell = np.clip(cell, 1, limit)  # 遠く離れたbitは端のセルにまとめる(候補が増えるだけ)
+        key = GridBroadPhase.__pack(cell[:,0], cell[:,1], cell[:,2])
+        order = np.argsort(key, kind='stable')
+        sorted_key = key[order]
+
+        pair_i = []
+        pair_j = []
+        for dx, dy, dz in GridBroadPhase.NEIGHBORS:
+            # 隣接セルに入っているbitの範囲を二分探索で求める
+            neighbor_key = key + GridBroadPhase.__pack(dx, dy, dz)
+            low = np.searchsorted(sorted_key, neighbor_key, 'left')
+            count = np.searchsorted(sorted_key, neighbor_key, 'right') - low
+            total = count.sum()
+            if total == 0:
+                continue
+
+            # 範囲を展開して(i, j)の組にする
+            i = np.repeat(np.arange(n), count)
+            start = np.repeat(low - (np.cumsum(count) - count), count)
+            j = order[start + np.arange(total)]
+            keep = j < i
+            pair_i.append(i[keep])
+            pair_j.append(j[keep])
+
+        if len(pair_i) == 0:
+            return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp)
+        pair_i = np.concatenate(pair_i)
+        pair_j = np.concatenate(pair_j)
+
+        # 従来の走査と同じ順番(i, jの昇順)に並べ替える
+        order = np.lexsort((pair_j, pair_i))
+        if rows is not None:
+            return rows[pair_i[order]], rows[pair_j[order]]
+        return pair_i[order], pair_j[order]
+
+    @staticmethod
+    def __pack(x, y, z):
+        return (np.int64(x) << (2*GridBroadPhase.BITS)) + (np.int64(y) << GridBroadPhase.BITS) + np.int64(z)
+
+class SequentialCollision:
+    # 候補の組を1組ずつ順番に処理する衝突計算
+    BRUTE_FORCE_ROWS = 1024     # Numbaを使うとき，これ以下の行数なら候補を求めずに総当たりで接触している組を求める
+    BASE_STEP = 0.1             # 従来の更新速度[sec]．これより短いステップのときだけ離れつつある組を更新しない
+
+    def __init__(self, broad_phase=None, delta_t=BASE_STEP):
+        if broad_phase is None:
+            broad_phase = GridBroadPhase()
+        self.broad_phase = broad_phase  # 衝突候補の組を求める方法
+        # 短いステップでは重なりが数ステップ続き，従来の更新式では離れつつある組を毎ステップ引き戻してしまう
+        # 従来のステップ以上では従来と同じ結果にするため，離れつつある組も更新する
+        self.skip_receding = delta_t < SequentialCollision.BASE_STEP
+
+    def resolve(self, world):
+        if jit.enabled:
+            return self.__resolveCompiled(world)
+        pair_i, pair_j = self.broad_phase.pairs(world, world.alive_rows)   # 落下済みのbitは除く
+
+        # プレイヤー間の距離を計算(位置は衝突計算の間変わらないので，まとめて計算しておく)
+        sub_x = world.position[pair_j] - world.position[pair_i]
+        distance = np.sqrt(dot3(sub_x, sub_x))
+        r_in = np.abs(world.size[pair_i] + world.size[pair_j])
+
+        # 衝突している組だけを残す
+        hit = distance <= r_in
+        pair_i = pair_i[hit]
+        pair_j = pair_j[hit]
+        sub_x = sub_x[hit]
+        distance = distance[hit]
+        r_in = r_in[hit]
+
+        for k in range(len(pair_i)):
+            i = pair_i[k]
+            j = pair_j[k]
+
+            if distance[k] < 0.1: # bitの重なり防止のランダム反発
+                sub_x[k,0] += world.rng.random()*0.5
+                world.velocity[i,1] += world.rng.random()*0.5
+
+            # 運動量保存則から導いた円の衝突の更新式により更新
+            # v1' = v1 - [m2/(m1+m2) * (1+e) * (v1-v2)・(x2-x1)] * (x2-x1)
+            # v2' = v2 + [m1/(m1+m2) * (1+e) * (v1-v2)・(x2-x1)] * (x2-x1)
+            total_mass = world.mass[i] + world.mass[j]
+            total_bounce = 1 + world.bounce[i] * world.bounce[j]
+            dot = dot3(world.velocity[i] - world.velocity[j], sub_x[k])
+            if self.skip_receding and dot <= 0:
+                continue # 離れつつある組は更新しない(重なりが数ステップ続いても引き戻さない)
+            sub_tilde = ((total_bounce / total_mass) * dot) * sub_x[k]
+
+            sub_tilde *= r_in[k] / distance[k] * 0.85 # bitの重なり防止のための擬似的な反発係数(距離に反比例)
+
+            world.velocity[i] += -world.mass[j] * sub_tilde
+            world.velocity[j] += +world.mass[i] * sub_tilde
+
+        return pair_i, pair_j # 衝突した組
+
+    def __resolveCompiled(self, world):
+        # 同じ計算をNumbaでコンパイルした関数で行う(jit.findHits，jit.applyHits)
+        rows = world.alive_rows
+        if len(rows) <= SequentialCollision.BRUTE_FORCE_ROWS:
+            pair_i, pair_j = jit.findHits(rows, world.position, world.size)
+            sub_x = world.position[pair_j] - world.position[pair_i]
+            distance = np.sqrt(dot3(sub_x, sub_x))
+        else:
+            pair_i, pair_j = self.broad_phase.pairs(world, rows)
+            sub_x = world.position[pair_j] - world.position[pair_i]
+            distance = np.sqrt(dot3(sub_x, sub_x))
+            hit = distance <= np.abs(world.size[pair_i] + world.size[pair_j])
+            pair_i = pair_i[hit]
+            pair_j = pair_j[hit]
+            distance = distance[hit]
+
+        # 重なり防止のランダム反発の乱数は，1組ずつ取り出すときと同じ順番でまとめて取り出しておく
+        jitter = world.rng.random((np.count_nonzero(distance < 0.1), 2))
+        jit.applyHits(pair_i, pair_j, world.position, world.velocity, world.mass, world.bounce, world.size, jitter,
+                      self.skip_receding)
+        return pair_i, pair_j # 衝突した組
+
+class VectorizedCollision:
+    # 全ての組をまとめて配列で計算する衝突計算(bitが密集しているとき向け)
+    def __init__(self, ordered=False, delta_t=SequentialCollision.BASE_STEP):
+        # ordered=Trueのとき，同じbitを含む組は従来の順番で処理し，SequentialCollisionと同じ結果にする
+        # ordered=Falseのとき，全ての組を衝突前の速度から同時に計算する
+        self.ordered = ordered
+        self.skip_receding = delta_t < SequentialCollision.BASE_STEP   # 離れつつある組を更新しないか(SequentialCollisionと同じ)
+
+    def resolve(self, world):
+        # 落下していない全ての組の相対位置と距離をブロードキャストで計算
+        rows = world.alive_rows
+        position = world.position[rows]
+        size = world.size[rows]
+        offset = position[None,:,:] - position[:,None,:]    # offset[i,j] = x_j - x_i
+        distance = np.sqrt(dot3(offset, offset))
+        r_in = np.abs(size[:,None] + size[None,:])
+
+        # 衝突している組(i > j)を i, j の昇順で取り出す
+        hit_i, hit_j = np.nonzero(np.tril(distance <= r_in, -1))
+        if len(hit_i) == 0:
+            return hit_i, hit_j
+        sub_x = offset[hit_i, hit_j]
+        distance = distance[hit_i, hit_j]
+        r_in = r_in[hit_i, hit_j]
+        hit_i = rows[hit_i]     # Worldの行番号に戻す
+        hit_j = rows[hit_j]
+
+        self.apply(world, hit_i, hit_j, sub_x, distance, r_in)
+        return hit_i, hit_j # 衝突した組
+
+    def apply(self, world, hit_i, hit_j, sub_x, distance, r_in):
+        # 衝突している組(i > j を i, j の昇順)の速度をまとめて更新する
+        # bitの重なり防止のランダム反発(乱数は組の順番に取り出す)
+        close = np.flatnonzero(distance < 0.1)
+        jitter = np.zeros((len(hit_i), 2))
+        jitter[close] = world.rng.random((len(close), 2)) * 0.5
+        sub_x[:,0] += jitter[:,0]
+
+        # 運動量保存則から導いた円の衝突の更新式の係数
+        total_mass = world.mass[hit_i] + world.mass[hit_j]
+        total_bounce = 1 + world.bounce[hit_i] * world.bounce[hit_j]
+        restitution = r_in / distance * 0.85    # bitの重なり防止のための擬似的な反発係数(距離に反比例)
+
+        if self.ordered:
+            batches = VectorizedCollision.__levels(hit_i, hit_j, world.count)
+        else:
+            batches = [np.arange(len(hit_i))]
+
+        for batch in batches:
+            i = hit_i[batch]
+            j = hit_j[batch]
+            np.add.at(world.velocity[:,1], i, jitter[batch,1])
+
+            dot = dot3(world.velocity[i] - world.velocity[j], sub_x[batch])
+            if self.skip_receding:
+                dot = np.where(dot > 0, dot, 0)   # 離れつつある組は更新しない(重なりが数ステップ続いても引き戻さない)
+            sub_tilde = ((total_bounce[batch] / total_mass[batch]) * dot)[:,None] * sub_x[batch]
+            sub_tilde *= restitution[batch,None]
+
+            np.add.at(world.velocity, i, -world.mass[j,None] * sub_tilde)
+            np.add.at(world.velocity, j, +world.mass[i,None] * sub_tilde)
+
+    @staticmethod
+    def __levels(hit_i, hit_j, count):
+        # 同じbitを含む組が前後しないように組を段に分ける
+        # 各段の中では同じbitが2回出てこないので，段ごとにまとめて計算しても順番に計算した結果と一致する
+        last = np.full(count, -1)   # 各bitが最後に出てきた段
+        level = np.empty(len(hit_i), dtype=np.intp)
+        for k, (i, j) in enumerate(zip(hit_i.tolist(), hit_j.tolist())):
+            level[k] = max(last[i], last[j]) + 1
+            last[i] = last[j] = level[k]
+        order = np.argsort(level, kind='stable')
+        return np.split(order, np.flatnonzero(np.diff(level[order])) + 1)
+
+class SweptCollision:
+    # 次のステップの間の移動も含めて衝突を判定する(連続衝突判定)
+    # 各組が接触する時刻(TOI)を相対運動の2次方程式から求め，早い順に接触したときの単位法線方向の撃力で速度を更新する
+    # 1ステップで自分の大きさ以上動いてもすり抜けず，重なった組は位置を押し戻すので，
+    # 重なり防止のランダム反発や距離に反比例する擬似的な反発係数は使わない(乱数も使わない)
+    HIT_GAIN = 0.85 # 撃力の係数．従来の衝突計算(sub_xが単位ベクトルでない)で接触した瞬間の撃力は
+                    # 単位法線の撃力の 0.85 * r_in^2 倍なので，同じ強さで弾き飛ばすように合わせる
+
+    def __init__(self, delta_t, broad_phase=None):
+        if broad_phase is None:
+            broad_phase = GridBroadPhase()
+        self.delta_t = delta_t          # 1ステップの時間[sec](Simulationと同じ値にする)
+        self.broad_phase = broad_phase  # 衝突候補の組を求める方法
+
+    def resolve(self, world):
+        # 1ステップの間に2台が近づける距離(一番速いbitの2台分)をグリッドのセルに足して候補を求める
+        rows = world.alive_rows
+        speed = np.sqrt(dot3(world.velocity[rows], world.velocity[rows]))
+        margin = 2 * np.fmax.reduce(speed, initial=0) * self.delta_t
+        pair_i, pair_j = self.broad_phase.pairs(world, rows, margin)
+        return self.solve(world, pair_i, pair_j)
+
+    def solve(self, world, pair_i, pair_j):
+        # 候補の組(i > j)のうち，このステップの間に接触する組を接触時刻, i, j の順に処理する
+        position = world.position
+        velocity = world.velocity
+        r_in = np.abs(world.size[pair_i] + world.size[pair_j])
+        toi = SweptCollision.timeOfImpact(
+            position[pair_j] - position[pair_i], velocity[pair_j] - velocity[pair_i], r_in, self.delta_t
+        )
+        hit = np.flatnonzero(np.isfinite(toi))
+        hit = hit[np.lexsort((pair_j[hit], pair_i[hit], toi[hit]))]
+
+        hit_i = []
+        hit_j = []
+        for k in hit:
+            i = pair_i[k]
+            j = pair_j[k]
+
+            # 前の組の撃力で速度が変わっていることがあるので，接触時刻を求め直す
+            sub_x = position[j] - position[i]
+            sub_v = velocity[j] - velocity[i]
+            t = SweptCollision.timeOfImpact(sub_x, sub_v, r_in[k], self.delta_t)
+            if not np.isfinite(t):
+                continue
+
+            # 接触したときの中心間の単位ベクトル(法線)．中心が完全に重なっているときはx方向とする
+            normal = sub_x + sub_v * t
+            distance = np.sqrt(dot3(normal, normal))
+            normal = normal / distance if distance > 0 else np.array([1.0, 0.0, 0.0])
+            total_mass = world.mass[i] + world.mass[j]
+
+            # 重なっている組は，重なった分だけ質量の逆比で法線方向に押し戻す
+            depth = r_in[k] - distance
+            if depth > 0:
+                position[i] -= (world.mass[j] / total_mass * depth) * normal
+                position[j] += (world.mass[i] / total_mass * depth) * normal
+
+            # 運動量保存則から導いた円の衝突の更新式(nは単位法線)に，従来の衝突計算で接触した瞬間と同じ強さの係数をかける
+            # v1' = v1 - [m2/(m1+m2) * (1+e) * (v1-v2)・n * HIT_GAIN * r_in^2] * n
+            # v2' = v2 + [m1/(m1+m2) * (1+e) * (v1-v2)・n * HIT_GAIN * r_in^2] * n
+            dot = -dot3(sub_v, normal)
+            if dot > 0:
+                total_bounce = 1 + world.bounce[i] * world.bounce[j]
+                gain = SweptCollision.HIT_GAIN * r_in[k] * r_in[k]
+                sub_tilde = ((total_bounce / total_mass) * dot * gain) * normal
+                delta_i = -world.mass[j] * sub_tilde
+                delta_j = +world.mass[i] * sub_tilde
+                # 接触時刻までは元の速度，その後は新しい速度で進むように位置をずらす(stepでは v * delta_t だけ進む)
+                position[i] -= delta_i * t
+                position[j] -= delta_j * t
+                velocity[i] += delta_i
+                velocity[j] += delta_j
+            hit_i.append(i)
+            hit_j.append(j)
+
+        return np.array(hit_i, dtype=np.intp), np.array(hit_j, dtype=np.intp) # 衝突した組
+
+    @staticmethod
+    def timeOfImpact(sub_x, sub_v, r_in, delta_t):
+        # |sub_x + sub_v t| = r_in となる最初の時刻 t (0 <= t <= delta_t)
+        # 重なっているときは0，このステップの間に接触しない(離れつつある，届かない)ときはinf
+        a = dot3(sub_v, sub_v)
+        b = dot3(sub_x, sub_v)
+        c = dot3(sub_x, sub_x) - r_in * r_in
+        discriminant = b * b - a * c
+        with np.errstate(invalid='ignore', divide='ignore'):
+            t = c / (np.sqrt(discriminant) - b)     # 小さい方の解(桁落ちしない形)
+        t = np.where((b < 0) & (discriminant >= 0) & (t <= delta_t), t, np.inf)
+        return np.where(c <= 0, 0.0, t)
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+import jit
+from collision import dot3
+from world import unpackKeys
+
+class AutoController:
+    # 全CPUのオートコントロールをまとめて計算する
+    # 各CPUは一番近い相手に向かって旋回し，相手がだいたい前にいるときに加速する
+    def __init__(self, chunk_size=256):
+        self.chunk_size = chunk_size    # 一度に距離行列を計算するCPUの数(メモリ使用量の上限)
+
+    def control(self, world, index):
+        # index行のbitの入力キー(加速, 減速, 左旋回, 右旋回)を計算してWorldに設定し，(len(index),4)の配列で返す
+        # 落下済みのbitは計算しない(入力キーは全てOFF)
+        index = np.asarray(index, dtype=np.intp)
+        keys = np.zeros((len(index), 4), dtype=bool)
+        alive = np.flatnonzero(world.alive[index])
+        if jit.enabled:
+            # 同じ計算をNumbaでコンパイルした関数で1台ずつ行う(距離行列を作らないので分割しない)
+            alive_keys = np.zeros((len(alive), 4), dtype=bool)
+            jit.autoControl(index[alive], world.alive_rows, world.position, world.direction, world.velocity,
+                            world.max_speed, world.count, alive_keys)
+            keys[alive] = alive_keys
+        else:
+            for start in range(0, len(alive), self.chunk_size):
+                chunk = alive[start:start + self.chunk_size]
+                keys[chunk] = self.__control(world, index[chunk])
+        world.input_key[index] = keys
+        return keys
+
+    def __control(self, world, rows):
+        position = world.position
+        count = np.arange(len(rows))
+
+        # 一番近いplayerを探す．相手は落下済みでないbitだけで，場外(死んでいない)のとき，相手が自分であるときは除く
+        target = world.alive_rows
+        target_position = position[target]
+        sub = target_position[None,:,:] - position[rows,None,:]
+        distance = np.sqrt(dot3(sub, sub))
+        distance[:, target_position[:,2] < 0] = np.inf
+        distance[count, np.searchsorted(target, rows)] = np.inf
+        nearest = np.argmin(distance, axis=1)
+        found = np.isfinite(distance[count, nearest])
+        nearest = target[nearest]
+        nearest[~found] = world.count - 1  # 相手がいないときは従来通り最後のplayerを照準にする
+
+        return self.steer(world, rows, nearest, found)
+
+    def steer(self, world, rows, nearest, found):
+        # rows行のbitがnearest行のbitを狙うときの入力キーを計算する(foundがFalseの行は相手なし)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            position = world.position
+            sight = position[nearest] - position[rows]                      # 照準ベクトル
+            sight = sight / np.linalg.norm(sight, axis=1)[:,None]           # 正規化
+
+            direction = world.direction[rows]
+            dot = np.einsum('ij,ij->i', direction, sight)                   # 内積
+            cross_z = direction[:,0]*sight[:,1] - direction[:,1]*sight[:,0] # 外積のz成分のみ
+
+            keys = np.zeros((len(rows), 4), dtype=bool)
+
+            # 自分の速度が速すぎる or 相手がいないときは減速，相手が前方のだいたい正面にいるときは加速
+            brake = (np.linalg.norm(world.velocity[rows], axis=1) > world.max_speed[rows]) | ~found
+            keys[:,0] = ~brake & (dot > 0) & (np.abs(cross_z) < 0.5)
+            keys[:,1] = brake
+
+            # 相手が左側にいるときは左旋回，右側にいるときは右旋回
+            keys[:,2] = cross_z > 0.1
+            keys[:,3] = cross_z < -0.1
+        return keys
+
+class KeyController:
+    # ユーザーのキー入力をそのままbitの入力キーにする
+    def __init__(self, key_list):
+        self.key_list = key_list    # 各ユーザーの入力キーのビットマスク(InputKey)の配列(Menu.bit_control_keyなど)
+
+    def control(self, world, index):
+        # index[k]行のbitにk番目のユーザーの入力キーを設定する
+        index = np.asarray(index, dtype=np.intp)
+        keys = unpackKeys(self.key_list[:len(index)])
+        world.input_key[index] = keys
+        return keys
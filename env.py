@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+# CPUのコントローラーを学習するための，描画なしで多数の試合をまとめて進める環境(gymのVecEnvと同じ形)
+#   env = HitbitVecEnv(num_envs=256, num_agents=2, cpu_num=6)
+#   observation = env.reset()
+#   observation, reward, done, info = env.step(actions)    # actionsは(num_envs, num_agents, 4)の入力キー
+#   python env.py --envs 256 --agents 2 --cpu-num 6 --steps 1000   (ランダムな入力で1秒あたりのステップ数を計測)
+#   python hitbit.py env ...
+#
+# 1つの環境は1つの試合(BatchWorldのアリーナ)で，各アリーナの先頭num_agents台を入力キーで操作し，
+# 残りのcpu_num台は従来のオートコントロールで動かす．決着がついた(生存者が1台以下，または操作するbitが全て落下した)
+# 環境と制限時間になった環境は，そのステップの結果を返した後に自動で初期配置に戻す
+# 衝突は本体のゲーム(SequentialCollision)と同じ順番で計算する．ordered=False(--unordered)にすると
+# 全ての組を同時に計算して速くなるが，3台以上が絡む衝突の結果が本体のゲームと変わる
+
+import sys
+import time
+import argparse
+import numpy as np
+
+from world import World, unpackKeys
+from batch import BatchWorld, BatchSimulation, BatchCollision, BatchAutoController
+from simulation import Simulation, PRESET_CARS, FILED_NUM_LIST
+
+class ActionController(BatchAutoController):
+    # 操作するbit(各アリーナの先頭num_agents台)には与えられた入力キーを，残りのbitにはオートコントロールを設定する
+    def __init__(self, num_agents):
+        BatchAutoController.__init__(self)
+        self.num_agents = num_agents
+        self.actions = None     # (num_envs, num_agents, 4)の入力キー
+
+    def control(self, batch, arenas):
+        if batch.player_num > self.num_agents:
+            BatchAutoController.control(self, batch, arenas)
+        keys = batch.input_key
+        keys[arenas,:self.num_agents] = self.actions[arenas] & batch.alive[arenas,:self.num_agents,None]
+        return keys
+
+class HitbitVecEnv:
+    # 観測は(num_envs, num_agents, プレイヤー数, 特徴量)の配列で，各bitから見た全員の状態(自分が先頭，その後は番号順)
+    # 特徴量 : 位置x, y(フィールドの半分の大きさで割る)，自分からの相対位置x, y(同じ)，
+    #          速度x, y(VELOCITY_SCALEで割る)，車の向きx, y，生存(1 / 0)．落下済みのbitは全て0
+    OBSERVATION_FEATURES = ('x', 'y', 'dx', 'dy', 'vx', 'vy', 'direction_x', 'direction_y', 'alive')
+    VELOCITY_SCALE = 12.0   # 観測の速度を割る値 [m/s](プリセットの最高速度)
+
+    # 報酬
+    SURVIVAL_REWARD = 0.01  # 生存している1ステップごと
+    KNOCK_OFF_REWARD = 1.0  # 相手を落下させたとき(最後に衝突した相手が落下したとき)
+    FALL_PENALTY = -1.0     # 自分が落下したとき
+
+    def __init__(self, num_envs, num_agents=2, cpu_num=0, filed_size=FILED_NUM_LIST[0], cars=None,
+                 delta_t=Simulation.DELTA_T, max_time=60, seed=None, ordered=True,
+                 friction_mode=World.FRICTION_SUBSTEP):
+        self.num_envs = num_envs        # 環境(アリーナ)の数
+        self.num_agents = num_agents    # 1つの環境で入力キーで操作するbitの数
+        self.cpu_num = cpu_num          # 1つの環境でオートコントロールで動くbitの数
+        self.player_num = num_agents + cpu_num
+        self.filed_size = np.broadcast_to(np.asarray(filed_size, np.float64), (num_envs,)).copy()  # 環境ごとのフィールドサイズ
+        self.max_ticks = int(max_time / delta_t)    # 1試合の上限ステップ数
+        self.rng = np.random.default_rng(seed)      # 初期配置の角度に使う乱数生成器
+
+        self.batch = BatchWorld(num_envs, self.player_num, friction_mode, seed)
+        if cars is None:
+            cars = [PRESET_CARS[s % len(PRESET_CARS)] for s in range(self.player_num)]
+        for k in range(num_envs):
+            for s, car in enumerate(cars):
+                self.batch.setCar(k, s, car)
+        self.controller = ActionController(num_agents)
+        self.simulation = BatchSimulation(self.batch, BatchCollision(ordered, delta_t), self.controller, delta_t)
+
+        self.episode_tick = np.zeros(num_envs, dtype=np.int64)  # 環境ごとの試合開始からのステップ数
+        self.episode_reward = np.zeros((num_envs, num_agents))  # 環境ごとの試合開始からの報酬の合計
+        self.total_steps = 0                                    # 全環境を進めたステップ数の合計
+
+        # 操作するbitの番号に自分が先頭になるように並べたプレイヤーの番号 (num_agents, プレイヤー数)
+        self.order = (np.arange(num_agents)[:,None] + np.arange(self.player_num)[None,:]) % self.player_num
+
+    @property
+    def observation_shape(self):
+        return (self.num_agents, self.player_num, len(HitbitVecEnv.OBSERVATION_FEATURES))   # 1つの環境の観測の形
+
+    def reset(self, envs=None):
+        # envs(環境の番号の配列，Noneなら全て)を初期配置に戻して，全環境の観測を返す
+        envs = np.arange(self.num_envs) if envs is None else np.asarray(envs)
+        sim = self.simulation
+        for k in envs:
+            self.batch.place(k, self.filed_size[k], theta=self.rng.uniform(0, 2*np.pi))
+        sim.death_tick[envs] = -1
+        sim.last_hit[envs] = -1
+        sim.knocked_out_by[envs] = -1
+        sim.finish_tick[envs] = -1
+        self.episode_tick[envs] = 0
+        self.episode_reward[envs] = 0
+        return self.observation()
+
+    def step(self, actions):
+        # actions : (num_envs, num_agents, 4)の入力キー(加速, 減速, 左旋回, 右旋回)か，(num_envs, num_agents)のビットマスク
+        # (観測, 報酬(num_envs, num_agents), 終了(num_envs), 情報)を返す．終了した環境の観測は自動で戻した後の初期配置のもの
+        actions = np.asarray(actions)
+        if actions.ndim == 2:
+            actions = unpackKeys(actions)
+        self.controller.actions = actions.astype(bool, copy=False)
+
+        sim = self.simulation
+        sim.step()
+        self.episode_tick += 1
+        self.total_steps += self.num_envs
+
+        # 報酬 : 生存，落下，相手を落下させた数(このステップで落下したbitの最後に衝突した相手)
+        dead = sim.death_tick == sim.tick
+        reward = np.where(self.batch.alive[:,:self.num_agents], HitbitVecEnv.SURVIVAL_REWARD, 0.0)
+        reward[dead[:,:self.num_agents]] += HitbitVecEnv.FALL_PENALTY
+        env, slot = np.nonzero(dead & (sim.knocked_out_by >= 0) & (sim.knocked_out_by < self.num_agents))
+        np.add.at(reward, (env, sim.knocked_out_by[env, slot]), HitbitVecEnv.KNOCK_OFF_REWARD)
+        self.episode_reward += reward
+
+        # 決着，操作するbitの全滅，時間切れで終了
+        alive_count = self.batch.aliveCount()
+        finished = (alive_count <= 1) | ~self.batch.alive[:,:self.num_agents].any(axis=1)
+        truncated = ~finished & (self.episode_tick >= self.max_ticks)
+        done = finished | truncated
+        info = {
+            'alive': self.batch.alive[:,:self.num_agents].copy(),   # 操作するbitの生存(自動で戻す前)
+            'winner': np.where(alive_count == 1, np.argmax(self.batch.alive, axis=1), -1),  # 勝者の番号(いなければ-1)
+            'truncated': truncated,                                 # 時間切れで終了したか
+        }
+        if done.any():
+            envs = np.flatnonzero(done)
+            info['final_observation'] = self.observation()[envs]    # 終了した環境の最後の観測(envsの順)
+            info['episode_reward'] = self.episode_reward[envs].copy()
+            info['episode_tick'] = self.episode_tick[envs].copy()
+            info['done_envs'] = envs
+            observation = self.reset(envs)
+        else:
+            observation = self.observation()
+        return observation, reward, done, info
+
+    def observation(self):
+        # 全環境の観測 (num_envs, num_agents, プレイヤー数, 特徴量) float32
+        batch = self.batch
+        half_size = (self.filed_size / 2)[:,None,None,None]
+        position = batch.position[:,self.order,:2]                  # (num_envs, num_agents, プレイヤー数, 2)
+        own = batch.position[:,:self.num_agents,None,:2]
+        alive = batch.alive[:,self.order,None]
+        observation = np.concatenate([
+            position / half_size,
+            (position - own) / half_size,
+            batch.velocity[:,self.order,:2] / HitbitVecEnv.VELOCITY_SCALE,
+            batch.direction[:,self.order,:2],
+            alive,
+        ], axis=3)
+        return np.where(alive, observation, 0).astype(np.float32)
+
+    def sampleActions(self):
+        # ランダムな入力キー (num_envs, num_agents, 4)
+        return self.rng.random((self.num_envs, self.num_agents, 4)) < 0.5
+
+def main(argv=None):
+    # ランダムな入力キーで進めて，1秒あたりのステップ数を表示する
+    parser = argparse.ArgumentParser(prog='hitbit env')
+    parser.add_argument('--envs', type=int, default=256)                        # 環境の数
+    parser.add_argument('--agents', type=int, default=2)                        # 1つの環境で操作するbitの数
+    parser.add_argument('--cpu-num', type=int, default=0)                       # 1つの環境のオートコントロールのbitの数
+    parser.add_argument('--filed-size', type=int, default=FILED_NUM_LIST[0], choices=FILED_NUM_LIST)
+    parser.add_argument('--steps', type=int, default=1000)                      # 進めるステップ数
+    parser.add_argument('--seed', type=int, default=0)                          # 乱数の種
+    parser.add_argument('--unordered', action='store_true')                     # 衝突の組を同時に計算する(速度優先)
+    parser.add_argument('--analytic-friction', action='store_true')             # 摩擦を解析解で計算する(速度優先)
+    args = parser.parse_args(argv)
+
+    env = HitbitVecEnv(args.envs, args.agents, args.cpu_num, args.filed_size, seed=args.seed,
+                       ordered=not args.unordered,
+                       friction_mode=World.FRICTION_ANALYTIC if args.analytic_friction else World.FRICTION_SUBSTEP)
+    env.reset()
+    env.step(env.sampleActions())   # 初回だけの処理(Numbaのコンパイルなど)は含めない
+    episodes = 0
+    start = time.perf_counter()
+    for t in range(args.steps):
+        observation, reward, done, info = env.step(env.sampleActions())
+        episodes += np.count_nonzero(done)
+    elapsed = time.perf_counter() - start
+
+    print('%d envs x %d agents (+%d cpu), %d steps in %.2fs, %d episodes' % (
+        args.envs, args.agents, args.cpu_num, args.steps, elapsed, episodes
+    ))
+    print('%.0f env-steps/sec, %.0f agent-steps/sec' % (
+        args.envs * args.steps / elapsed, args.envs * args.agents * args.steps / elapsed
+    ))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,186 +1,72 @@
 # -*- coding: utf-8 -*-
 
-from OpenGL.GL import *
-from OpenGL.GLU import *
-from OpenGL.GLUT import *
 import sys
+import time
 import numpy as np
 
-class Car:
-    id_counter = 500
-
-    def __init__(self, torque, max_speed, rotation, mass, bounce, size, color):
-        self.id = Car.id_counter    # 車の番号
-        self.torque = torque        # 加速トルク [N]
-        self.max_speed = max_speed  # 最高速度 [m/s]
-        self.rotation = rotation    # 旋回速度 [rad/s]
-        self.mass = mass            # 質量 [kg]
-        self.bounce = bounce        # 疑似反発係数
-        self.size = size            # 車両サイズ [m]
-        self.color = color          # 車両色
-
-        # 描画設定リストのためのidカウンターをインクリメント
-        Car.id_counter += 1
-        if Car.id_counter >= 600:
-            print('Error : Class Car -> id_counter overflows')
-            sys.exit(1)
-
-        # 描画設定リストを設定
-        glNewList(int(self.id), GL_COMPILE)  # 画面描画リストの登録開始
-        glColor3f(self.color[0], self.color[1], self.color[2])  # 色を設定
+import simulation
+from profiling import profiler
+from record import Recording, Replay
+from world import InputKey
+from simulation import Simulation, CAR_PRESETS, CPU_NUM_LIST, FILED_NUM_LIST, FILED_FRICTION, GRAVITY
+
+# OpenGL(GL，GLU，GLUT)と描画モジュール(render)は最初に描画するときにloadGLで読み込む
+# 描画しないツール(tournament，sweep)やプロセスプールのワーカーがhitbitをimportしても，OpenGLの読み込みとドライバーの準備をしない
+render = None
+
+def loadGL():
+    global render
+    if render is not None:
+        return
+    from OpenGL import GL, GLU, GLUT
+    for module in (GL, GLU, GLUT):
+        # from OpenGL.GL import * と同じ名前をこのモジュールに取り込む(このモジュールで定義した名前は上書きしない)
+        names = getattr(module, '__all__', None) or [name for name in dir(module) if not name.startswith('_')]
+        for name in names:
+            globals().setdefault(name, getattr(module, name))
+    import render as render_module
+    render = render_module
+
+# 各ユーザーのキー -> (ユーザー番号, 入力キー)
+USER_KEY_MAP = {
+    b'e': (0, InputKey.LEFT), b'r': (0, InputKey.RIGHT), b'u': (0, InputKey.ACCEL), b'i': (0, InputKey.BRAKE), # ユーザー1
+    b'd': (1, InputKey.LEFT), b'f': (1, InputKey.RIGHT), b'j': (1, InputKey.ACCEL), b'k': (1, InputKey.BRAKE), # ユーザー2
+    b'c': (2, InputKey.LEFT), b'v': (2, InputKey.RIGHT), b'm': (2, InputKey.ACCEL), b',': (2, InputKey.BRAKE), # ユーザー3
+    b'3': (3, InputKey.LEFT), b'4': (3, InputKey.RIGHT), b'7': (3, InputKey.ACCEL), b'8': (3, InputKey.BRAKE), # ユーザー4
+}
+
+class Car(simulation.Car):
+    __slots__ = ()
+
+    def __setShape(self):
+        # 車の形(表示リストに登録する)．色は含めないので，同じ形の車は色が違っても同じ表示リストを使う
         glPushMatrix()                  # 前の設定行列をスタックして退避
         glScaled(1.5, 1, 1)             # 細長い形状に伸縮
         glutSolidCube(self.size)        # キューブを描画
         glPopMatrix()                   # 前の設定行列をスタックから取り出して復帰
-        glEndList()                     # 画面描画リストの登録終了
 
-class Player:
-    cpu_id_counter = 1  # 各CPUの番号付けのためのクラス変数
-
-    # Playerタイプ
-    TYPE_USER = 0
-    TYPE_CPU  = 1
-
-    # 生存ステータス
-    ALIVE = 0
-    DEAD  = 1
-
-    DELTA_T = None # 更新速度[sec]
-
-    def __init__(self, name, car, position, velocity, direction):
-        if name != None:
-            self.name = name                        # プレイヤー名
-            self.type = Player.TYPE_USER            # ユーザーとして設定
-        else:
-            self.name = 'CPU' + str(Player.cpu_id_counter) # CPU名
-            Player.cpu_id_counter += 1              # CPU数をインクリメント
-            self.type = Player.TYPE_CPU             # CUPとして設定
-
-        self.car = car              # 車の種類
-        self.position = position    # 位置(ベクトル)[m]
-        self.velocity = velocity    # 速度(ベクトル)[m/sec]
-        self.direction = direction  # 車の向き(単位ベクトル)
-        self.status = Player.ALIVE  # 生存ステータス
-        self.input_key = [False, False, False, False]   # 入力キー
-
-    def __accelerate(self):
-        # 車の向き(単位ベクトル)との内積から，車の向きの速さを求める
-        head_velocity = self.velocity.dot(self.direction)
-        if head_velocity < 0:
-            head_velocity = 0   # 速度ベクトルが車の向きからみて負の方向なら0とする
-
-        # トルクと質量から加速度を計算し，車の向きに合わせて加速
-        if head_velocity < self.car.max_speed:
-            self.velocity += (self.car.torque / self.car.mass * Player.DELTA_T) * self.direction
-
-    def __brake(self):
-        brake_coefficient = 0.6  # トルクからブレーキ性能を決める擬似的な係数
-
-        # トルクとブレーキ係数，質量から減速度を計算し，車の速度方向に合わせて減速
-        if np.linalg.norm(self.velocity) > 0:   # 速度があるときのみ
-            self.velocity -= (self.car.torque / self.car.mass * Player.DELTA_T) * brake_coefficient \
-                                                * (self.velocity / np.linalg.norm(self.velocity))
-
-    def __turnLeft(self):
-        # ベクトルを回転角に変換，車の回転パラメータ(角速度)から新しい角度を求めて，ベクトルに戻す．左旋回
-        new_theta = np.arctan2(self.direction[1], self.direction[0]) + self.car.rotation * Player.DELTA_T
-        self.direction[0] = np.cos(new_theta)
-        self.direction[1] = np.sin(new_theta)
-
-    def __turnRight(self):
-        # ベクトルを回転角に変換，車の回転パラーメタ(角速度)から新しい角度を求めて，ベクトルに戻す．右旋回
-        new_theta = np.arctan2(self.direction[1], self.direction[0]) - self.car.rotation * Player.DELTA_T
-        self.direction[0] = np.cos(new_theta)
-        self.direction[1] = np.sin(new_theta)
-
-    def inputKey(self, key_array):
-        self.input_key = key_array
-
-    def calcAutoControl(self, player_list):
-        d_min = np.inf      # 距離が一番近いplayerまでの距離
-        d_min_index = -1    # 距離が一番近いplayerのインデックス
-        for i, player in enumerate(player_list):
-            if player.position[2] < 0 or player is self:
-                continue    # 相手が場外(死んでいない)のとき，相手が自分であるときスキップ
-            else:
-                # 一番近いplayerを探す
-                distance = np.linalg.norm(self.position - player.position)
-                if distance < d_min:
-                    d_min = distance
-                    d_min_index = i
-
-        sight = player_list[d_min_index].position - self.position   # 照準ベクトル
-        sight = sight / np.linalg.norm(sight)                       # 正規化
-
-        dot = self.direction.dot(sight)                 # 内積
-        cross_z = np.cross(self.direction, sight)[2]    # 外積のz成分のみ
-
-        if np.linalg.norm(self.velocity) > self.car.max_speed or d_min_index == -1:
-            # 自分の速度が速すぎる or 相手がいない
-            self.input_key[0] = False   # 加速 OFF
-            self.input_key[1] = True    # 減速 ON
-        else:
-            if dot > 0 and np.abs(cross_z) < 0.5: # 相手が前方にいる & 相手がだいたい前
-                self.input_key[0] = True    # 加速 ON
-                self.input_key[1] = False   # 減速 OFF
-            else:
-                self.input_key[0] = False   # 加速 OFF
-                self.input_key[1] = False   # 減速 OFF
-
-        if cross_z > 0.1:       # 相手が左側にいる
-            self.input_key[2] = True    # 左旋回 ON
-            self.input_key[3] = False   # 右旋回 OFF
-        elif cross_z < -0.1:    # 相手が右側にいる
-            self.input_key[2] = False   # 左旋回 OFF
-            self.input_key[3] = True    # 右旋回 ON
-        else:                   # 相手が正面にいる
-            self.input_key[2] = False   # 左旋回 OFF
-            self.input_key[3] = False   # 右旋回 OFF
-
-    def update(self, filed_size, filed_friction, gravity):
-        # 落下済みの場合
-        if self.status == Player.DEAD:
-            return # 落下済みの場合，更新しないで終了
+    def draw(self):
+        loadGL()
+        glColor3f(self.color[0], self.color[1], self.color[2])              # 色を設定
+        glCallList(render.geometry.get(('car', self.size), self.__setShape)) # 車両サイズごとの形を呼び出し
 
-        # 落下中の場合
-        if abs(self.position[0]) > filed_size/2 or abs(self.position[1]) > filed_size/2:
-            self.velocity[2] -= gravity * Player.DELTA_T  # 重力加速度による落下処理
+class Player(simulation.Player):
+    __slots__ = ()
 
-        # 行動可能状態の場合
-        else:
-            # 入力に従って，加速・減速・旋回
-            if self.input_key[0] == True:
-                self.__accelerate()  # 加速
-            if self.input_key[1] == True:
-                self.__brake()       # ブレーキ
-            if self.input_key[2] == True:
-                self.__turnLeft()    # 左旋回
-            if self.input_key[3] == True:
-                self.__turnRight()   # 右旋回
-
-            # 摩擦による減速
-            div = 100   # 逆方向加速防止のための時間分割数
-            for i in range(div):
-                if np.linalg.norm(self.velocity) > 0.1:
-                    # 速度が一定以上の場合，車の速度方向に合わせて減速する
-                    self.velocity -= (filed_friction * gravity) * (Player.DELTA_T/div) \
-                                                    * (self.velocity / np.linalg.norm(self.velocity))
-                else:
-                    # 速度が一定以下の場合，完全に停止させる(0で初期化)
-                    self.velocity = np.array([0,0,0], dtype=np.float)
-
-        # 位置座標を更新
-        self.position += self.velocity * Player.DELTA_T
-        if self.position[2] < -20:
-            self.status = Player.DEAD
+    def drawCarBody(self, position=None, direction=None):
+        # position, directionを指定したときはその位置と向きに描画する(補間した状態の描画など)
+        if position is None:
+            position = self.position
+        if direction is None:
+            direction = self.direction
 
-    def drawCarBody(self):
+        loadGL()
         glPushMatrix() # 前の設定行列をスタックにpushして退避
 
-        glTranslatef(self.position[0], self.position[1], self.position[2])                  # 車の位置を設定
-        glRotatef(np.rad2deg(np.arctan2(self.direction[1], self.direction[0])), 0, 0, 1)    # 車の向きを設定．z軸方向に回転
+        glTranslatef(position[0], position[1], position[2])                                 # 車の位置を設定
+        glRotatef(np.rad2deg(np.arctan2(direction[1], direction[0])), 0, 0, 1)              # 車の向きを設定．z軸方向に回転
         glScaled(self.car.size, self.car.size, self.car.size)                               # 車のサイズを設定
-        glCallList(self.car.id)                                                             # 車の基本描画呼び出し
+        self.car.draw()                                                                     # 車の基本描画呼び出し
 
         # 前方方向に角を描画したい(未実装)
         # v = crossVec(trans2Vec(0, 0, 1), p.direct);
@@ -190,34 +76,37 @@ class Player:
 
         glPopMatrix() # スタックして退避しておいた設定行列を元に戻す
 
-    def __drawRing(self):
+    def __setRing(self):
+        # 原点を中心とした半径car.sizeのリング(表示リストに登録する)
         theta = [np.pi/5*i for i in range(10)]  # 円を10区切り
         glColor3f(1, 0, 0)                      # 赤色で描画
         glBegin(GL_LINE_LOOP)                   # ループする線の描画を開始
         for th in theta:
             glVertex3d( # 頂点を打つ
-                self.position[0] + self.car.size*np.cos(th),    # x座標
-                self.position[1] + self.car.size*np.sin(th),    # y座標
-                0                                               # z座標
+                self.car.size*np.cos(th),       # x座標
+                self.car.size*np.sin(th),       # y座標
+                0                               # z座標
             )
         glEnd()                                 #描画を終了
 
-    def drawCar(self):
+    def __drawRing(self, position):
+        glPushMatrix()                                  # 前の設定行列をスタックにpushして退避
+        glTranslated(position[0], position[1], 0)       # リングの位置を設定(地面の高さ)
+        glCallList(render.geometry.get(('ring', self.car.size), self.__setRing)) # 車両サイズごとのリングを呼び出し
+        glPopMatrix()                                   # スタックして退避しておいた設定行列を元に戻す
+
+    def drawCar(self, position=None, direction=None):
         if self.status == Player.DEAD:
             return # 落下済みの場合は描画しないで終了
-        self.__drawRing() # 車の周りにリングを描画
-        self.drawCarBody()  # 車本体を描画
-
-class Filed:
-    def __init__(self, size, friction, gravity):
-        self.size = size
-        self.friction = friction
-        self.gravity = gravity
+        if position is None:
+            position = self.position
+        loadGL()
+        self.__drawRing(position)                   # 車の周りにリングを描画
+        self.drawCarBody(position, direction)       # 車本体を描画
 
+class Filed(simulation.Filed):
     def __setGround(self):
-        pass
-
-    def __drawGround(self):
+        # 地面の格子(表示リストに登録する)
         vertex = [-self.size/2 + self.size/10*i for i in range(11)] # 線の頂点座標を計算
         glColor3f(1, 1, 1)  # 白色で描画
         glBegin(GL_LINES)   # 複数の線の描画を開始
@@ -228,10 +117,11 @@ class Filed:
             glVertex3d(v, self.size/2, 0)   # xy平面の横線終点
         glEnd()             # 描画を終了
 
-    def __setAxis(self):
-        pass
+    def __drawGround(self):
+        glCallList(render.geometry.get(('ground', self.size), self.__setGround)) # フィールドサイズごとの地面を呼び出し
 
-    def __drawAxis(self):
+    def __setAxis(self):
+        # 座標軸(表示リストに登録する)
         glBegin(GL_LINES)       # 複数の線の描画を開始
         glColor3f(1, 0, 0)      # x軸 赤色
         glVertex3d(0, 0, 0.1)   # x軸 線描画始点
@@ -244,62 +134,96 @@ class Filed:
         glVertex3d(0, 0, 5.1)   # z軸 線描画終点
         glEnd()                 # 描画を終了
 
+    def __drawAxis(self):
+        glCallList(render.geometry.get(('axis',), self.__setAxis))
+
     def draw(self):
+        loadGL()
         self.__drawGround()
         self.__drawAxis()
 
 class Menu:
+    PHYSICS_RATE = 60           # 物理計算の更新頻度 [Hz]
+    FRAME_RATE = 240            # 画面の更新頻度の上限 [Hz]
+    MAX_FRAME_TIME = 0.25       # 1画面で進める時間の上限 [sec] (極端に遅い画面で処理が追いつかなくなるのを防ぐ)
+    MODEL_ROTATION_SPEED = 50   # モデルの回転表示の角速度 [deg/sec]
+    REPLAY_SEEK_TIME = 5        # 試合の再生で左右キーを押したときに移動する時間 [sec]
+
     def __init__(self):
-        self.delta_t = 0.1                      # 画面の更新速度
-        Player.DELTA_T = self.delta_t           # Playerクラスの更新速度を設定
+        loadGL()
+        self.delta_t = 1 / Menu.PHYSICS_RATE        # 物理計算の更新速度(固定)
+        simulation.Player.DELTA_T = self.delta_t    # Playerクラスの更新速度を設定
+        self.frame_interval = 1 / Menu.FRAME_RATE   # 画面の更新間隔
+        self.frame_time = 0                         # 前の画面からの経過時間(実時間)
+        self.last_time = None                       # 前の画面の時刻
+        self.accumulator = 0                        # まだ物理計算を進めていない時間
         self.ortho_size = 50                    # 画面の表示サイズ
         self.menu_num = 0                       # メニュー番号識別のための整数
 
         self.enter_key = False                                                   # Enterキー入力
         self.arrow_key = {'up':False, 'down':False, 'left':False, 'right':False} # 矢印キー入力
-        self.bit_control_key = [ [False, False, False, False] for i in range(4)] # 各ユーザーのキー入力
+        self.bit_control_key = np.zeros(4, dtype=np.uint8) # 各ユーザーのキー入力(InputKeyのビットマスク)
 
         self.setting_menu_row = 0               # 設定画面メニュー選択行
         self.user_num_list = [1, 2, 3, 4, 0]    # ユーザー数の選択リスト
         self.user_num_index = 0                 # 選択しているユーザー数の選択リストのインデックス
-        self.cpu_num_list = [8, 10, 12, 5]      # CPU数の選択リスト
+        self.cpu_num_list = CPU_NUM_LIST        # CPU数の選択リスト
         self.cpu_num_index = 0                  # 選択しているCPU数の選択リストのインデックス
-        self.filed_num_list = [20, 50, 75]      # フィールドサイズの選択リスト
+        self.filed_num_list = FILED_NUM_LIST    # フィールドサイズの選択リスト
         self.filed_num_index = 0                # 選択しているフィールドサイズの選択リストのインデックス
 
-        self.car_list = [\
-            Car(600, 12, 5, 50, 0.6, 1.0, [0,1,0]), \
-            Car(600, 12, 5, 50, 0.6, 1.0, [0,1,1]), \
-            Car(600, 12, 5, 50, 0.6, 1.0, [1,1,0]), \
-            Car(600, 12, 5, 50, 0.6, 1.0, [0,0,1]), \
-            Car(600, 12, 5, 50, 0.6, 1.0, [1,1,1]) \
-        ]   # bit carのリスト (加速, 最高速, 旋回, 重量, 反発, サイズ, 色)
+        self.car_list = [Car(*preset) for preset in CAR_PRESETS]   # bit carのリスト
 
         self.model = Player(
             'model',
             self.car_list[0],
-            np.array([0,0,0],dtype=np.float),
-            np.array([0,0,0],dtype=np.float),
-            np.array([1,0,0],dtype=np.float)
+            np.array([0,0,0],dtype=np.float64),
+            np.array([0,0,0],dtype=np.float64),
+            np.array([1,0,0],dtype=np.float64)
         )                                       # bit car選択画面の表示するモデル
         self.model_index = 0                    # モデルのbit carの種類を指すインデックス
         self.model_show_angle = 0               # モデルの回転表示用の回転角
         self.user_car_list = []                 # ユーザーが選択したbit carのリスト
 
         self.filed = None                       # フィールド
+        self.simulation = None                  # 試合(描画なしで進めるゲーム本体)
+        self.recording = None                   # 試合の記録
+        self.replay = None                      # 試合の再生
+        self.replay_color = None                # 再生する試合の各bitの色
         self.player_list = []                   # プレイヤー(ユーザーとCPU)のリスト
+        self.bit_color = None                   # 各bitの色
 
         self.wait = 0                           # 画面停止(カウントダウン)のための変数
+        self.resources_released = False         # 表示リストが取得できずに描画のリソースを解放した直後か
 
     @staticmethod
     def __printString(string, position, font, color=(1,1,1)):
-        string = bytes(string.encode('utf-8'))               # バイト文字列に変換
-        glColor3f(color[0], color[1], color[2])              # 文字色を設定
-        glRasterPos3d(position[0], position[1], position[2]) # 文字位置を設定
-        for i in range(len(string)):
-            glutBitmapCharacter(font, string[i])             # 一文字ずつ描画
+        with profiler.scope('text'):
+            glColor3f(color[0], color[1], color[2])              # 文字色を設定
+            glRasterPos3d(position[0], position[1], position[2]) # 文字位置を設定
+            render.text.draw(string, font)                       # 表示リストにまとめた文字列を描画
 
     def draw(self):
+        # 前の画面からの経過時間(実時間)を計算
+        now = time.perf_counter()
+        if self.last_time is None:
+            self.last_time = now
+        self.frame_time = min(now - self.last_time, Menu.MAX_FRAME_TIME)
+        self.last_time = now
+
+        # 表示リストが取得できないときは，描画のリソースを全て解放して次の画面で作り直す
+        # 解放した直後も取得できないときは続けられないので終了する
+        try:
+            self.__drawMenu()
+            self.resources_released = False
+        except render.GLResourceError as error:
+            if self.resources_released:
+                print('Error : Class Menu -> %s' % error)
+                sys.exit(1)
+            render.clear()
+            self.resources_released = True
+
+    def __drawMenu(self):
         if self.menu_num == 0:
             self.__drawTitle()            # タイトル画面
         elif self.menu_num == 1:
@@ -315,7 +239,7 @@ class Menu:
         elif self.menu_num == 6:
             self.__drawWinner()           # 勝者表示画面
         elif self.menu_num == 7:
-            self.__drawRecord()           # 戦闘履歴画面(未実装)
+            self.__drawRecord()           # 戦闘履歴画面(試合の再生)
 
     def __drawTitle(self):
         glMatrixMode(GL_MODELVIEW)  # モデルビュー行列を選択
@@ -491,61 +415,37 @@ class Menu:
                 self.model_show_angle = 0           # 次の選択のために表示をリセット
 
         # 表示角度を変更
-        self.model_show_angle += 5
+        self.model_show_angle += Menu.MODEL_ROTATION_SPEED * self.frame_time
 
     def __setGameContent(self):
         # フィールドの設定
         self.filed = Filed(
             size = self.filed_num_list[self.filed_num_index],   # フィールドのサイズ
-            friction = 0.75,                                    # 摩擦係数
-            gravity = 9.8                                       # 重力加速度
+            friction = FILED_FRICTION,                          # 摩擦係数
+            gravity = GRAVITY                                   # 重力加速度
         )
 
-        # プレイヤー数を取得
-        user_num = self.user_num_list[self.user_num_index]
+        # プレイヤーを円形に配置して試合を作成
         cpu_num = self.cpu_num_list[self.cpu_num_index]
-        player_num = user_num + cpu_num
-
-        # プレイヤーを円形に配置のための変数
-        theta = 0
-        d_theta = 2*np.pi / player_num
-
-        # ユーザーのbit carと初期位置などを設定
-        for i in range(user_num):
-            x = np.cos(theta)
-            y = np.sin(theta)
-            p_x = (self.filed.size / 4) * x
-            p_y = (self.filed.size / 4) * y
-            theta += d_theta
-
-            user = Player(
-                'User' + str(i+1),                  # ユーザー名
-                self.user_car_list[i],              # bit car
-                np.array([p_x,p_y,0], np.float),    # 初期位置
-                np.array([0,0,0], np.float),        # 初期速度
-                np.array([-x,-y,0], np.float)       # 初期角度
-            )
-            self.player_list.append(user)           # リストに追加
-
-        # CPUのbit carと初期位置などを設定
-        for i in range(cpu_num):
-            x = np.cos(theta)
-            y = np.sin(theta)
-            p_x = (self.filed.size / 4) * x
-            p_y = (self.filed.size / 4) * y
-            theta += d_theta
-
-            cpu = Player(
-                None,                               # CPU名
-                self.car_list[0],                   # bit car
-                np.array([p_x,p_y,0], np.float),    # 初期位置
-                np.array([0,0,0], np.float),        # 初期速度
-                np.array([-x,-y,0], np.float)       # 初期角度
-            )
-            self.player_list.append(cpu)            # リストに追加
+        seed = int(np.random.SeedSequence().generate_state(1)[0])   # 試合を再現するための乱数の種
+        self.simulation = Simulation.setup(
+            self.filed,                                 # フィールド
+            self.user_car_list,                         # ユーザーのbit car
+            [self.car_list[0]] * cpu_num,               # CPUのbit car
+            user_key_list = self.bit_control_key,       # ユーザーのキー入力
+            player_class = Player,                      # 描画できるPlayerとして作成
+            delta_t = self.delta_t,                     # 更新速度
+            seed = seed                                 # 乱数の種
+        )
+        self.player_list = self.simulation.players      # プレイヤーのリスト
+        self.recording = Recording.capture(self.simulation, seed)  # 試合の記録を開始
+        self.bit_color = np.array([player.car.color for player in self.player_list], np.float32) # 各bitの色
 
         # 視点の設定
-        self.ortho_size = self.filed.size   # 描画領域の数値を設定
+        self.__setOrtho(self.filed.size)
+
+    def __setOrtho(self, ortho_size):
+        self.ortho_size = ortho_size        # 描画領域の数値を設定
         glMatrixMode(GL_PROJECTION)         # 投影行列を選択
         glLoadIdentity()                    # 単位行列で初期化
         glOrtho(
@@ -554,6 +454,19 @@ class Menu:
             -self.ortho_size, self.ortho_size
         )                                   # 描画領域を設定(投影行列を設定)
 
+    def __drawBits(self, position=None, direction=None, simulation=None, color=None):
+        # 落下していないbitを全員まとめて描画する(位置と向きを省略したときは現在の状態)
+        if simulation is None:
+            simulation = self.simulation
+            color = self.bit_color
+        world = simulation.world
+        if position is None:
+            position = world.position
+        if direction is None:
+            direction = world.direction
+        alive = world.alive_rows
+        render.drawBits(position[alive], direction[alive], world.size[alive], color[alive])
+
     def __drawBattleStartCount(self):
         glMatrixMode(GL_MODELVIEW)  # モデルビュー行列を選択
         glLoadIdentity()            # 単位行列で初期化
@@ -564,9 +477,9 @@ class Menu:
         )                           # カメラ視点を設定(モデルビュー行列を設定)
 
         self.filed.draw()           # 地面を描画
+        self.__drawBits()           # bit car描画
 
         for player in self.player_list:
-            player.drawCar()            # bit car描画
             Menu.__printString(
                 player.name,            # 表示名
                 player.position + 0.8,  # 表示位置(ブロードキャストに注意)
@@ -587,7 +500,7 @@ class Menu:
 
         # カウントダウンを計算
         if self.wait < 6:
-            self.wait += self.delta_t   # 時間を加算
+            self.wait += self.frame_time    # 時間を加算
         else:
             self.wait = 0               # 待ち時間を初期化
             self.menu_num += 1          # 次のメニューへ移動
@@ -601,62 +514,24 @@ class Menu:
             0.0, 0.0, 1.0
         )                           # カメラ視点を設定(モデルビュー行列を設定)
 
-        self.filed.draw()   # 地面を描画
-
-        # 衝突コントロール
-        for i in range(len(self.player_list)):
-            j = 0
-            while j < i: # i番目とj番目の衝突を計算
-                player_i = self.player_list[i]
-                player_j = self.player_list[j]
-
-                # プレイヤー間の距離を計算
-                sub_x = player_j.position - player_i.position
-                distance = np.linalg.norm(sub_x)
-                r_in = np.abs(player_i.car.size + player_j.car.size)
-
-                # 衝突していないとき
-                if distance > r_in:
-                    j += 1
-                    continue # do nothing
-
-                # 衝突しているとき
-                else:
-                    if distance < 0.1: # bitの重なり防止のランダム反発
-                        sub_x[0] += np.random.rand()*0.5
-                        player_i.velocity[1] += np.random.rand()*0.5
-
-                    # 運動量保存則から導いた円の衝突の更新式により更新
-                    # v1' = v1 - [m2/(m1+m2) * (1+e) * (v1-v2)・(x2-x1)] * (x2-x1)
-                    # v2' = v2 + [m1/(m1+m2) * (1+e) * (v1-v2)・(x2-x1)] * (x2-x1)
-                    total_mass = player_i.car.mass + player_j.car.mass
-                    total_bounce = 1 + player_i.car.bounce * player_j.car.bounce
-                    dot = (player_i.velocity - player_j.velocity).dot(sub_x)
-                    sub_tilde = ((total_bounce / total_mass) * dot) * sub_x
-
-                    sub_tilde *= r_in / distance * 0.85 # bitの重なり防止のための擬似的な反発係数(距離に反比例)
-
-                    self.player_list[i].velocity += -player_j.car.mass * sub_tilde
-                    self.player_list[j].velocity += +player_i.car.mass * sub_tilde
-
-                # jをインクリメント
-                j += 1
-
-        # bitの描画及びコントロール，更新
-        self.alive_count = 0 # 生存者カウンター
-        for i, player in enumerate(self.player_list):
-            if player.type == Player.TYPE_USER:
-                player.drawCar()                                # bit car描画
-                player.inputKey(self.bit_control_key[i])        # コントロールキー入力
-                player.update(self.filed.size, self.filed.friction, self.filed.gravity) # 更新
-            else:
-                player.drawCar()                                # bit car描画
-                player.calcAutoControl(self.player_list)        # オートコントロール
-                player.update(self.filed.size, self.filed.friction, self.filed.gravity) # 更新
-
-            # 生存者をカウント
-            if player.status == Player.ALIVE:
-                self.alive_count += 1
+        with profiler.scope('filed'):
+            self.filed.draw()   # 地面を描画
+
+        # 経過した実時間の分だけ，物理計算を固定の時間刻みで進める
+        with profiler.scope('physics'):
+            self.accumulator += self.frame_time
+            while self.accumulator >= self.delta_t:
+                self.simulation.step()                  # 衝突，コントロール，更新を1ステップ進める
+                self.accumulator -= self.delta_t
+                if self.simulation.isFinished():
+                    self.accumulator = 0
+                    break
+            self.alive_count = self.simulation.aliveCount() # 生存者カウンター
+
+        # 1ステップ前と現在の状態の間を補間してbitを描画
+        with profiler.scope('bits'):
+            position, direction = self.simulation.interpolate(self.accumulator / self.delta_t)
+            self.__drawBits(position, direction)
 
         # 試合終了判定(生存者が0人または1人)
         if self.alive_count == 0 or self.alive_count == 1:
@@ -672,8 +547,7 @@ class Menu:
         )                           # カメラ視点を設定(モデルビュー行列を設定)
 
         self.filed.draw()           # 地面を描画
-        for i, player in enumerate(self.player_list):
-            player.drawCar()        # bit car描画
+        self.__drawBits()           # bit car描画
         Menu.__printString(
             'FINISH',
             (-1, 0, 0),
@@ -683,19 +557,12 @@ class Menu:
 
         # カウントダウンを計算
         if self.wait < 3:
-            self.wait += self.delta_t
+            self.wait += self.frame_time
         else:
             self.wait = 0       # 待ち時間を初期化
 
             # 視点をリセット
-            self.ortho_size = 50                # 描画領域の数値を設定
-            glMatrixMode(GL_PROJECTION)         # 投影行列を選択
-            glLoadIdentity()                    # 単位行列で初期化
-            glOrtho(
-                -self.ortho_size, self.ortho_size,
-                -self.ortho_size, self.ortho_size,
-                -self.ortho_size, self.ortho_size
-            )                                   # 描画領域を設定(投影行列を設定)
+            self.__setOrtho(50)
 
             # Winnerをモデルとして保持
             if self.alive_count != 0:
@@ -738,7 +605,7 @@ class Menu:
             glPopMatrix()                               # 前の設定行列をスタックから取り出して復帰
 
             # 表示角度を変更
-            self.model_show_angle += 5
+            self.model_show_angle += Menu.MODEL_ROTATION_SPEED * self.frame_time
 
         # 生存者がいないとき
         else:
@@ -748,14 +615,72 @@ class Menu:
                 GLUT_BITMAP_TIMES_ROMAN_24
             ) # 'DRAW'(引き分け)と表示
 
+        Menu.__printString('<UP> REPLAY', (4, 0, -35), GLUT_BITMAP_8_BY_13)
+
+        # 上キーで試合の再生へ
+        if self.arrow_key['up'] == True:
+            self.arrow_key['up'] = False                # 連続入力防止
+            self.replay = Replay(self.recording, Player, Filed)
+            self.replay_color = np.array([car.color for car in self.recording.cars], np.float32)
+            self.accumulator = 0
+            self.__setOrtho(self.replay.simulation.filed.size)
+            self.menu_num = 7                           # 戦闘履歴画面へ移動
+
         # Enterキーで次のメニューへ
         if self.enter_key == True:
             self.enter_key = False      # 連続入力防止
+            render.clear()              # 試合で使った表示リストとバッファを解放
             self.__init__()             # 全設定をリセット
-            Player.cpu_id_counter = 1   # CPUのIDカウンターをリセット
 
     def __drawRecord(self):
-        pass # (未実装)
+        glMatrixMode(GL_MODELVIEW)  # モデルビュー行列を選択
+        glLoadIdentity()            # 単位行列で初期化
+        gluLookAt(
+            0.2, -1.0, 1.0,
+            0.0, 0.0, 0.0,
+            0.0, 0.0, 1.0
+        )                           # カメラ視点を設定(モデルビュー行列を設定)
+
+        simulation = self.replay.simulation
+        simulation.filed.draw()     # 地面を描画
+
+        # 記録した試合を実時間で進める(最後まで進んだら止める)
+        self.accumulator += self.frame_time
+        while self.accumulator >= simulation.delta_t:
+            if self.replay.isFinished():
+                self.accumulator = 0
+                break
+            self.replay.step()
+            self.accumulator -= simulation.delta_t
+
+        # 1ステップ前と現在の状態の間を補間してbitを描画
+        position, direction = simulation.interpolate(self.accumulator / simulation.delta_t)
+        self.__drawBits(position, direction, simulation, self.replay_color)
+
+        # 再生時間を表示
+        Menu.__printString(
+            'REPLAY  %.1f / %.1f' % (simulation.tick * simulation.delta_t,
+                                     self.recording.tick_count * simulation.delta_t),
+            (-simulation.filed.size/2, -simulation.filed.size/2 - 3, 0),
+            GLUT_BITMAP_8_BY_13
+        )
+
+        # 左右キーで巻き戻し・早送り(キーフレームから計算し直す)
+        seek = int(round(Menu.REPLAY_SEEK_TIME / simulation.delta_t))
+        if self.arrow_key['left'] == True:
+            self.arrow_key['left'] = False              # 連続入力防止
+            self.replay.seek(simulation.tick - seek)
+            self.accumulator = 0
+        elif self.arrow_key['right'] == True:
+            self.arrow_key['right'] = False             # 連続入力防止
+            self.replay.seek(simulation.tick + seek)
+            self.accumulator = 0
+
+        # Enterキーで勝者表示画面へ戻る
+        if self.enter_key == True:
+            self.enter_key = False                      # 連続入力防止
+            self.__setOrtho(50)
+            self.menu_num = 6
 
 
 
@@ -767,6 +692,25 @@ class Menu:
 menu = None
 
 def main():
+    # python hitbit.py tournament ... のときは描画せずにCPU同士の試合を並列に実行する
+    if len(sys.argv) > 1 and sys.argv[1] == 'tournament':
+        import tournament
+        sys.exit(tournament.main(sys.argv[2:]))
+    # python hitbit.py sweep ... のときは描画せずにbit carのパラメータを変えた試合をまとめて実行する
+    if len(sys.argv) > 1 and sys.argv[1] == 'sweep':
+        import batch
+        sys.exit(batch.main(sys.argv[2:]))
+    # python hitbit.py env ... のときは描画せずに学習用の環境をランダムな入力で進めて，1秒あたりのステップ数を表示する
+    if len(sys.argv) > 1 and sys.argv[1] == 'env':
+        import env
+        sys.exit(env.main(sys.argv[2:]))
+
+    # python hitbit.py --profile のときは処理時間の計測と表示を有効にして起動する(F1で切り替え，F2で書き出し)
+    if '--profile' in sys.argv:
+        profiler.enabled = True
+        profiler.overlay = True
+
+    loadGL()
     glutInit(sys.argv)
     glutInitDisplayMode(GLUT_RGB | GLUT_DOUBLE | GLUT_DEPTH) # RGBカラー, ダブルバッファリング, 隠面消去
     glutInitWindowSize(1080, 700)                   # ウィンドウ初期サイズ
@@ -790,9 +734,37 @@ def initialize():
     menu = Menu()                       # メニュー画面を生成
 
 def display():
-    glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)  # カラーバッファとデプスバッファをクリア
-    menu.draw()        # 画面を表示
-    glutSwapBuffers()  # 実行していないコマンドを全て実行. glFlushの代わり
+    with profiler.scope('frame'):
+        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)  # カラーバッファとデプスバッファをクリア
+        with profiler.scope('menu'):
+            menu.draw()        # 画面を表示
+        if profiler.overlay:
+            drawProfile()      # 計測結果を表示
+        with profiler.scope('swap'):
+            glutSwapBuffers()  # 実行していないコマンドを全て実行. glFlushの代わり
+    profiler.endFrame()
+
+def drawProfile():
+    # 計測結果(区間ごとの1画面あたりの時間)を画面左上に表示
+    glMatrixMode(GL_PROJECTION)     # 投影行列を選択
+    glPushMatrix()                  # ゲームの投影行列を退避
+    glLoadIdentity()
+    glOrtho(0, 1, 0, 1, -1, 1)      # 画面全体を0～1とする
+    glMatrixMode(GL_MODELVIEW)      # モデルビュー行列を選択
+    glPushMatrix()                  # ゲームのモデルビュー行列を退避
+    glLoadIdentity()
+    glDisable(GL_DEPTH_TEST)        # ゲームの画面より手前に表示
+
+    glColor3f(1, 1, 0)              # 黄色で表示
+    for i, line in enumerate(profiler.lines()):
+        glRasterPos2d(0.01, 0.97 - 0.03*i)
+        render.text.draw(line, GLUT_BITMAP_8_BY_13)
+
+    glEnable(GL_DEPTH_TEST)
+    glPopMatrix()                   # モデルビュー行列を復帰
+    glMatrixMode(GL_PROJECTION)
+    glPopMatrix()                   # 投影行列を復帰
+    glMatrixMode(GL_MODELVIEW)
 
 def resize(w, h):
     ortho_size = menu.ortho_size        # 画面表示サイズを設定
@@ -808,89 +780,23 @@ def resize(w, h):
 
 def redisplayLoop(dummy):
     glutPostRedisplay()                                     # 再描画要請
-    glutTimerFunc(int(menu.delta_t*1000), redisplayLoop, 0) # 一定時間毎に再帰させる, 3つ目の引数はdummy
+    glutTimerFunc(int(menu.frame_interval*1000), redisplayLoop, 0) # 一定時間毎に再帰させる, 3つ目の引数はdummy
 
 def keyboardIn(key, x, y):
     # x,yはkey入力時のマウス位置
     if key == b'\r':   # Enter Key
         menu.enter_key = True
-    # ユーザー1
-    elif key == b'e':
-        menu.bit_control_key[0][2] = True
-    elif key == b'r':
-        menu.bit_control_key[0][3] = True
-    elif key == b'u':
-        menu.bit_control_key[0][0] = True
-    elif key == b'i':
-        menu.bit_control_key[0][1] = True
-    # ユーザー2
-    elif key == b'd':
-        menu.bit_control_key[1][2] = True
-    elif key == b'f':
-        menu.bit_control_key[1][3] = True
-    elif key == b'j':
-        menu.bit_control_key[1][0] = True
-    elif key == b'k':
-        menu.bit_control_key[1][1] = True
-    # ユーザー3
-    elif key == b'c':
-        menu.bit_control_key[2][2] = True
-    elif key == b'v':
-        menu.bit_control_key[2][3] = True
-    elif key == b'm':
-        menu.bit_control_key[2][0] = True
-    elif key == b',':
-        menu.bit_control_key[2][1] = True
-    # ユーザー4
-    elif key == b'3':
-        menu.bit_control_key[3][2] = True
-    elif key == b'4':
-        menu.bit_control_key[3][3] = True
-    elif key == b'7':
-        menu.bit_control_key[3][0] = True
-    elif key == b'8':
-        menu.bit_control_key[3][1] = True
+    elif key in USER_KEY_MAP:
+        user, flag = USER_KEY_MAP[key]
+        menu.bit_control_key[user] |= flag      # 入力キーのビットを立てる
 
 def keyboardOut(key, x, y):
     # x,yはkey入力時のマウス位置
     if key == b'\r':   # Enter Key
         menu.enter_key = False
-    # ユーザー1
-    elif key == b'e':
-        menu.bit_control_key[0][2] = False
-    elif key == b'r':
-        menu.bit_control_key[0][3] = False
-    elif key == b'u':
-        menu.bit_control_key[0][0] = False
-    elif key == b'i':
-        menu.bit_control_key[0][1] = False
-    # ユーザー2
-    elif key == b'd':
-        menu.bit_control_key[1][2] = False
-    elif key == b'f':
-        menu.bit_control_key[1][3] = False
-    elif key == b'j':
-        menu.bit_control_key[1][0] = False
-    elif key == b'k':
-        menu.bit_control_key[1][1] = False
-    # ユーザー3
-    elif key == b'c':
-        menu.bit_control_key[2][2] = False
-    elif key == b'v':
-        menu.bit_control_key[2][3] = False
-    elif key == b'm':
-        menu.bit_control_key[2][0] = False
-    elif key == b',':
-        menu.bit_control_key[2][1] = False
-    # ユーザー4
-    elif key == b'3':
-        menu.bit_control_key[3][2] = False
-    elif key == b'4':
-        menu.bit_control_key[3][3] = False
-    elif key == b'7':
-        menu.bit_control_key[3][0] = False
-    elif key == b'8':
-        menu.bit_control_key[3][1] = False
+    elif key in USER_KEY_MAP:
+        user, flag = USER_KEY_MAP[key]
+        menu.bit_control_key[user] &= ~flag     # 入力キーのビットを下ろす
 
 def keyboardSpIn(key, x, y):
     # x,yはkey入力時のマウス位置
@@ -902,6 +808,13 @@ def keyboardSpIn(key, x, y):
         menu.arrow_key['left'] = True
     elif key == GLUT_KEY_RIGHT:
         menu.arrow_key['right'] = True
+    # 処理時間の計測
+    elif key == GLUT_KEY_F1:
+        profiler.enabled = not profiler.enabled     # 計測と表示の切り替え
+        profiler.overlay = profiler.enabled
+    elif key == GLUT_KEY_F2:
+        profiler.exportCSV('hitbit_profile.csv')    # 計測結果を書き出す
+        profiler.exportJSON('hitbit_profile.json')
 
 def keyboardSpOut(key, x, y):
     # x,yはkey入力時のマウス位置
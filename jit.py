@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+# Numbaでコンパイルする1ステップの計算(移動と摩擦，衝突の撃力，オートコントロール)
+# Numbaがインストールされていれば World.step，SequentialCollision，AutoController はこちらを使い，
+# なければ(またはenabledをFalseにすると)NumPyの計算を使う
+# NumPyの計算と同じ値に同じ順番で同じ演算をするので，結果は完全に一致する(tools/regression.py jit で確認)
+#   HITBIT_JIT=0 python hitbit.py      (Numbaを使わない)
+
+import os
+import importlib.util
+import importlib.metadata
+import numpy as np
+
+available = importlib.util.find_spec('numba') is not None          # Numbaがインストールされているか(importはしない)
+enabled = available and os.environ.get('HITBIT_JIT', '1') != '0'    # コンパイルした計算を使うか(実行中に切り替えられる)
+
+def version():
+    # コンパイルした計算を使うときのNumbaの版(使わないときはNone)
+    return importlib.metadata.version('numba') if enabled else None
+
+def kernel(function):
+    # 初回の呼び出し時にNumbaをimportしてコンパイルする(__pycache__に保存して次回から使う)
+    # Numbaのimportは時間がかかるので，enabledのときに呼ばれるまで行わない
+    # ゼロ除算は例外にせずNumPyと同じくinf, nanにする．fastmathは使わない(演算の順番を変えない)
+    compiled = None
+    def call(*args):
+        nonlocal compiled
+        if compiled is None:
+            import numba
+            compiled = numba.njit(cache=True, error_model='numpy')(function)
+        return compiled(*args)
+    call.__name__ = function.__name__
+    return call
+
+@kernel
+def stepRows(index, position, velocity, direction, alive, input_key, torque, mass, max_speed, cos, sin,
+             filed_size, filed_friction, gravity, delta_t, brake_coefficient, stop_speed,
+             substep, friction_div, dead_height, dead):
+    # World.stepのindex行の更新(静止中の行は飛ばす)．落下した行をdeadに入れて，落下した数を返す
+    # filed_size, filed_frictionは長さ1(全行共通)か長さcount(行ごと)の配列
+    dead_num = 0
+    for r in index:
+        size = filed_size[r if len(filed_size) > 1 else 0]
+        friction = filed_friction[r if len(filed_friction) > 1 else 0]
+        half_size = size
+        half_size /= 2
+        v = velocity[r]
+        d = direction[r]
+        p = position[r]
+        key = input_key[r]
+
+        # 静止中(フィールドの上で速度が0で，加速と旋回の入力がない)は状態が変わらない
+        if (v[0] == 0 and v[1] == 0 and v[2] == 0 and not key[0] and not key[2] and not key[3]
+                and abs(p[0]) <= half_size and abs(p[1]) <= half_size):
+            continue
+
+        accel = torque[r] / mass[r]
+        accel *= delta_t
+
+        # 落下中の場合，重力加速度による落下処理
+        ground = not (abs(p[0]) > half_size or abs(p[1]) > half_size)
+        if not ground:
+            v[2] = v[2] - gravity * delta_t
+
+        # 加速
+        head_velocity = v[0]*d[0]
+        head_velocity += v[1]*d[1]
+        head_velocity += v[2]*d[2]
+        if head_velocity < 0:
+            head_velocity = 0.0
+        if ground and key[0] and head_velocity < max_speed[r]:
+            for k in range(3):
+                v[k] = v[k] + d[k] * accel
+
+        # ブレーキ
+        speed = np.sqrt(v[0]*v[0] + v[1]*v[1] + v[2]*v[2])
+        if speed > 0 and ground and key[1]:
+            brake = accel * brake_coefficient
+            for k in range(3):
+                v[k] = v[k] - (v[k] / speed) * brake
+
+        # 旋回(左旋回，右旋回の順)
+        for column in (2, 3):
+            signed_sin = sin[r] * (1 if column == 2 else -1)
+            x = d[0] * cos[r]
+            x -= d[1] * signed_sin
+            y = d[0] * signed_sin
+            y += d[1] * cos[r]
+            if ground and key[column]:
+                d[0] = x
+                d[1] = y
+
+        # 摩擦による減速
+        deceleration = friction * gravity
+        if substep:
+            deceleration *= delta_t / friction_div
+            for i in range(friction_div):
+                speed = np.sqrt(v[0]*v[0] + v[1]*v[1] + v[2]*v[2])
+                if not ground:
+                    continue
+                if speed > stop_speed:
+                    for k in range(3):
+                        v[k] = v[k] - (v[k] / speed) * deceleration
+                else:
+                    v[0] = 0.0
+                    v[1] = 0.0
+                    v[2] = 0.0
+        else:
+            speed = np.sqrt(v[0]*v[0] + v[1]*v[1] + v[2]*v[2])
+            new_speed = speed - deceleration * delta_t
+            scale = new_speed / speed if new_speed > stop_speed else 0.0
+            if ground:
+                for k in range(3):
+                    v[k] = v[k] * scale
+
+        # 位置座標を更新
+        for k in range(3):
+            p[k] += v[k] * delta_t
+        if not p[2] >= dead_height:
+            alive[r] = False
+            dead[dead_num] = r
+            dead_num += 1
+    return dead_num
+
+@kernel
+def findHits(rows, position, size):
+    # rows(昇順)の間で接触している組(i > j)を i, j の昇順で返す(総当たり)
+    n = len(rows)
+    capacity = 64
+    hit_i = np.empty(capacity, np.intp)
+    hit_j = np.empty(capacity, np.intp)
+    count = 0
+    for a in range(n):
+        i = rows[a]
+        for b in range(a):
+            j = rows[b]
+            x = position[j,0] - position[i,0]
+            y = position[j,1] - position[i,1]
+            z = position[j,2] - position[i,2]
+            distance = np.sqrt(x*x + y*y + z*z)
+            if distance <= abs(size[i] + size[j]):
+                if count == capacity:
+                    capacity *= 2
+                    hit_i = np.concatenate((hit_i, np.empty(capacity - count, np.intp)))
+                    hit_j = np.concatenate((hit_j, np.empty(capacity - count, np.intp)))
+                hit_i[count] = i
+                hit_j[count] = j
+                count += 1
+    return hit_i[:count], hit_j[:count]
+
+@kernel
+def applyHits(hit_i, hit_j, position, velocity, mass, bounce, size, jitter, skip_receding):
+    # SequentialCollisionの撃力の計算を1組ずつ順番に行う(skip_recedingのときは離れつつある組を飛ばす)
+    # jitterは重なり防止のランダム反発の乱数(中心間の距離が0.1未満の組の順に2つずつ)
+    close = 0
+    for k in range(len(hit_i)):
+        i = hit_i[k]
+        j = hit_j[k]
+        sub_x = position[j] - position[i]
+        distance = np.sqrt(sub_x[0]*sub_x[0] + sub_x[1]*sub_x[1] + sub_x[2]*sub_x[2])
+        r_in = abs(size[i] + size[j])
+
+        if distance < 0.1:
+            sub_x[0] += jitter[close,0]*0.5
+            velocity[i,1] += jitter[close,1]*0.5
+            close += 1
+
+        total_mass = mass[i] + mass[j]
+        total_bounce = 1 + bounce[i] * bounce[j]
+        sub_v = velocity[i] - velocity[j]
+        dot = sub_v[0]*sub_x[0] + sub_v[1]*sub_x[1] + sub_v[2]*sub_x[2]
+        if skip_receding and dot <= 0:
+            continue
+        rate = (total_bounce / total_mass) * dot
+        restitution = r_in / distance * 0.85
+        for c in range(3):
+            sub_tilde = rate * sub_x[c]
+            sub_tilde *= restitution
+            velocity[i,c] += -mass[j] * sub_tilde
+            velocity[j,c] += +mass[i] * sub_tilde
+
+@kernel
+def autoControl(rows, target, position, direction, velocity, max_speed, count, keys):
+    # AutoControllerの入力キーの計算．rowsの各行はtarget(昇順)の中で一番近い相手(自分以外)を狙う
+    for k in range(len(rows)):
+        r = rows[k]
+        nearest = -1
+        best = np.inf
+        for t in target:
+            if t == r or position[t,2] < 0:   # 場外に落ちている相手，自分は除く
+                continue
+            x = position[t,0] - position[r,0]
+            y = position[t,1] - position[r,1]
+            z = position[t,2] - position[r,2]
+            distance = np.sqrt(x*x + y*y + z*z)
+            if np.isnan(distance):  # np.argminと同じく最初のnanを選ぶ(相手なしとして扱う)
+                best = distance
+                break
+            if distance < best:
+                best = distance
+                nearest = t
+        found = np.isfinite(best)
+        if not found:
+            nearest = count - 1     # 相手がいないときは最後のplayerを照準にする
+
+        sight_x = position[nearest,0] - position[r,0]
+        sight_y = position[nearest,1] - position[r,1]
+        sight_z = position[nearest,2] - position[r,2]
+        length = np.sqrt(sight_x*sight_x + sight_y*sight_y + sight_z*sight_z)
+        sight_x = sight_x / length
+        sight_y = sight_y / length
+        sight_z = sight_z / length
+        d = direction[r]
+        dot = d[0]*sight_x + d[1]*sight_y + d[2]*sight_z
+        cross_z = d[0]*sight_y - d[1]*sight_x
+
+        v = velocity[r]
+        brake = np.sqrt(v[0]*v[0] + v[1]*v[1] + v[2]*v[2]) > max_speed[r] or not found
+        keys[k,0] = not brake and dot > 0 and abs(cross_z) < 0.5
+        keys[k,1] = brake
+        keys[k,2] = cross_z > 0.1
+        keys[k,3] = cross_z < -0.1
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+# 処理ごとの時間計測
+#   with profiler.scope('collision'):
+#       ...
+# 1画面(endFrameを呼ぶまで)の間に同じ名前の区間で計った時間を合計し，画面ごとの時間として直近capacity画面分を保持する
+# 無効のときは何もしないコンテキストを返すだけなので，計測箇所を残したままでもほとんど遅くならない
+
+import csv
+import json
+import time
+import contextlib
+import numpy as np
+
+class Scope:
+    # 計測区間(名前ごとに1つ作って使い回す)
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.start = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.add(self.name, time.perf_counter() - self.start)
+        return False
+
+class Profiler:
+    NULL_SCOPE = contextlib.nullcontext()   # 無効のときの区間
+    PERCENTILES = (50, 95, 99)
+
+    def __init__(self, enabled=False, capacity=1024):
+        self.enabled = enabled      # 計測するか
+        self.overlay = enabled      # 画面に表示するか
+        self.capacity = capacity    # 保持する画面数
+        self.scopes = {}            # 名前 -> Scope
+        self.current = {}           # 名前 -> この画面の合計時間 [sec]
+        self.samples = {}           # 名前 -> 画面ごとの時間のリングバッファ [sec]
+        self.count = {}             # 名前 -> 記録した画面数
+
+    def scope(self, name):
+        if not self.enabled:
+            return Profiler.NULL_SCOPE
+        scope = self.scopes.get(name)
+        if scope is None:
+            scope = self.scopes[name] = Scope(self, name)
+        return scope
+
+    def add(self, name, seconds):
+        self.current[name] = self.current.get(name, 0) + seconds
+
+    def endFrame(self):
+        # この画面の合計時間をリングバッファに記録する
+        for name, seconds in self.current.items():
+            samples = self.samples.get(name)
+            if samples is None:
+                samples = self.samples[name] = np.zeros(self.capacity)
+                self.count[name] = 0
+            samples[self.count[name] % self.capacity] = seconds
+            self.count[name] += 1
+        self.current = {}
+
+    def reset(self):
+        self.current = {}
+        self.samples = {}
+        self.count = {}
+
+    def stats(self):
+        # 名前ごとの画面数，平均，p50/p95/p99，最大 [ms]
+        stats = {}
+        for name, samples in self.samples.items():
+            samples = samples[:min(self.count[name], self.capacity)] * 1e3
+            p50, p95, p99 = np.percentile(samples, Profiler.PERCENTILES)
+            stats[name] = {
+                'count': self.count[name], 'mean': samples.mean(),
+                'p50': p50, 'p95': p95, 'p99': p99, 'max': samples.max(),
+            }
+        return stats
+
+    def lines(self):
+        # 画面に表示する文字列(1区間1行)
+        return ['%-12s p50 %6.2f  p95 %6.2f  p99 %6.2f ms' % (name, s['p50'], s['p95'], s['p99'])
+                for name, s in sorted(self.stats().items())]
+
+    def exportJSON(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.stats(), f, indent=2)
+
+    def exportCSV(self, path):
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['name', 'count', 'mean_ms', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms'])
+            for name, s in sorted(self.stats().items()):
+                writer.writerow([name, s['count'], s['mean'], s['p50'], s['p95'], s['p99'], s['max']])
+
+profiler = Profiler()   # ゲーム全体で共有する計測
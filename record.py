@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+# 試合の記録と再生
+# 初期配置(フィールド，bit car，配置角度)，乱数の種，各ステップのユーザーの入力キーだけを記録し，
+# 描画なしの物理計算で同じ試合を再現する．途中から再生できるように，一定間隔の状態(キーフレーム)も記録できる
+#
+# ファイル形式(リトルエンディアン)
+#   ヘッダー   HEADER
+#   bit car    CAR × (ユーザー数 + CPU数)
+#   入力キー   ステップ数(uint32)，各ステップのユーザーの入力キー(1人4bit，1バイトに2人分)
+#   キーフレーム  数(uint32)，各キーフレーム(KEYFRAME + 各bitの状態の配列)
+
+import struct
+import numpy as np
+
+from world import packKeys, unpackKeys
+from simulation import Simulation, Player, Car, Filed
+
+class Recording:
+    MAGIC = b'HBRC'
+    VERSION = 1
+    HEADER = struct.Struct('<4sHdddddQIHH') # 識別子, 版, 更新速度, フィールドサイズ, 摩擦係数, 重力加速度, 配置角度,
+                                            # 乱数の種, キーフレームの間隔, ユーザー数, CPU数
+    CAR = struct.Struct('<6d3f')            # 加速, 最高速, 旋回, 重量, 反発, サイズ, 色
+    KEYFRAME = struct.Struct('<I4QBI')      # ステップ数, 乱数生成器(PCG64)の状態
+    KEYFRAME_TIME = 5                       # キーフレームの間隔の初期値 [sec]
+
+    def __init__(self, filed, cars, user_num, seed, delta_t, theta=0, keyframe_interval=0):
+        self.filed = filed                          # フィールド
+        self.cars = list(cars)                      # 各プレイヤーのbit car(ユーザー，CPUの順)
+        self.user_num = user_num                    # ユーザー数
+        self.seed = seed                            # 乱数の種
+        self.delta_t = delta_t                      # 更新速度 [sec]
+        self.theta = theta                          # 1人目の配置角度
+        self.keyframe_interval = keyframe_interval  # キーフレームの間隔 [ステップ](0のときは記録しない)
+        self.tick_count = 0                         # 記録したステップ数
+        self.inputs = bytearray()                   # 各ステップのユーザーの入力キー
+        self.keyframes = []                         # キーフレーム(ステップ数の順)
+
+    @property
+    def tick_bytes(self):
+        return (self.user_num + 1) // 2 # 1ステップの入力キーのバイト数
+
+    @staticmethod
+    def capture(simulation, seed, theta=0, keyframe_time=KEYFRAME_TIME):
+        # Simulation.setupで作成した試合(seedとthetaはsetupに渡したもの)の記録を開始する
+        players = simulation.players
+        recording = Recording(
+            simulation.filed,
+            [player.car for player in players],
+            sum(1 for player in players if player.type == Player.TYPE_USER),
+            seed,
+            simulation.delta_t,
+            theta,
+            int(round(keyframe_time / simulation.delta_t)) if keyframe_time else 0
+        )
+        simulation.recorder = recording
+        return recording
+
+    def beginTick(self, simulation):
+        # ステップの最初(衝突計算の前)に呼ばれる．キーフレームの間隔ごとに状態を記録する
+        if self.keyframe_interval > 0 and simulation.tick % self.keyframe_interval == 0:
+            if not self.keyframes or self.keyframes[-1]['tick'] < simulation.tick:
+                self.keyframes.append(Recording.__snapshot(simulation))
+
+    def recordInput(self, simulation):
+        # ステップのコントロールの後に呼ばれる．ユーザーの入力キーを記録する
+        self.tick_count += 1
+        if self.user_num == 0:
+            return
+        keys = simulation.world.input_key[:self.user_num]   # ユーザーは先頭の行
+        nibble = packKeys(keys)
+        if len(nibble) % 2 == 1:
+            nibble = np.append(nibble, 0)
+        self.inputs += (nibble[0::2] | (nibble[1::2] << 4)).astype(np.uint8).tobytes()
+
+    def inputKeys(self, tick):
+        # tickステップ目のユーザーの入力キー((ユーザー数, 4)の配列)
+        start = tick * self.tick_bytes
+        packed = np.frombuffer(self.inputs, np.uint8, self.tick_bytes, start)
+        nibble = np.stack([packed & 0x0f, packed >> 4], axis=1).ravel()[:self.user_num]
+        return unpackKeys(nibble)
+
+    def setup(self, player_class=Player, filed_class=Filed):
+        # 記録した試合を最初の状態から作成する(ユーザーの入力キーは記録から再生する)
+        filed = filed_class(self.filed.size, self.filed.friction, self.filed.gravity)
+        simulation = Simulation.setup(
+            filed,
+            self.cars[:self.user_num],
+            self.cars[self.user_num:],
+            player_class = player_class,
+            delta_t = self.delta_t,
+            seed = self.seed,
+            theta = self.theta
+        )
+        if self.user_num > 0:
+            controller, index = simulation.controllers[0]   # ユーザーのキー入力をReplayControllerに置き換え
+            simulation.controllers[0] = (ReplayController(self, simulation), index)
+        return simulation
+
+    def restore(self, simulation, keyframe):
+        # キーフレームの状態をsimulationに戻す
+        world = simulation.world
+        world.position[:] = keyframe['position']
+        world.velocity[:] = keyframe['velocity']
+        world.direction[:] = keyframe['direction']
+        world.alive[:] = keyframe['alive']
+        world.refreshAlive()
+        world.rng.bit_generator.state = keyframe['rng']
+        simulation.tick = keyframe['tick']
+        simulation.death_tick[:] = keyframe['death_tick']
+        simulation.last_hit[:] = keyframe['last_hit']
+        simulation.knocked_out_by[:] = keyframe['knocked_out_by']
+        simulation.savePrevious()
+
+    @staticmethod
+    def __snapshot(simulation):
+        world = simulation.world
+        return {
+            'tick': simulation.tick,
+            'rng': world.rng.bit_generator.state,
+            'position': world.position.copy(),
+            'velocity': world.velocity.copy(),
+            'direction': world.direction.copy(),
+            'alive': world.alive.copy(),
+            'death_tick': simulation.death_tick.copy(),
+            'last_hit': simulation.last_hit.copy(),
+            'knocked_out_by': simulation.knocked_out_by.copy(),
+        }
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            f.write(self.toBytes())
+
+    def toBytes(self):
+        data = bytearray(Recording.HEADER.pack(
+            Recording.MAGIC, Recording.VERSION, self.delta_t,
+            self.filed.size, self.filed.friction, self.filed.gravity, self.theta,
+            self.seed, self.keyframe_interval, self.user_num, len(self.cars) - self.user_num
+        ))
+        for car in self.cars:
+            data += Recording.CAR.pack(
+                car.torque, car.max_speed, car.rotation, car.mass, car.bounce, car.size, *car.color
+            )
+        data += struct.pack('<I', self.tick_count)
+        data += self.inputs
+        data += struct.pack('<I', len(self.keyframes))
+        for keyframe in self.keyframes:
+            rng = keyframe['rng']['state']
+            data += Recording.KEYFRAME.pack(
+                keyframe['tick'],
+                rng['state'] & (2**64 - 1), rng['state'] >> 64, rng['inc'] & (2**64 - 1), rng['inc'] >> 64,
+                keyframe['rng']['has_uint32'], keyframe['rng']['uinteger']
+            )
+            data += np.concatenate([keyframe['position'], keyframe['velocity'], keyframe['direction']], axis=1).tobytes()
+            data += np.packbits(keyframe['alive']).tobytes()
+            data += np.stack([keyframe['death_tick'], keyframe['last_hit'], keyframe['knocked_out_by']]).astype('<i4').tobytes()
+        return bytes(data)
+
+    @staticmethod
+    def load(path):
+        with open(path, 'rb') as f:
+            return Recording.fromBytes(f.read())
+
+    @staticmethod
+    def fromBytes(data):
+        (magic, version, delta_t, size, friction, gravity, theta,
+         seed, keyframe_interval, user_num, cpu_num) = Recording.HEADER.unpack_from(data, 0)
+        if magic != Recording.MAGIC or version != Recording.VERSION:
+            raise ValueError('not a hitbit recording (version %d)' % Recording.VERSION)
+        offset = Recording.HEADER.size
+
+        cars = []
+        for i in range(user_num + cpu_num):
+            param = Recording.CAR.unpack_from(data, offset)
+            cars.append(Car(*param[:6], list(param[6:])))
+            offset += Recording.CAR.size
+
+        recording = Recording(Filed(size, friction, gravity), cars, user_num, seed, delta_t, theta, keyframe_interval)
+        (tick_count,) = struct.unpack_from('<I', data, offset)
+        offset += 4
+        recording.tick_count = tick_count
+        recording.inputs = bytearray(data[offset:offset + tick_count * recording.tick_bytes])
+        offset += tick_count * recording.tick_bytes
+
+        (keyframe_count,) = struct.unpack_from('<I', data, offset)
+        offset += 4
+        n = user_num + cpu_num
+        for i in range(keyframe_count):
+            tick, s0, s1, i0, i1, has_uint32, uinteger = Recording.KEYFRAME.unpack_from(data, offset)
+            offset += Recording.KEYFRAME.size
+            state = np.frombuffer(data, '<f8', n * 9, offset).reshape(n, 9)
+            offset += n * 9 * 8
+            alive = np.unpackbits(np.frombuffer(data, np.uint8, (n + 7) // 8, offset))[:n].astype(bool)
+            offset += (n + 7) // 8
+            record = np.frombuffer(data, '<i4', n * 3, offset).reshape(3, n).astype(np.int64)
+            offset += n * 3 * 4
+            recording.keyframes.append({
+                'tick': tick,
+                'rng': {'bit_generator': 'PCG64', 'state': {'state': s0 | (s1 << 64), 'inc': i0 | (i1 << 64)},
+                        'has_uint32': has_uint32, 'uinteger': uinteger},
+                'position': state[:,0:3].copy(),
+                'velocity': state[:,3:6].copy(),
+                'direction': state[:,6:9].copy(),
+                'alive': alive,
+                'death_tick': record[0],
+                'last_hit': record[1],
+                'knocked_out_by': record[2],
+            })
+        return recording
+
+class ReplayController:
+    # 記録したユーザーの入力キーをステップ数に合わせて設定する
+    def __init__(self, recording, simulation):
+        self.recording = recording
+        self.simulation = simulation
+
+    def control(self, world, index):
+        index = np.asarray(index, dtype=np.intp)
+        tick = self.simulation.tick
+        if tick < self.recording.tick_count:
+            keys = self.recording.inputKeys(tick)
+        else:
+            keys = np.zeros((len(index), 4), dtype=bool)    # 記録の後は入力なし
+        world.input_key[index] = keys
+        return keys
+
+class Replay:
+    # 記録した試合を再生する．seekでは一番近いキーフレームから進める
+    def __init__(self, recording, player_class=Player, filed_class=Filed):
+        self.recording = recording
+        self.player_class = player_class
+        self.filed_class = filed_class
+        self.simulation = recording.setup(player_class, filed_class)
+
+    def isFinished(self):
+        return self.simulation.tick >= self.recording.tick_count
+
+    def step(self, n=1):
+        # 記録の最後まで進める
+        n = min(n, self.recording.tick_count - self.simulation.tick)
+        if n > 0:
+            self.simulation.step(n)
+
+    def seek(self, tick):
+        # tickステップ目の状態にする
+        tick = max(0, min(tick, self.recording.tick_count))
+        keyframe = None
+        for k in self.recording.keyframes:
+            if k['tick'] <= tick:
+                keyframe = k
+        current = self.simulation.tick
+        if keyframe is not None and (tick < current or keyframe['tick'] > current):
+            self.recording.restore(self.simulation, keyframe)   # キーフレームから進める
+        elif tick < current:
+            self.simulation = self.recording.setup(self.player_class, self.filed_class)  # 最初から進め直す
+        self.step(tick - self.simulation.tick)
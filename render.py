@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+# 描画用のOpenGLリソースをまとめて管理する
+
+from OpenGL.GL import *
+from OpenGL.GL import shaders
+from OpenGL.GLUT import *
+import ctypes
+import collections
+import numpy as np
+
+class GLResourceError(RuntimeError):
+    # OpenGLから表示リストやバッファの番号を取得できなかった
+    pass
+
+class GLResources:
+    # 表示リストとバッファの番号をOpenGLから取得・解放し，使用中の数を数える
+    def __init__(self):
+        self.list_count = 0     # 使用中の表示リストの数
+        self.buffer_count = 0   # 使用中のバッファの数
+
+    def genLists(self, count=1):
+        # 連続したcount個の表示リスト番号を取得し，先頭の番号を返す
+        # 取得できないときはGLResourceErrorを送出する(どうするかは呼び出し側(Menu)で決める)
+        base = glGenLists(count)
+        if base == 0:
+            raise GLResourceError('glGenLists(%d) failed' % count)
+        self.list_count += count
+        return base
+
+    def deleteLists(self, base, count=1):
+        glDeleteLists(base, count)
+        self.list_count -= count
+
+    def genBuffer(self):
+        self.buffer_count += 1
+        return glGenBuffers(1)
+
+    def deleteBuffer(self, buffer):
+        glDeleteBuffers(1, [buffer])
+        self.buffer_count -= 1
+
+    def counts(self):
+        # 使用中のリソースの数(監視用)
+        return {'lists': self.list_count, 'buffers': self.buffer_count}
+
+resources = GLResources()   # 描画で使う全ての表示リストとバッファ
+
+class GeometryCache:
+    # 形が変わらない図形を表示リストに1度だけ登録して使い回す
+    # キーにはフィールドサイズや車両サイズを含めるので，サイズが変わったときだけ新しく作成される
+    def __init__(self):
+        self.lists = {}     # キー -> 表示リスト番号
+
+    def get(self, key, build):
+        # keyの表示リスト番号を返す．まだなければbuild()の描画内容で登録する
+        list_id = self.lists.get(key)
+        if list_id is None:
+            list_id = resources.genLists()      # 空いている表示リスト番号を取得
+            glNewList(list_id, GL_COMPILE)      # 画面描画リストの登録開始
+            try:
+                build()
+            except BaseException:
+                glEndList()                     # 登録を終了してから番号を解放する
+                resources.deleteLists(list_id)
+                raise
+            glEndList()                         # 画面描画リストの登録終了
+            self.lists[key] = list_id
+        return list_id
+
+    def release(self, key):
+        # keyの表示リストを削除する
+        list_id = self.lists.pop(key, None)
+        if list_id is not None:
+            resources.deleteLists(list_id)
+
+    def clear(self):
+        for key in list(self.lists):
+            self.release(key)
+
+geometry = GeometryCache()  # 車，リング，地面などの図形の表示リスト
+
+class InstancedRenderer:
+    # 同じ形の図形を，インスタンスごとの位置，向き，大きさ，色を変えて1回の描画命令でまとめて描画する
+    # インスタンスの情報は毎画面1つのバッファにまとめて転送する
+    # シェーダーやインスタンス描画が使えない環境では，表示リストを1つずつ呼び出して描画する(固定機能)
+    VERTEX_SHADER = '''
+        #version 120
+        attribute vec3 vertex;      // 図形の頂点
+        attribute vec3 offset;      // インスタンスの位置
+        attribute vec2 heading;     // インスタンスの向き(cos, sin)
+        attribute float scale;      // インスタンスの大きさ
+        attribute vec3 color;       // インスタンスの色
+        varying vec3 frag_color;
+        void main() {
+            vec3 p = vertex * scale;
+            p.xy = vec2(heading.x * p.x - heading.y * p.y, heading.y * p.x + heading.x * p.y);
+            gl_Position = gl_ModelViewProjectionMatrix * vec4(p + offset, 1.0);
+            frag_color = color;
+        }
+    '''
+    FRAGMENT_SHADER = '''
+        #version 120
+        varying vec3 frag_color;
+        void main() {
+            gl_FragColor = vec4(frag_color, 1.0);
+        }
+    '''
+
+    # インスタンスの情報の並び(名前, 要素数)．1インスタンス = float32 × 9
+    INSTANCE_LAYOUT = [('offset', 3), ('heading', 2), ('scale', 1), ('color', 3)]
+    INSTANCE_SIZE = 9
+
+    program = None      # 全ての図形で共有するシェーダー
+    available = None    # インスタンス描画が使えるか(Noneは未確認)
+
+    def __init__(self, name, mode, vertex):
+        self.name = name                                # 図形の名前(表示リストのキー)
+        self.mode = mode                                # 描画モード(GL_TRIANGLES, GL_LINE_LOOPなど)
+        self.vertex = np.asarray(vertex, np.float32)    # 図形の頂点 (M,3)
+        self.vertex_buffer = None                       # 頂点バッファ
+        self.instance_buffer = None                     # インスタンスの情報のバッファ
+
+    def draw(self, position, heading, scale, color):
+        # position (K,3)，heading (K,2) 向きの(cos, sin)，scale (K,)，color (K,3) のK個のインスタンスを描画する
+        if len(position) == 0:
+            return
+        if InstancedRenderer.available is None:
+            InstancedRenderer.available = InstancedRenderer.__setProgram()
+        if InstancedRenderer.available:
+            self.__drawInstanced(position, heading, scale, color)
+        else:
+            self.__drawFixed(position, heading, scale, color)
+
+    @staticmethod
+    def __setProgram():
+        # シェーダーを作成する．インスタンス描画が使えないときはFalseを返す
+        if not (bool(glDrawArraysInstanced) and bool(glVertexAttribDivisor)):
+            return False
+        try:
+            vertex_shader = shaders.compileShader(InstancedRenderer.VERTEX_SHADER, GL_VERTEX_SHADER)
+            fragment_shader = shaders.compileShader(InstancedRenderer.FRAGMENT_SHADER, GL_FRAGMENT_SHADER)
+            program = glCreateProgram()
+            glAttachShader(program, vertex_shader)
+            glAttachShader(program, fragment_shader)
+            glBindAttribLocation(program, 0, 'vertex')  # 頂点を0番にする(0番はインスタンスごとにしない)
+            glLinkProgram(program)
+            if glGetProgramiv(program, GL_LINK_STATUS) != GL_TRUE:
+                return False
+        except Exception:
+            return False
+        InstancedRenderer.program = program
+        return True
+
+    def __drawInstanced(self, position, heading, scale, color):
+        program = InstancedRenderer.program
+        if self.vertex_buffer is None:
+            self.vertex_buffer = resources.genBuffer()
+            glBindBuffer(GL_ARRAY_BUFFER, self.vertex_buffer)
+            glBufferData(GL_ARRAY_BUFFER, self.vertex.nbytes, self.vertex, GL_STATIC_DRAW)
+            self.instance_buffer = resources.genBuffer()
+
+        # インスタンスの情報を1つの配列にまとめて転送する
+        instance = np.empty((len(position), InstancedRenderer.INSTANCE_SIZE), np.float32)
+        instance[:,0:3] = position
+        instance[:,3:5] = heading
+        instance[:,5] = scale
+        instance[:,6:9] = color
+        glBindBuffer(GL_ARRAY_BUFFER, self.instance_buffer)
+        glBufferData(GL_ARRAY_BUFFER, instance.nbytes, instance, GL_STREAM_DRAW)
+
+        glUseProgram(program)
+        locations = []
+        stride = instance.itemsize * InstancedRenderer.INSTANCE_SIZE
+        start = 0
+        for name, size in InstancedRenderer.INSTANCE_LAYOUT:
+            location = glGetAttribLocation(program, name)
+            glEnableVertexAttribArray(location)
+            glVertexAttribPointer(location, size, GL_FLOAT, GL_FALSE, stride, ctypes.c_void_p(start * instance.itemsize))
+            glVertexAttribDivisor(location, 1)      # インスタンスごとに1つ進める
+            locations.append(location)
+            start += size
+
+        glBindBuffer(GL_ARRAY_BUFFER, self.vertex_buffer)
+        glEnableVertexAttribArray(0)
+        glVertexAttribPointer(0, 3, GL_FLOAT, GL_FALSE, 0, None)
+
+        glDrawArraysInstanced(self.mode, 0, len(self.vertex), len(position))   # 全インスタンスを1回で描画
+
+        # 固定機能の描画に影響しないように元に戻す
+        for location in locations:
+            glVertexAttribDivisor(location, 0)
+            glDisableVertexAttribArray(location)
+        glDisableVertexAttribArray(0)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+        glUseProgram(0)
+
+    def release(self):
+        # 頂点バッファとインスタンスの情報のバッファを解放する
+        if self.vertex_buffer is not None:
+            resources.deleteBuffer(self.vertex_buffer)
+            resources.deleteBuffer(self.instance_buffer)
+            self.vertex_buffer = None
+            self.instance_buffer = None
+
+    def __setMesh(self):
+        glBegin(self.mode)
+        for v in self.vertex:
+            glVertex3f(v[0], v[1], v[2])
+        glEnd()
+
+    def __drawFixed(self, position, heading, scale, color):
+        list_id = geometry.get(('mesh', self.name), self.__setMesh)
+        angle = np.rad2deg(np.arctan2(heading[:,1], heading[:,0]))
+        for i in range(len(position)):
+            glPushMatrix()
+            glTranslatef(position[i,0], position[i,1], position[i,2])
+            glRotatef(angle[i], 0, 0, 1)
+            glScaled(scale[i], scale[i], scale[i])
+            glColor3f(color[i,0], color[i,1], color[i,2])
+            glCallList(list_id)
+            glPopMatrix()
+
+def cubeVertex():
+    # 原点を中心とした一辺1の立方体の三角形(外から見て反時計回り)
+    vertex = []
+    for normal, u, v in (
+        ((1,0,0), (0,1,0), (0,0,1)), ((-1,0,0), (0,0,1), (0,1,0)),
+        ((0,1,0), (0,0,1), (1,0,0)), ((0,-1,0), (1,0,0), (0,0,1)),
+        ((0,0,1), (1,0,0), (0,1,0)), ((0,0,-1), (0,1,0), (1,0,0)),
+    ):
+        n, u, v = np.array(normal) * 0.5, np.array(u) * 0.5, np.array(v) * 0.5
+        vertex += [n-u-v, n+u-v, n+u+v, n-u-v, n+u+v, n-u+v]
+    return np.array(vertex)
+
+def ringVertex(division=10):
+    # 原点を中心とした半径1の円周の頂点
+    theta = np.pi*2/division * np.arange(division)
+    return np.stack([np.cos(theta), np.sin(theta), np.zeros(division)], axis=1)
+
+bodies = InstancedRenderer('body', GL_TRIANGLES, cubeVertex() * [1.5, 1, 1])   # Carの表示リストと同じ細長い直方体
+rings = InstancedRenderer('ring', GL_LINE_LOOP, ringVertex())                  # bitの周りのリング
+
+def drawBits(position, direction, size, color):
+    # bitのリングと車体をまとめて描画する(描画するbitだけを渡す)
+    heading = np.array(direction[:,:2])
+    norm = np.linalg.norm(heading, axis=1)
+    heading[norm == 0] = (1, 0)                     # 向きがないときは回転しない
+    norm[norm == 0] = 1
+    heading /= norm[:,None]
+
+    ground = np.array(position)
+    ground[:,2] = 0                                 # リングは地面の高さに描画
+    count = len(position)
+    rings.draw(ground, np.tile([1, 0], (count, 1)), size, np.tile([1, 0, 0], (count, 1)))
+
+    # Carの表示リストは一辺car.sizeの立方体で，drawCarBodyでさらにcar.size倍しているので，大きさはsize^2
+    bodies.draw(position, heading, size * size, color)
+
+class TextCache:
+    # 文字列の描画を表示リストにまとめて使い回す
+    # 文字列ごとの表示リストは(文字列, フォント)をキーに保持し，上限を超えたら長く使われていないものから削除する
+    # 数字を含む文字列(カウントダウンや設定値など)は変わりやすいので，文字ごとの表示リストをglCallListsでまとめて呼び出す
+    def __init__(self, capacity=256):
+        self.capacity = capacity                    # 文字列ごとの表示リストの上限数
+        self.lists = collections.OrderedDict()      # (文字列, フォント) -> 表示リスト番号(古い順)
+        self.glyph_base = {}                        # フォント -> 文字ごとの表示リストの先頭番号
+
+    def draw(self, string, font):
+        # 現在のラスター位置から文字列を描画する
+        string = bytes(string.encode('utf-8'))      # バイト文字列に変換
+        if any(48 <= c <= 57 for c in string):
+            glListBase(self.__glyphBase(font))      # 文字コードがそのまま表示リストの番号になる
+            glCallLists(string)
+            glListBase(0)
+        else:
+            glCallList(self.__stringList(string, font))
+
+    def __stringList(self, string, font):
+        key = (string, font.value)
+        list_id = self.lists.get(key)
+        if list_id is not None:
+            self.lists.move_to_end(key)             # 最近使ったものとして末尾に移動
+            return list_id
+
+        if len(self.lists) >= self.capacity:
+            key_old, list_old = self.lists.popitem(last=False)  # 一番長く使われていないものを削除
+            resources.deleteLists(list_old)
+        list_id = resources.genLists()
+        glNewList(list_id, GL_COMPILE)              # 画面描画リストの登録開始
+        for c in string:
+            glutBitmapCharacter(font, c)            # 一文字ずつ描画
+        glEndList()                                 # 画面描画リストの登録終了
+        self.lists[key] = list_id
+        return list_id
+
+    def __glyphBase(self, font):
+        base = self.glyph_base.get(font.value)
+        if base is None:
+            base = resources.genLists(256)          # 1バイトの文字コード全てに表示リストを用意
+            for c in range(256):
+                glNewList(base + c, GL_COMPILE)
+                glutBitmapCharacter(font, c)
+                glEndList()
+            self.glyph_base[font.value] = base
+        return base
+
+    def clear(self):
+        for list_id in self.lists.values():
+            resources.deleteLists(list_id)
+        self.lists.clear()
+        for base in self.glyph_base.values():
+            resources.deleteLists(base, 256)
+        self.glyph_base.clear()
+
+text = TextCache()  # Menuの文字列
+
+def clear():
+    # 描画で使った全ての表示リストとバッファを解放する(次に描画するときに作り直される)
+    geometry.clear()
+    text.clear()
+    bodies.release()
+    rings.release()
@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+# 描画(OpenGL)に依存しないゲーム本体
+# 描画はhitbit.pyのCar, Player, Filedがこれらのクラスを継承して行う
+
+import enum
+import numpy as np
+
+from world import World
+from collision import SequentialCollision, GridBroadPhase
+from controller import AutoController, KeyController
+from profiling import profiler
+
+# bit carのプリセット (加速, 最高速, 旋回, 重量, 反発, サイズ, 色)
+CAR_PRESETS = [
+    (600, 12, 5, 50, 0.6, 1.0, [0,1,0]),
+    (600, 12, 5, 50, 0.6, 1.0, [0,1,1]),
+    (600, 12, 5, 50, 0.6, 1.0, [1,1,0]),
+    (600, 12, 5, 50, 0.6, 1.0, [0,0,1]),
+    (600, 12, 5, 50, 0.6, 1.0, [1,1,1]),
+]
+
+# 設定画面の選択肢
+CPU_NUM_LIST = [8, 10, 12, 5]       # CPU数の選択リスト
+FILED_NUM_LIST = [20, 50, 75]       # フィールドサイズの選択リスト
+FILED_FRICTION = 0.75               # フィールドの摩擦係数
+GRAVITY = 9.8                       # 重力加速度
+
+class PlayerType(enum.IntEnum):
+    USER = 0
+    CPU  = 1
+
+class Status(enum.IntEnum):
+    ALIVE = 0
+    DEAD  = 1
+
+class Car:
+    __slots__ = ('torque', 'max_speed', 'rotation', 'mass', 'bounce', 'size', 'color')
+
+    def __init__(self, torque, max_speed, rotation, mass, bounce, size, color):
+        self.torque = torque        # 加速トルク [N]
+        self.max_speed = max_speed  # 最高速度 [m/s]
+        self.rotation = rotation    # 旋回速度 [rad/s]
+        self.mass = mass            # 質量 [kg]
+        self.bounce = bounce        # 疑似反発係数
+        self.size = size            # 車両サイズ [m]
+        self.color = color          # 車両色
+
+PRESET_CARS = [Car(*preset) for preset in CAR_PRESETS]  # プリセットのbit car(複数の試合で共有するので変更しない)
+
+class Player:
+    # 状態と車の種類はWorldの配列に保持し，Playerはその1行を参照するだけの小さなオブジェクト
+    __slots__ = ('name', 'type', 'world', 'index')
+
+    cpu_id_counter = 1  # 各CPUの番号付けのためのクラス変数
+
+    # Playerタイプ
+    TYPE_USER = PlayerType.USER
+    TYPE_CPU  = PlayerType.CPU
+
+    # 生存ステータス
+    ALIVE = Status.ALIVE
+    DEAD  = Status.DEAD
+
+    DELTA_T = None # 更新速度[sec]
+
+    auto_controller = AutoController() # オートコントロールの計算
+
+    def __init__(self, name, car, position, velocity, direction, world=None):
+        if name != None:
+            self.name = name                        # プレイヤー名
+            self.type = Player.TYPE_USER            # ユーザーとして設定
+        else:
+            self.name = 'CPU' + str(Player.cpu_id_counter) # CPU名
+            Player.cpu_id_counter += 1              # CPU数をインクリメント
+            self.type = Player.TYPE_CPU             # CUPとして設定
+
+        # 状態はWorldの配列に保持し，Playerはその1行を参照する
+        if world is None:
+            world = World()                         # 単独で使う場合は専用のWorldを作成
+        self.world = world
+        self.index = world.add(car, position, velocity, direction) # Worldの行番号
+
+    @classmethod
+    def fromRow(cls, name, type, world, index):
+        # Worldに登録済みの行を参照するPlayerを作成する(pickleからの復元など)
+        player = cls.__new__(cls)
+        player.name = name
+        player.type = PlayerType(type)
+        player.world = world
+        player.index = index
+        return player
+
+    def __reduce__(self):
+        # pickleするときは名前，タイプ，World，行番号だけを保存する
+        return (self.__class__.fromRow, (self.name, int(self.type), self.world, self.index))
+
+    @property
+    def car(self):
+        return self.world.car(self.index)   # 車の種類
+
+    @car.setter
+    def car(self, car):
+        self.world.setCar(self.index, car)  # Worldの車パラメータも切り替える
+
+    @property
+    def position(self):
+        return self.world.position[self.index]  # 位置(ベクトル)[m]
+
+    @position.setter
+    def position(self, value):
+        self.world.position[self.index] = value
+
+    @property
+    def velocity(self):
+        return self.world.velocity[self.index]  # 速度(ベクトル)[m/sec]
+
+    @velocity.setter
+    def velocity(self, value):
+        self.world.velocity[self.index] = value
+
+    @property
+    def direction(self):
+        return self.world.direction[self.index] # 車の向き(単位ベクトル)
+
+    @direction.setter
+    def direction(self, value):
+        self.world.direction[self.index] = value
+
+    @property
+    def status(self):
+        return Player.ALIVE if self.world.alive[self.index] else Player.DEAD # 生存ステータス
+
+    @status.setter
+    def status(self, value):
+        self.world.alive[self.index] = (value == Player.ALIVE)
+        self.world.refreshAlive()
+
+    @property
+    def input_key(self):
+        return self.world.input_key[self.index] # 入力キー
+
+    def inputKey(self, key_array):
+        self.world.input_key[self.index] = key_array
+
+    def calcAutoControl(self, player_list):
+        # 自分の行だけオートコントロールを計算(player_listは同じWorldを共有するplayerのリスト)
+        # 全CPUをまとめて計算する場合はAutoController.controlを使う
+        Player.auto_controller.control(self.world, [self.index])
+
+    def update(self, filed_size, filed_friction, gravity):
+        # 自分の行だけWorldで更新(全員をまとめて更新する場合はWorld.stepを使う)
+        self.world.step(filed_size, filed_friction, gravity, Player.DELTA_T, index=[self.index])
+
+class Filed:
+    def __init__(self, size, friction, gravity):
+        self.size = size
+        self.friction = friction
+        self.gravity = gravity
+
+class Simulation:
+    # 描画なしで試合を進める
+    DELTA_T = 0.1   # 更新速度[sec]
+
+    def __init__(self, filed, players, controllers=(), collision=None, delta_t=DELTA_T):
+        self.filed = filed                  # フィールド
+        self.players = list(players)        # プレイヤー(全員同じWorldを共有していること)
+        self.world = self.players[0].world if self.players else World()
+
+        # (コントローラー, 操作するWorldの行番号)のリスト
+        self.controllers = [(controller, np.asarray(index, dtype=np.intp)) for controller, index in controllers]
+
+        if collision is None:
+            collision = SequentialCollision(GridBroadPhase(), delta_t)
+        self.collision = collision          # bit同士の衝突計算
+        self.delta_t = delta_t              # 1ステップの時間[sec]
+        self.tick = 0                       # 経過ステップ数
+
+        # 1ステップ前の状態(描画時の補間に使う)
+        self.previous_position = self.world.position.copy()
+        self.previous_direction = self.world.direction.copy()
+
+        # 試合結果の記録
+        self.death_tick = np.full(self.world.count, -1)     # 落下したステップ(生存中は-1)
+        self.last_hit = np.full(self.world.count, -1)       # 最後に衝突した相手の行番号(いなければ-1)
+        self.knocked_out_by = np.full(self.world.count, -1) # 落下させた相手(最後に衝突した相手)の行番号
+        self.recorder = None                                # 試合の記録(record.Recording)
+
+    @staticmethod
+    def setup(filed, user_car_list, cpu_car_list, user_key_list=None,
+              player_class=Player, collision=None, delta_t=DELTA_T, seed=None, theta=0,
+              friction_mode=World.FRICTION_SUBSTEP):
+        # プレイヤーを円形に配置して試合を作成する(thetaは1人目の配置角度)
+        # friction_modeは摩擦の積分方法(World.FRICTION_ANALYTICにすると速いが，従来の試合と少し変わる)
+        world = World(friction_mode, seed)
+        Player.cpu_id_counter = 1   # CPUのIDカウンターをリセット
+
+        player_num = len(user_car_list) + len(cpu_car_list)
+        d_theta = 2*np.pi / player_num
+
+        players = []
+        for i, car in enumerate(list(user_car_list) + list(cpu_car_list)):
+            x = np.cos(theta)
+            y = np.sin(theta)
+            p_x = (filed.size / 4) * x
+            p_y = (filed.size / 4) * y
+            theta += d_theta
+
+            player = player_class(
+                'User' + str(i+1) if i < len(user_car_list) else None,  # ユーザー名(CPUはNone)
+                car,                                # bit car
+                np.array([p_x,p_y,0], np.float64),  # 初期位置
+                np.array([0,0,0], np.float64),      # 初期速度
+                np.array([-x,-y,0], np.float64),    # 初期角度
+                world                               # 状態を保持するWorld
+            )
+            players.append(player)
+
+        # ユーザーはキー入力，CPUはオートコントロールで操作する
+        user_index = [p.index for p in players if p.type == Player.TYPE_USER]
+        cpu_index = [p.index for p in players if p.type == Player.TYPE_CPU]
+        controllers = [(AutoController(), cpu_index)]
+        if len(user_index) > 0:
+            if user_key_list is None:
+                user_key_list = np.zeros(len(user_index), dtype=np.uint8)   # 入力キーのビットマスク
+            controllers.insert(0, (KeyController(user_key_list), user_index))
+
+        return Simulation(filed, players, controllers, collision, delta_t)
+
+    def aliveCount(self):
+        return self.world.aliveCount()
+
+    def isFinished(self):
+        # 試合終了判定(生存者が0人または1人)
+        return self.aliveCount() <= 1
+
+    def winner(self):
+        # 生存者が1人だけのときそのプレイヤー，それ以外はNone
+        if self.aliveCount() != 1:
+            return None
+        return self.players[int(self.world.alive_rows[0])]
+
+    def step(self, n=1):
+        for i in range(n):
+            self.savePrevious()     # 1ステップ前の状態を保存
+            if self.recorder is not None:
+                self.recorder.beginTick(self)
+
+            # 衝突コントロール
+            with profiler.scope('collision'):
+                hit_i, hit_j = self.collision.resolve(self.world)
+                self.last_hit[hit_i] = hit_j
+                self.last_hit[hit_j] = hit_i
+
+            # ユーザーのキー入力，CPUのオートコントロール
+            with profiler.scope('control'):
+                for controller, index in self.controllers:
+                    controller.control(self.world, index)
+            if self.recorder is not None:
+                self.recorder.recordInput(self)     # ユーザーの入力キーを記録
+
+            # 全員の状態をまとめて更新(落下したbitは以降の衝突，コントロール，更新から外れる)
+            with profiler.scope('update'):
+                dead = self.world.step(self.filed.size, self.filed.friction, self.filed.gravity, self.delta_t)
+            self.tick += 1
+
+            # このステップで落下したbitを記録
+            self.death_tick[dead] = self.tick
+            self.knocked_out_by[dead] = self.last_hit[dead]
+
+    def survivalTime(self):
+        # 各プレイヤーの生存時間[sec](生存中は現在までの時間)
+        tick = np.where(self.death_tick < 0, self.tick, self.death_tick)
+        return tick * self.delta_t
+
+    def eliminations(self):
+        # 各プレイヤーが落下させた相手の数
+        knocked = self.knocked_out_by[self.knocked_out_by >= 0]
+        return np.bincount(knocked, minlength=self.world.count)
+
+    def savePrevious(self):
+        # 現在の状態を1ステップ前の状態として保存する
+        # 毎ステップ配列を作らないように同じ配列にコピーする(bitが追加されて大きさが変わったときだけ作り直す)
+        world = self.world
+        if self.previous_position.shape != world.position.shape:
+            self.previous_position = world.position.copy()
+            self.previous_direction = world.direction.copy()
+        else:
+            np.copyto(self.previous_position, world.position)
+            np.copyto(self.previous_direction, world.direction)
+
+    def interpolate(self, alpha):
+        # 1ステップ前と現在の状態の間を補間した位置と向きを返す(alpha=0で1ステップ前，1で現在)
+        position = self.previous_position + (self.world.position - self.previous_position) * alpha
+        direction = self.previous_direction + (self.world.direction - self.previous_direction) * alpha
+        norm = np.linalg.norm(direction, axis=1)
+        norm[norm == 0] = 1
+        return position, direction / norm[:,None]
+
+    def runUntilFinished(self, max_ticks=None):
+        # 試合が終わるまで(またはmax_ticksステップまで)進めて，勝者を返す
+        while not self.isFinished():
+            if max_ticks is not None and self.tick >= max_ticks:
+                break
+            self.step()
+        return self.winner()
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+# 物理計算，衝突，オートコントロール，描画の処理時間を計測するスクリプト
+#   python tools/benchmark.py                              (表で表示)
+#   python tools/benchmark.py --output result.json         (結果をJSONで保存)
+#   python tools/benchmark.py --baseline baseline.json     (保存した結果と比べて遅くなった項目を表示)
+#   python tools/benchmark.py --compare baseline.json result.json   (保存した結果同士を比べる)
+#
+# OpenGLは呼び出し回数を数えるだけの代わりのモジュールに置き換えるので，画面のない環境(CI)でも実行できる
+# 描画の時間はPython側の処理(配列の準備，描画命令の呼び出し)の時間で，GPUの時間は含まない
+# 各項目は同じ状態から1ステップ分の処理をrepeat回計測し，中央値を比べる
+
+import os
+import re
+import sys
+import json
+import time
+import types
+import ctypes
+import tracemalloc
+import argparse
+import platform
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+BITS_LIST = [2, 13, 100, 1000]      # 計測するbit数
+COMPONENTS = ['update', 'collision', 'ai', 'draw', 'draw_fixed']
+
+class StubGL:
+    # OpenGL(GL，GLU，GLUT)の代わり．関数は呼び出し回数を数えるだけで，定数は適当な整数
+    # from OpenGL.GL import * で取り込まれる名前は，描画モジュールのソースに書かれているものから作る
+    SOURCES = ['hitbit.py', 'render.py']
+    NAME = re.compile(r'\b(?:glut|glu|gl)[A-Z]\w*|\bGL(?:UT|U)?_\w+')
+
+    def __init__(self):
+        self.calls = 0          # 関数の呼び出し回数
+        self.object_id = 0      # glGenLists，glGenBuffersで返した最後の番号
+        self.constants = {}
+        names = set()
+        for source in StubGL.SOURCES:
+            with open(os.path.join(ROOT, source), encoding='utf-8') as f:
+                names.update(StubGL.NAME.findall(f.read()))
+        self.names = sorted(names)
+
+    def install(self):
+        # sys.modulesに代わりのモジュールを登録する(描画モジュールをimportする前に呼ぶ)
+        modules = {}
+        for name in ['OpenGL', 'OpenGL.GL', 'OpenGL.GL.shaders', 'OpenGL.GLU', 'OpenGL.GLUT']:
+            module = types.ModuleType(name)
+            module.__all__ = [] if name in ('OpenGL', 'OpenGL.GL.shaders') else list(self.names)
+            module.__getattr__ = self.attribute
+            modules[name] = module
+        modules['OpenGL'].GL = modules['OpenGL.GL']
+        modules['OpenGL'].GLU = modules['OpenGL.GLU']
+        modules['OpenGL'].GLUT = modules['OpenGL.GLUT']
+        modules['OpenGL.GL'].shaders = modules['OpenGL.GL.shaders']
+        sys.modules.update(modules)
+
+    def attribute(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        if name.startswith('GLUT_BITMAP') or name.startswith('GLUT_STROKE'):
+            return self.constants.setdefault(name, ctypes.c_void_p(len(self.constants) + 1))   # フォント
+        if name[:2] == 'GL':
+            if name.endswith('_TRUE'):
+                return 1
+            if name.endswith('_FALSE'):
+                return 0
+            return self.constants.setdefault(name, len(self.constants) + 2)
+        if name in ('glGenLists', 'glGenBuffers'):
+            return self.generate
+        return self.call
+
+    def call(self, *args):
+        self.calls += 1
+        return 0
+
+    def generate(self, count):
+        # 表示リスト，バッファの番号(重ならない番号を返す)
+        self.calls += 1
+        base = self.object_id + 1
+        self.object_id += count
+        return base
+
+stub_gl = StubGL()
+stub_gl.install()
+
+import jit
+import render
+from hitbit import Car, Player, Filed
+from simulation import Simulation, CAR_PRESETS, FILED_NUM_LIST, FILED_FRICTION, GRAVITY
+
+class Bench:
+    # 1つの条件(bit数，フィールドサイズ)の試合．warmupステップ進めた状態から各処理を計測する
+    def __init__(self, bit_num, filed_size, seed, warmup):
+        cars = [Car(*CAR_PRESETS[i % len(CAR_PRESETS)]) for i in range(bit_num)]
+        self.filed = Filed(filed_size, FILED_FRICTION, GRAVITY)
+        self.simulation = Simulation.setup(self.filed, [], cars, player_class=Player, seed=seed)
+        # 計測前にwarmupステップ動かしておく．bitが重なって配置される条件(bit数が多く，フィールドが狭い)では
+        # 最初の衝突計算で速度が発散することがあるので，衝突計算はせずにコントロールと更新だけで進める
+        world = self.simulation.world
+        for t in range(warmup):
+            for controller, index in self.simulation.controllers:
+                controller.control(world, index)
+            world.step(filed_size, FILED_FRICTION, GRAVITY, self.simulation.delta_t)
+        self.color = np.array([car.color for car in cars], np.float64)
+
+        self.snapshot = {
+            'position': world.position.copy(),
+            'velocity': world.velocity.copy(),
+            'direction': world.direction.copy(),
+            'alive': world.alive.copy(),
+            'input_key': world.input_key.copy(),
+            'rng': world.rng.bit_generator.state,
+        }
+
+    def restore(self):
+        world = self.simulation.world
+        for name in ('position', 'velocity', 'direction', 'alive', 'input_key'):
+            getattr(world, name)[:] = self.snapshot[name]
+        world.rng.bit_generator.state = self.snapshot['rng']
+        world.refreshAlive()
+
+    def run(self, component):
+        # componentの処理を1回行う
+        sim = self.simulation
+        world = sim.world
+        if component == 'update':
+            world.step(sim.filed.size, sim.filed.friction, sim.filed.gravity, sim.delta_t)
+        elif component == 'collision':
+            sim.collision.resolve(world)
+        elif component == 'ai':
+            for controller, index in sim.controllers:
+                controller.control(world, index)
+        else:
+            # Menu.__drawBattleと同じ描画(地面と生存しているbit)．draw_fixedはインスタンス描画が使えない環境の描画
+            render.InstancedRenderer.available = component == 'draw'
+            self.filed.draw()
+            alive = world.alive
+            render.drawBits(world.position[alive], world.direction[alive], world.size[alive], self.color[alive])
+
+    def measure(self, component, repeat):
+        # 同じ状態からrepeat回計測した時間 [ms]，1回あたりのOpenGLの呼び出し回数，確保したメモリ [byte]
+        self.run(component)     # 表示リストの作成など，最初の1回だけの処理は含めない
+        elapsed = np.empty(repeat)
+        calls = stub_gl.calls
+        for r in range(repeat):
+            self.restore()
+            start = time.perf_counter()
+            self.run(component)
+            elapsed[r] = time.perf_counter() - start
+        self.restore()
+        calls = (stub_gl.calls - calls) // repeat
+
+        # 1回の処理で一時的に確保したメモリの最大量(tracemallocで計測するので時間とは別に1回だけ行う)
+        tracemalloc.start()
+        base = tracemalloc.get_traced_memory()[0]
+        self.run(component)
+        allocated = tracemalloc.get_traced_memory()[1] - base
+        tracemalloc.stop()
+        self.restore()
+        return elapsed * 1e3, calls, allocated
+
+def runBenchmark(args):
+    results = []
+    for bit_num in args.bits:
+        for filed_size in args.filed:
+            bench = Bench(bit_num, filed_size, args.seed, args.warmup)
+            for component in args.components:
+                elapsed, calls, allocated = bench.measure(component, args.repeat)
+                results.append({
+                    'component': component,
+                    'bits': bit_num,
+                    'filed': filed_size,
+                    'alive': int(bench.snapshot['alive'].sum()),
+                    'median_ms': float(np.median(elapsed)),
+                    'min_ms': float(elapsed.min()),
+                    'p95_ms': float(np.percentile(elapsed, 95)),
+                    'gl_calls': int(calls),
+                    'alloc_kb': allocated / 1024,
+                })
+                print('%-10s bit %4d, filed %2d : median %8.3f [ms], min %8.3f [ms], gl calls %6d, alloc %8.1f [KB]' % (
+                    component, bit_num, filed_size, results[-1]['median_ms'], results[-1]['min_ms'], calls, allocated / 1024
+                ), file=sys.stderr)
+    return {
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'numba': jit.version(),   # Numbaでコンパイルした計算を使ったか
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+            'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        },
+        'settings': {'repeat': args.repeat, 'warmup': args.warmup, 'seed': args.seed},
+        'results': results,
+    }
+
+def compare(baseline, current, threshold, floor):
+    # 中央値がbaselineの(1 + threshold)倍より遅く，かつfloor [ms]以上遅くなった項目を遅くなったとする
+    reference = {(r['component'], r['bits'], r['filed']): r for r in baseline['results']}
+    regressions = 0
+    for r in current['results']:
+        base = reference.get((r['component'], r['bits'], r['filed']))
+        if base is None:
+            continue
+        ratio = r['median_ms'] / base['median_ms'] if base['median_ms'] > 0 else np.inf
+        slower = ratio > 1 + threshold and r['median_ms'] - base['median_ms'] > floor
+        regressions += slower
+        print('%-10s bit %4d, filed %2d : %8.3f -> %8.3f [ms]  x%5.2f %s' % (
+            r['component'], r['bits'], r['filed'], base['median_ms'], r['median_ms'], ratio,
+            'REGRESSION' if slower else ''
+        ))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bits', type=int, nargs='+', default=BITS_LIST)
+    parser.add_argument('--filed', type=int, nargs='+', default=FILED_NUM_LIST)
+    parser.add_argument('--components', nargs='+', choices=COMPONENTS, default=COMPONENTS)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=5)     # 計測前に進めるステップ数
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output')                          # 結果を保存するJSONファイル
+    parser.add_argument('--baseline')                        # 比べる結果のJSONファイル
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'CURRENT'))
+    parser.add_argument('--threshold', type=float, default=0.2)     # 遅くなったとする割合
+    parser.add_argument('--floor', type=float, default=0.05)        # 遅くなったとする最小の差 [ms]
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            baseline = json.load(f)
+        with open(args.compare[1]) as f:
+            current = json.load(f)
+    else:
+        current = runBenchmark(args)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(current, f, indent=2)
+        if not args.baseline:
+            return 0
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    regressions = compare(baseline, current, args.threshold, args.floor)
+    print('%d regression(s)' % regressions)
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
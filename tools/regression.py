@@ -0,0 +1,400 @@
+# -*- coding: utf-8 -*-
+# 物理計算の実装を切り替えたときに，結果が変わっていないかを確認するスクリプト
+#   python tools/regression.py friction
+#   python tools/regression.py collision
+#   python tools/regression.py ai
+#   python tools/regression.py batch
+#   python tools/regression.py swept
+#   python tools/regression.py jit
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import jit
+from world import World
+from collision import BruteForceBroadPhase, GridBroadPhase, SequentialCollision, VectorizedCollision, SweptCollision
+from controller import AutoController
+from simulation import Simulation, Car, Filed, CAR_PRESETS, FILED_NUM_LIST
+from batch import BatchWorld, BatchSimulation, BatchCollision, BatchSweptCollision
+
+class CarParam:
+    # Menu.car_listのbit carと同じパラメータ(描画はしない)
+    def __init__(self, torque=600, max_speed=12, rotation=5, mass=50, bounce=0.6, size=1.0):
+        self.torque = torque
+        self.max_speed = max_speed
+        self.rotation = rotation
+        self.mass = mass
+        self.bounce = bounce
+        self.size = size
+
+def makeWorld(player_num, filed_size, friction_mode):
+    # __setGameContentと同じように円形に配置したWorldを作成
+    world = World(friction_mode)
+    for i in range(player_num):
+        theta = 2*np.pi / player_num * i
+        x = np.cos(theta)
+        y = np.sin(theta)
+        world.add(CarParam(), [filed_size/4*x, filed_size/4*y, 0], [0, 0, 0], [-x, -y, 0])
+    return world
+
+def runTrajectory(player_num, filed_size, friction_mode, ticks, seed, delta_t=0.1):
+    # 乱数で決めた入力キーで更新し，各時刻の位置を返す
+    rng = np.random.default_rng(seed)
+    world = makeWorld(player_num, filed_size, friction_mode)
+    trajectory = np.empty((ticks, player_num, 3))
+    elapsed = 0
+    for t in range(ticks):
+        world.input_key[:] = rng.random((player_num, 4)) < 0.4
+        start = time.perf_counter()
+        world.step(filed_size, 0.75, 9.8, delta_t)
+        elapsed += time.perf_counter() - start
+        trajectory[t] = world.position
+    return trajectory, elapsed
+
+def checkFriction(args):
+    ok = True
+    for filed_size in (20, 50, 75):
+        for player_num in (1, 13):
+            substep, t_substep = runTrajectory(player_num, filed_size, World.FRICTION_SUBSTEP, args.ticks, args.seed)
+            analytic, t_analytic = runTrajectory(player_num, filed_size, World.FRICTION_ANALYTIC, args.ticks, args.seed)
+            error = np.nanmax(np.abs(substep - analytic))
+            ok &= error <= args.tolerance
+            print('filed %2d, bit %2d : max error %.2e [m], substep %.2f [ms/tick], analytic %.3f [ms/tick], x%.1f' % (
+                filed_size, player_num, error,
+                t_substep / args.ticks * 1e3, t_analytic / args.ticks * 1e3, t_substep / t_analytic
+            ))
+    return ok
+
+def makeCluster(player_num, spread, seed):
+    # 密集したbitの集まりを作成(重なり防止のランダム反発が起きるように，重なった組も入れる)
+    rng = np.random.default_rng(seed)
+    world = World(seed=seed)
+    for i in range(player_num):
+        world.add(CarParam(), np.r_[rng.uniform(-spread, spread, 2), 0], rng.normal(0, 5, 3), [1, 0, 0])
+    world.position[1] = world.position[0] + [0.01, 0.02, 0]
+    return world
+
+def referenceCollision(world):
+    # 1台ずつ計算していたときのMenu.__drawBattleの衝突コントロールと同じ計算(乱数はworld.rngから同じ順番で取り出す)
+    for i in range(world.count):
+        j = 0
+        while j < i: # i番目とj番目の衝突を計算
+            # プレイヤー間の距離を計算
+            sub_x = world.position[j] - world.position[i]
+            distance = np.linalg.norm(sub_x)
+            r_in = np.abs(world.size[i] + world.size[j])
+
+            # 衝突していないとき
+            if distance > r_in:
+                j += 1
+                continue # do nothing
+
+            # 衝突しているとき
+            else:
+                if distance < 0.1: # bitの重なり防止のランダム反発
+                    sub_x[0] += world.rng.random()*0.5
+                    world.velocity[i,1] += world.rng.random()*0.5
+
+                total_mass = world.mass[i] + world.mass[j]
+                total_bounce = 1 + world.bounce[i] * world.bounce[j]
+                dot = (world.velocity[i] - world.velocity[j]).dot(sub_x)
+                sub_tilde = ((total_bounce / total_mass) * dot) * sub_x
+
+                sub_tilde *= r_in / distance * 0.85 # bitの重なり防止のための擬似的な反発係数(距離に反比例)
+
+                world.velocity[i] += -world.mass[j] * sub_tilde
+                world.velocity[j] += +world.mass[i] * sub_tilde
+
+            # jをインクリメント
+            j += 1
+
+def checkCollision(args):
+    # 全ての衝突計算が，従来の1組ずつの計算(総当たり)と同じ結果になるか確認する
+    # 離れつつある組を飛ばすのは従来より短いステップのときだけなので，従来のステップ(0.1 [sec])では
+    # 以前の衝突コントロール(referenceCollision)とも内積と距離の計算の丸め誤差の範囲で一致する
+    ok = True
+    backends = [
+        ('grid', lambda: SequentialCollision(GridBroadPhase())),
+        ('vectorized ordered', lambda: VectorizedCollision(ordered=True)),
+        ('vectorized', lambda: VectorizedCollision()),
+    ]
+    for player_num, spread in ((13, 3), (100, 10), (300, 8)):
+        reference = makeCluster(player_num, spread, args.seed)
+        SequentialCollision(BruteForceBroadPhase()).resolve(reference)
+        original = makeCluster(player_num, spread, args.seed)
+        referenceCollision(original)
+        error = np.abs(reference.velocity - original.velocity).max() / np.abs(original.velocity).max()
+        ok &= error <= 1e-12
+        print('bit %3d, %-18s : relative error %.2e' % (player_num, 'original loop', error))
+        for name, backend in backends:
+            world = makeCluster(player_num, spread, args.seed)
+            start = time.perf_counter()
+            backend().resolve(world)
+            elapsed = time.perf_counter() - start
+            error = np.abs(world.velocity - reference.velocity).max()
+            if name != 'vectorized':
+                ok &= error == 0    # 順番を保つ計算は完全に一致する
+            print('bit %3d, %-18s : max error %.2e [m/s], %.2f [ms]' % (player_num, name, error, elapsed * 1e3))
+    return ok
+
+def referenceAutoControl(world, row):
+    # 1台ずつ計算していたときのPlayer.calcAutoControlと同じ計算
+    input_key = [False, False, False, False]
+    d_min = np.inf
+    d_min_index = -1
+    for i in range(world.count):
+        if world.position[i,2] < 0 or i == row:
+            continue
+        distance = np.linalg.norm(world.position[row] - world.position[i])
+        if distance < d_min:
+            d_min = distance
+            d_min_index = i
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sight = world.position[d_min_index] - world.position[row]
+        sight = sight / np.linalg.norm(sight)
+        dot = world.direction[row].dot(sight)
+        cross_z = np.cross(world.direction[row], sight)[2]
+
+    if np.linalg.norm(world.velocity[row]) > world.max_speed[row] or d_min_index == -1:
+        input_key[0] = False
+        input_key[1] = True
+    elif dot > 0 and np.abs(cross_z) < 0.5:
+        input_key[0] = True
+        input_key[1] = False
+    if cross_z > 0.1:
+        input_key[2] = True
+    elif cross_z < -0.1:
+        input_key[3] = True
+    return input_key
+
+def checkAutoControl(args):
+    # まとめて計算したオートコントロールが，1台ずつ計算した結果と完全に一致するか確認する
+    ok = True
+    for player_num in (2, 13, 100):
+        rng = np.random.default_rng(args.seed)
+        mismatch = 0
+        t_reference = 0
+        t_batch = 0
+        for trial in range(args.ticks // 10):
+            world = makeCluster(player_num, 20, int(rng.integers(1 << 30)))
+            theta = rng.uniform(-np.pi, np.pi, player_num)
+            world.direction[:,0] = np.cos(theta)
+            world.direction[:,1] = np.sin(theta)
+            world.velocity *= 2                                         # 速すぎて減速するbitを含める
+            world.position[rng.random(player_num) < 0.3, 2] = -1        # 場外に落ちているbitを含める
+            if trial % 5 == 0:
+                world.position[1:, 2] = -1                              # 相手がいない場合を含める
+
+            start = time.perf_counter()
+            reference = np.array([referenceAutoControl(world, row) for row in range(player_num)])
+            t_reference += time.perf_counter() - start
+            start = time.perf_counter()
+            keys = AutoController().control(world, np.arange(player_num))
+            t_batch += time.perf_counter() - start
+            mismatch += np.count_nonzero(np.any(keys != reference, axis=1))
+        ok &= mismatch == 0
+        print('bit %3d : mismatch %d, reference %.2f [ms/tick], batch %.3f [ms/tick]' % (
+            player_num, mismatch, t_reference / (args.ticks // 10) * 1e3, t_batch / (args.ticks // 10) * 1e3
+        ))
+    return ok
+
+def checkBatch(args):
+    # まとめて進めたアリーナが，1試合ずつSimulationで進めた結果と完全に一致するか確認する
+    # (衝突は同じ順番で計算するordered=Trueで比べる．重なり防止のランダム反発の乱数は
+    #  全アリーナで1つの乱数生成器をアリーナ順に使うので，Simulationも1つの乱数生成器を共有して同じ順に進める)
+    ok = True
+    for arena_num, player_num in ((6, 8), (30, 12)):
+        torque = np.linspace(400, 800, arena_num)
+        batch = BatchWorld(arena_num, player_num, seed=args.seed)
+        rng = np.random.default_rng(args.seed)     # batchと同じ種の乱数生成器をSimulationで共有する
+        sims = []
+        for k in range(arena_num):
+            filed_size = FILED_NUM_LIST[k % len(FILED_NUM_LIST)]
+            cars = [Car(*CAR_PRESETS[0]) for s in range(player_num)]
+            cars[0].torque = torque[k]
+            for s, car in enumerate(cars):
+                batch.setCar(k, s, car)
+            batch.place(k, filed_size, theta=0.1*k)
+            sim = Simulation.setup(Filed(filed_size, 0.75, 9.8), [], cars,
+                                   collision=VectorizedCollision(ordered=True), theta=0.1*k)
+            sim.world.rng = rng
+            sims.append(sim)
+        batch_sim = BatchSimulation(batch, collision=BatchCollision(ordered=True))
+
+        t_single = 0
+        t_batch = 0
+        for t in range(args.ticks):
+            start = time.perf_counter()
+            for sim in sims:
+                if not sim.isFinished():   # 決着がついたアリーナはそこで止まる
+                    sim.step()
+            t_single += time.perf_counter() - start
+            start = time.perf_counter()
+            batch_sim.step()
+            t_batch += time.perf_counter() - start
+
+        mismatch = 0
+        error = 0
+        for k, sim in enumerate(sims):
+            mismatch += np.count_nonzero(sim.death_tick != batch_sim.death_tick[k])
+            error = max(error, np.abs(sim.world.position - batch.position[k]).max())
+        ok &= mismatch == 0 and error == 0
+        print('arena %2d x bit %2d : death tick mismatch %d, max error %.2e [m], single %.1f [ms], batch %.1f [ms], x%.1f' % (
+            arena_num, player_num, mismatch, error, t_single * 1e3, t_batch * 1e3, t_single / t_batch
+        ))
+    return ok
+
+def headOn(collision, speed, delta_t):
+    # 正面から近づく2台を1ステップ進めて，すり抜けたか(x座標の順が入れ替わったか)と中心間の距離を返す
+    world = World()
+    gap = speed * delta_t   # 1ステップで2台分以上近づく
+    world.add(CarParam(), [-gap/2 - 1, 0, 0], [+speed, 0, 0], [1, 0, 0])
+    world.add(CarParam(), [+gap/2 + 1, 0, 0], [-speed, 0, 0], [-1, 0, 0])
+    collision.resolve(world)
+    world.step(1000, 0, 9.8, delta_t)   # 摩擦なし
+    return world.position[0,0] > world.position[1,0], abs(world.position[1,0] - world.position[0,0])
+
+def checkSwept(args):
+    # 連続衝突判定が大きいdelta_tでもすり抜けないこと，まとめて進めたアリーナと1試合ずつの結果が一致することを確認する
+    ok = True
+    for delta_t in (0.1, 0.5, 1.0):
+        for speed in (12, 40):
+            tunnel, gap = headOn(SequentialCollision(), speed, delta_t)
+            swept_tunnel, swept_gap = headOn(SweptCollision(delta_t), speed, delta_t)
+            ok &= not swept_tunnel
+            print('delta_t %.1f, speed %2d : sequential %-8s (gap %6.2f [m]), swept %-8s (gap %6.2f [m])' % (
+                delta_t, speed, 'tunnel' if tunnel else 'bounce', gap, 'tunnel' if swept_tunnel else 'bounce', swept_gap
+            ))
+
+    for arena_num, player_num, delta_t in ((6, 8, 0.1), (30, 12, 0.2)):
+        batch = BatchWorld(arena_num, player_num, seed=args.seed)
+        sims = []
+        for k in range(arena_num):
+            filed_size = FILED_NUM_LIST[k % len(FILED_NUM_LIST)]
+            cars = [Car(*CAR_PRESETS[s % len(CAR_PRESETS)]) for s in range(player_num)]
+            for s, car in enumerate(cars):
+                batch.setCar(k, s, car)
+            batch.place(k, filed_size, theta=0.1*k)
+            sims.append(Simulation.setup(Filed(filed_size, 0.75, 9.8), [], cars,
+                                         collision=SweptCollision(delta_t), delta_t=delta_t, theta=0.1*k))
+        batch_sim = BatchSimulation(batch, collision=BatchSweptCollision(delta_t), delta_t=delta_t)
+
+        start = time.perf_counter()
+        for t in range(args.ticks):
+            for sim in sims:
+                if not sim.isFinished():
+                    sim.step()
+        t_single = time.perf_counter() - start
+        start = time.perf_counter()
+        batch_sim.step(args.ticks)
+        t_batch = time.perf_counter() - start
+
+        mismatch = sum(np.count_nonzero(sim.death_tick != batch_sim.death_tick[k]) for k, sim in enumerate(sims))
+        error = max(np.abs(sim.world.position - batch.position[k]).max() for k, sim in enumerate(sims))
+        ok &= mismatch == 0 and error == 0
+        print('arena %2d x bit %2d, delta_t %.1f : death tick mismatch %d, max error %.2e [m], single %.1f [ms], batch %.1f [ms]' % (
+            arena_num, player_num, delta_t, mismatch, error, t_single * 1e3, t_batch * 1e3
+        ))
+    return ok
+
+def corpusMatch(player_num, filed_size, ticks, seed):
+    # CPU同士の試合を進めた後の状態
+    cars = [Car(*CAR_PRESETS[i % len(CAR_PRESETS)]) for i in range(player_num)]
+    sim = Simulation.setup(Filed(filed_size, 0.75, 9.8), [], cars, seed=seed, theta=seed)
+    sim.step(ticks)
+    world = sim.world
+    return [world.position, world.velocity, world.direction, world.alive, sim.death_tick, sim.last_hit]
+
+def corpusFriction(player_num, filed_size, friction_mode, ticks, seed):
+    # 乱数の入力キーで動かした軌跡
+    return [runTrajectory(player_num, filed_size, friction_mode, ticks, seed)[0]]
+
+def corpusCollision(player_num, spread, seed):
+    # 重なった組を含む密集したbitの衝突計算の後の速度
+    world = makeCluster(player_num, spread, seed)
+    hit_i, hit_j = SequentialCollision().resolve(world)
+    return [world.velocity, hit_i, hit_j]
+
+def corpusAutoControl(player_num, seed):
+    # 場外のbit，相手がいないbit，速すぎるbitを含むオートコントロールの入力キー
+    rng = np.random.default_rng(seed)
+    world = makeCluster(player_num, 20, seed)
+    theta = rng.uniform(-np.pi, np.pi, player_num)
+    world.direction[:,0] = np.cos(theta)
+    world.direction[:,1] = np.sin(theta)
+    world.velocity *= 2
+    world.position[rng.random(player_num) < 0.3, 2] = -1
+    world.refreshAlive()
+    return [AutoController().control(world, np.arange(player_num))]
+
+def corpusBatch(arena_num, player_num, ticks, seed):
+    # アリーナごとにフィールドサイズが違うBatchSimulation
+    batch = BatchWorld(arena_num, player_num, seed=seed)
+    for k in range(arena_num):
+        for s in range(player_num):
+            batch.setCar(k, s, Car(*CAR_PRESETS[(k + s) % len(CAR_PRESETS)]))
+        batch.place(k, FILED_NUM_LIST[k % len(FILED_NUM_LIST)], theta=0.1*k)
+    sim = BatchSimulation(batch)
+    sim.step(ticks)
+    return [batch.world.position, batch.world.velocity, sim.death_tick]
+
+def checkJIT(args):
+    # 共通のケース(corpus)をNumbaでコンパイルした計算とNumPyの計算で実行し，結果が完全に一致するか確認する
+    if not jit.available:
+        print('numba is not installed (NumPy only)')
+        return True
+    corpus = [
+        ('match bit 2, filed 20', lambda: corpusMatch(2, 20, args.ticks, args.seed)),
+        ('match bit 13, filed 50', lambda: corpusMatch(13, 50, args.ticks, args.seed)),
+        ('match bit 100, filed 75', lambda: corpusMatch(100, 75, args.ticks, args.seed)),
+        ('friction substep', lambda: corpusFriction(13, 50, World.FRICTION_SUBSTEP, args.ticks, args.seed)),
+        ('friction analytic', lambda: corpusFriction(13, 50, World.FRICTION_ANALYTIC, args.ticks, args.seed)),
+        ('collision bit 100', lambda: corpusCollision(100, 10, args.seed)),
+        ('collision bit 2000', lambda: corpusCollision(2000, 40, args.seed)),
+        ('auto control bit 100', lambda: corpusAutoControl(100, args.seed)),
+        ('batch 20 x 8', lambda: corpusBatch(20, 8, args.ticks, args.seed)),
+    ]
+    enabled = jit.enabled
+    ok = True
+    try:
+        for name, case in corpus:
+            jit.enabled = True
+            case()      # 初回の呼び出しのコンパイル時間は含めない
+            elapsed = {}
+            result = {}
+            for use_jit in (False, True):
+                jit.enabled = use_jit
+                start = time.perf_counter()
+                result[use_jit] = case()
+                elapsed[use_jit] = time.perf_counter() - start
+            same = all(np.array_equal(a, b, equal_nan=a.dtype.kind == 'f')
+                       for a, b in zip(result[False], result[True]))
+            ok &= same
+            print('%-24s : %-8s numpy %8.1f [ms], numba %8.1f [ms], x%.1f' % (
+                name, 'same' if same else 'MISMATCH', elapsed[False] * 1e3, elapsed[True] * 1e3,
+                elapsed[False] / elapsed[True]
+            ))
+    finally:
+        jit.enabled = enabled
+    return ok
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('check', choices=['friction', 'collision', 'ai', 'batch', 'swept', 'jit'])
+    parser.add_argument('--ticks', type=int, default=300)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--tolerance', type=float, default=0.05)    # 許容誤差 [m]
+    args = parser.parse_args(argv)
+
+    checks = {'friction': checkFriction, 'collision': checkCollision, 'ai': checkAutoControl, 'batch': checkBatch, 'swept': checkSwept, 'jit': checkJIT}
+    ok = checks[args.check](args)
+    print('OK' if ok else 'NG')
+    return 0 if ok else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
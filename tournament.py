@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+# CPU同士の試合を描画なしで並列に実行し，bit carごとの勝率を集計する
+#   python tournament.py --matches 1000 --cpu-num 12 --filed-size 50 --cars 0 1 2
+#   python hitbit.py tournament ...
+
+import os
+import sys
+import json
+import time
+import uuid
+import argparse
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from world import World
+from record import Recording
+from trajectory import TrajectoryWriter
+from simulation import Simulation, Filed, CAR_PRESETS, PRESET_CARS, CPU_NUM_LIST, FILED_NUM_LIST, FILED_FRICTION, GRAVITY
+
+trajectory_writer = None   # このプロセスの試合の状態の書き込み先
+
+def runMatch(match_id, seed, cpu_num, filed_size, car_index_list, delta_t, max_time, record_dir=None, trajectory_dir=None,
+             friction_mode=World.FRICTION_SUBSTEP):
+    # 1試合を実行して結果を返す(プロセスプールから呼ぶので，引数と戻り値はpickleできるものにする)
+    rng = np.random.default_rng(seed)
+    car_index = rng.choice(car_index_list, cpu_num)     # 各CPUのbit car
+    filed = Filed(filed_size, FILED_FRICTION, GRAVITY)
+    theta = rng.uniform(0, 2*np.pi)                     # 配置角度をずらして試合ごとに展開を変える
+    sim = Simulation.setup(
+        filed,
+        [],                                             # ユーザーなし
+        [PRESET_CARS[k] for k in car_index],            # CPUのbit car(プリセットを共有する)
+        delta_t = delta_t,
+        seed = seed,
+        theta = theta,
+        friction_mode = friction_mode
+    )
+    if record_dir is not None:
+        recording = Recording.capture(sim, seed, theta) # 試合を記録する
+    if trajectory_dir is None:
+        winner = sim.runUntilFinished(max_ticks=int(max_time / delta_t))
+    else:
+        winner = runWithTrajectory(sim, match_id, int(max_time / delta_t), trajectory_dir)
+    if record_dir is not None:
+        recording.save(os.path.join(record_dir, 'match_%05d.hbr' % match_id))
+
+    return {
+        'match': match_id,
+        'seed': seed,
+        'cpu_num': cpu_num,
+        'filed_size': filed_size,
+        'cars': car_index.tolist(),                             # 各CPUのbit car
+        'winner': -1 if winner is None else winner.index,       # 勝者の番号(引き分け・時間切れは-1)
+        'time': round(sim.tick * delta_t, 6),                   # 試合時間[sec]
+        'survival': np.round(sim.survivalTime(), 6).tolist(),   # 各CPUの生存時間[sec]
+        'eliminations': sim.eliminations().tolist(),            # 各CPUが落下させた相手の数
+    }
+
+def runWithTrajectory(sim, match_id, max_ticks, trajectory_dir):
+    # 各ステップの全員の状態を書き込みながら試合を進める(プロセスごとに別のシャードに書き込む)
+    # シャード名はプロセス番号とuuidにして，PIDが再利用されても前の実行のシャードに追記しない
+    global trajectory_writer
+    if trajectory_writer is None:
+        trajectory_writer = TrajectoryWriter(os.path.join(trajectory_dir, 'shard_%d_%s' % (os.getpid(), uuid.uuid4().hex)))
+    trajectory_writer.beginMatch(match_id, sim.world.count)
+    trajectory_writer.append(sim.world)
+    while not sim.isFinished() and sim.tick < max_ticks:
+        sim.step()
+        trajectory_writer.append(sim.world)
+    trajectory_writer.endMatch()
+    return sim.winner()
+
+def aggregate(results, car_index_list):
+    # bit carごとに出場数，勝利数，平均生存時間，平均撃墜数を集計する
+    table = {k: {'entries': 0, 'wins': 0, 'survival': 0.0, 'eliminations': 0} for k in car_index_list}
+    for result in results:
+        for i, k in enumerate(result['cars']):
+            table[k]['entries'] += 1
+            table[k]['survival'] += result['survival'][i]
+            table[k]['eliminations'] += result['eliminations'][i]
+        if result['winner'] >= 0:
+            table[result['cars'][result['winner']]]['wins'] += 1
+    return table
+
+def printTable(table, results):
+    draws = sum(1 for result in results if result['winner'] < 0)
+    print('matches %d, draws %d' % (len(results), draws))
+    print('%-4s %-28s %8s %6s %9s %10s %8s' % ('car', 'preset', 'entries', 'wins', 'win rate', 'survival', 'KO'))
+    for k, row in table.items():
+        entries = max(row['entries'], 1)
+        # 1試合に同じbit carが複数出場するので，勝率は出場1回あたりで計算する
+        print('%-4d %-28s %8d %6d %8.1f%% %9.1fs %8.2f' % (
+            k, str(CAR_PRESETS[k][:6]), row['entries'], row['wins'],
+            100.0 * row['wins'] / entries, row['survival'] / entries, row['eliminations'] / entries
+        ))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='hitbit tournament')
+    parser.add_argument('--matches', type=int, default=100)                             # 試合数
+    parser.add_argument('--seed', type=int, default=0)                                  # 乱数の種
+    parser.add_argument('--cpu-num', type=int, default=CPU_NUM_LIST[0], choices=CPU_NUM_LIST)
+    parser.add_argument('--filed-size', type=int, default=FILED_NUM_LIST[0], choices=FILED_NUM_LIST)
+    parser.add_argument('--cars', type=int, nargs='+', default=list(range(len(CAR_PRESETS))),
+                        choices=range(len(CAR_PRESETS)))                                # 出場するbit carのプリセット
+    parser.add_argument('--delta-t', type=float, default=Simulation.DELTA_T)            # 更新速度[sec]
+    parser.add_argument('--max-time', type=float, default=120)                          # 1試合の上限時間[sec]
+    parser.add_argument('--workers', type=int, default=None)                            # プロセス数(省略時はCPUコア数)
+    parser.add_argument('--output', default=None)                                       # 試合結果を書き出すJSON Linesファイル
+    parser.add_argument('--record-dir', default=None)                                   # 試合の記録を書き出すディレクトリ
+    parser.add_argument('--trajectory-dir', default=None)                               # 各ステップの状態を書き出すディレクトリ
+    parser.add_argument('--analytic-friction', action='store_true')                     # 摩擦を解析解で計算する(速度優先)
+    args = parser.parse_args(argv)
+    if args.analytic_friction and args.record_dir is not None:
+        parser.error('--record-dir cannot be used with --analytic-friction (replays use the substep friction)')
+    friction_mode = World.FRICTION_ANALYTIC if args.analytic_friction else World.FRICTION_SUBSTEP
+
+    # 各試合の乱数の種は全体の種から作る(同じ種なら同じ結果になる)
+    seeds = np.random.SeedSequence(args.seed).generate_state(args.matches)
+
+    if args.record_dir is not None:
+        os.makedirs(args.record_dir, exist_ok=True)
+
+    results = []
+    output = open(args.output, 'w') if args.output else None
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = [
+            executor.submit(runMatch, i, int(seeds[i]), args.cpu_num, args.filed_size,
+                            args.cars, args.delta_t, args.max_time, args.record_dir, args.trajectory_dir,
+                            friction_mode)
+            for i in range(args.matches)
+        ]
+        # 終わった試合から順に結果を受け取る
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            if output:
+                output.write(json.dumps(result) + '\n')
+            winner = result['winner']
+            print('[%d/%d] match %d : winner %s (car %s), %.1fs' % (
+                len(results), args.matches, result['match'],
+                'CPU' + str(winner + 1) if winner >= 0 else 'DRAW',
+                result['cars'][winner] if winner >= 0 else '-', result['time']
+            ))
+    if output:
+        output.close()
+
+    elapsed = time.perf_counter() - start
+    print('%d matches in %.1fs (%.0f matches/min)' % (len(results), elapsed, len(results) / elapsed * 60))
+    printTable(aggregate(sorted(results, key=lambda r: r['match']), args.cars), results)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
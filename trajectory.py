@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+# 試合中の全プレイヤーの状態(位置，速度，向き，生存ステータス)を列ごとのファイルに追記して保存し，
+# np.memmapでコピーせずに読み出す
+#   python trajectory.py DIR     (保存した試合の概要を表示)
+#
+# ディレクトリ構成(プロセスごとに別のシャードに書き込む．試合番号は全シャードで重複しないこと)
+#   DIR/SHARD/position.f8   (行数, 3) float64   1行が1ステップの1プレイヤー(試合，ステップ，プレイヤーの順)
+#   DIR/SHARD/velocity.f8   (行数, 3) float64
+#   DIR/SHARD/direction.f8  (行数, 3) float64
+#   DIR/SHARD/status.u1     (行数,)   uint8     Player.ALIVE / Player.DEAD
+#   DIR/SHARD/index.bin     試合ごとの(試合番号, 先頭の行, ステップ数, プレイヤー数)
+
+import os
+import sys
+import numpy as np
+
+from simulation import Player
+
+COLUMNS = [                                 # (名前, 型, 1行あたりの要素数)
+    ('position', np.dtype('<f8'), 3),
+    ('velocity', np.dtype('<f8'), 3),
+    ('direction', np.dtype('<f8'), 3),
+    ('status', np.dtype('u1'), 1),
+]
+INDEX = np.dtype([('match', '<i8'), ('offset', '<i8'), ('ticks', '<i8'), ('players', '<i8')])
+STORE_INDEX = np.dtype(INDEX.descr + [('shard', '<i8')])  # 読み出し時の索引(シャード番号付き)
+
+def columnPath(path, name, dtype):
+    return os.path.join(path, '%s.%s%d' % (name, dtype.kind, dtype.itemsize))
+
+class TrajectoryWriter:
+    # 1つのシャードに試合を追記する．状態はchunk_ticksステップごとにファイルに書き出すので，試合全体をメモリに持たない
+    def __init__(self, path, chunk_ticks=256):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.chunk_ticks = chunk_ticks
+        self.files = {name: open(columnPath(path, name, dtype), 'ab') for name, dtype, width in COLUMNS}
+        self.index = open(os.path.join(path, 'index.bin'), 'ab')
+        self.rows = os.path.getsize(columnPath(path, 'status', COLUMNS[3][1]))  # 書き込み済みの行数
+        self.match = None       # 書き込み中の試合の索引
+        self.buffer = []        # まだ書き出していないステップの状態
+
+    def beginMatch(self, match_id, player_num):
+        self.match = np.array((match_id, self.rows, 0, player_num), INDEX)
+        self.buffer = []
+
+    def append(self, world):
+        # Worldの全員の現在の状態を1ステップ分追加する
+        self.buffer.append((
+            world.position.copy(),
+            world.velocity.copy(),
+            world.direction.copy(),
+            np.where(world.alive, Player.ALIVE, Player.DEAD).astype(np.uint8),
+        ))
+        if len(self.buffer) >= self.chunk_ticks:
+            self.__flush()
+
+    def endMatch(self):
+        self.__flush()
+        self.index.write(self.match.tobytes())  # 試合の状態を全て書き出してから索引を追加する
+        for f in self.files.values():
+            f.flush()
+        self.index.flush()
+        self.match = None
+
+    def __flush(self):
+        if not self.buffer:
+            return
+        for k, (name, dtype, width) in enumerate(COLUMNS):
+            self.files[name].write(np.concatenate([state[k] for state in self.buffer]).astype(dtype).tobytes())
+        rows = len(self.buffer) * int(self.match['players'])
+        self.match['ticks'] += len(self.buffer)
+        self.rows += rows
+        self.buffer = []
+
+    def close(self):
+        if self.match is not None:
+            self.endMatch()
+        for f in self.files.values():
+            f.close()
+        self.index.close()
+
+class TrajectoryStore:
+    # 保存した全シャードの試合をnp.memmapで参照する(読み出した配列はファイルのビューでコピーしない)
+    def __init__(self, path):
+        shards = [path] + [os.path.join(path, name) for name in sorted(os.listdir(path))]
+        shards = [shard for shard in shards if os.path.isfile(os.path.join(shard, 'index.bin'))]
+
+        self.columns = []   # シャードごとの{名前: (行数, 要素数)のmemmap}
+        entries = []        # シャードごとの索引
+        for s, shard in enumerate(shards):
+            shard_index = np.fromfile(os.path.join(shard, 'index.bin'), INDEX)
+            rows = int((shard_index['offset'] + shard_index['ticks'] * shard_index['players']).max(initial=0))
+            columns = {}
+            for name, dtype, width in COLUMNS:
+                shape = (rows, width) if width > 1 else (rows,)
+                if rows == 0:
+                    columns[name] = np.zeros(shape, dtype)
+                else:
+                    columns[name] = np.memmap(columnPath(shard, name, dtype), dtype, 'r', shape=shape)
+            self.columns.append(columns)
+
+            entry = np.zeros(len(shard_index), STORE_INDEX)
+            for name in INDEX.names:
+                entry[name] = shard_index[name]
+            entry['shard'] = s
+            entries.append(entry)
+
+        # 全試合の索引(試合番号, 先頭の行, ステップ数, プレイヤー数, シャード番号)
+        self.index = np.concatenate(entries) if entries else np.zeros(0, STORE_INDEX)
+        self.position = {int(m): k for k, m in enumerate(self.index['match'])}  # 試合番号 -> 索引の位置
+        if len(self.position) != len(self.index):
+            # 同じ試合番号が複数のシャードにあると(同じディレクトリに2回書き出したときなど)どの試合か決められない
+            match, count = np.unique(self.index['match'], return_counts=True)
+            raise ValueError('duplicate match ids in %s : %s' % (path, match[count > 1][:10].tolist()))
+
+    def __len__(self):
+        return len(self.index)
+
+    def matchIds(self):
+        return self.index['match']
+
+    def totalTicks(self):
+        return int(self.index['ticks'].sum())
+
+    def column(self, match_id, name, player=None, ticks=None):
+        # 試合match_idの列nameを(ステップ数, プレイヤー数, 要素数)のビューで返す(statusは(ステップ数, プレイヤー数))
+        # playerで1人，ticks(slice)で時間の範囲を指定すると，その部分だけのビューになる
+        entry = self.index[self.position[match_id]]
+        offset, tick_num, player_num = int(entry['offset']), int(entry['ticks']), int(entry['players'])
+        data = self.columns[int(entry['shard'])][name][offset:offset + tick_num * player_num]
+        data = data.reshape((tick_num, player_num) + data.shape[1:])
+        if ticks is not None:
+            data = data[ticks]
+        if player is not None:
+            data = data[:, player]
+        return data
+
+    def match(self, match_id, player=None, ticks=None):
+        # 試合match_idの全ての列を{名前: ビュー}で返す
+        return {name: self.column(match_id, name, player, ticks) for name, dtype, width in COLUMNS}
+
+def main(argv=None):
+    # 保存した試合の数，ステップ数，平均の速さを表示する
+    argv = sys.argv[1:] if argv is None else argv
+    try:
+        store = TrajectoryStore(argv[0])
+    except ValueError as error:
+        print('Error : %s' % error)
+        return 1
+    print('%d matches, %d ticks' % (len(store), store.totalTicks()))
+    for match_id in store.matchIds()[:20]:
+        velocity = store.column(int(match_id), 'velocity')
+        alive = store.column(int(match_id), 'status') == Player.ALIVE
+        speed = np.sqrt((velocity ** 2).sum(axis=2))
+        print('match %5d : %5d ticks, %2d players, mean speed %.2f [m/s]' % (
+            match_id, velocity.shape[0], velocity.shape[1], speed[alive].mean()
+        ))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,359 @@
+# -*- coding: utf-8 -*-
+
+import enum
+import numpy as np
+
+import jit
+
+class InputKey(enum.IntFlag):
+    # 入力キーのビット(World.input_keyの列の順)
+    ACCEL = 1   # 加速
+    BRAKE = 2   # 減速
+    LEFT  = 4   # 左旋回
+    RIGHT = 8   # 右旋回
+
+KEY_BITS = np.array([InputKey.ACCEL, InputKey.BRAKE, InputKey.LEFT, InputKey.RIGHT], np.uint8)
+
+def packKeys(keys):
+    # (…,4)の入力キーをビットマスク(uint8)にまとめる
+    return np.asarray(keys, bool).astype(np.uint8) @ KEY_BITS
+
+def unpackKeys(mask):
+    # ビットマスクを(…,4)の入力キーに戻す
+    return (np.asarray(mask, np.uint8)[...,None] & KEY_BITS) != 0
+
+class World:
+    # 各bitの状態を(N,3)などの連続した配列でまとめて保持し，全員を一度に更新する
+    BRAKE_COEFFICIENT = 0.6 # トルクからブレーキ性能を決める擬似的な係数
+    FRICTION_DIV = 100      # 逆方向加速防止のための時間分割数
+    STOP_SPEED = 0.1        # これ以下の速さで完全に停止させる [m/s]
+    STOP_ACCELERATION = 1.0 # 従来より短いステップでは，1ステップでこれ以下の速さ(STOP_ACCELERATION * delta_t)なら停止させる [m/s^2]
+    DEAD_HEIGHT = -20       # これより下に落ちたら落下済みとする [m]
+    NO_ROWS = np.zeros(0, dtype=np.intp)    # 落下したbitがないときのstepの戻り値
+
+    # 摩擦の積分方法
+    FRICTION_SUBSTEP  = 0   # 時間分割による逐次計算(従来の方法)
+    FRICTION_ANALYTIC = 1   # 解析解による計算(速いが，止まる直前の1ステップで停止するステップが変わることがある)
+
+    # 行ごとの配列 (名前, 1行あたりの要素数(0は1次元), 型, 追加した行の初期値)
+    ROW_ARRAYS = [
+        ('position', 3, np.float64, 0), ('velocity', 3, np.float64, 0), ('direction', 3, np.float64, 0),
+        ('alive', 0, bool, True), ('input_key', 4, bool, False),
+        ('torque', 0, np.float64, 0), ('max_speed', 0, np.float64, 0), ('rotation', 0, np.float64, 0),
+        ('mass', 0, np.float64, 0), ('bounce', 0, np.float64, 0), ('size', 0, np.float64, 0),
+        ('car_id', 0, np.int32, -1),
+    ]
+
+    def __init__(self, friction_mode=FRICTION_SUBSTEP, seed=None):
+        self.friction_mode = friction_mode              # 摩擦の積分方法
+        self.rng = np.random.default_rng(seed)          # 衝突時のランダム反発などに使う乱数生成器
+        self.count = 0                                  # 登録されているbitの数
+        self.position = np.zeros((0, 3))                # 位置(ベクトル)[m]
+        self.velocity = np.zeros((0, 3))                # 速度(ベクトル)[m/sec]
+        self.direction = np.zeros((0, 3))               # 車の向き(単位ベクトル)
+        self.alive = np.zeros(0, dtype=bool)            # 生存マスク
+        self.alive_rows = np.zeros(0, dtype=np.intp)    # 生存している行番号(昇順)．aliveを直接書き換えたときはrefreshAliveを呼ぶ
+        self.input_key = np.zeros((0, 4), dtype=bool)   # 入力キー(加速, 減速, 左旋回, 右旋回)
+
+        # 車のパラメータ(行ごと)
+        self.torque = np.zeros(0)       # 加速トルク [N]
+        self.max_speed = np.zeros(0)    # 最高速度 [m/s]
+        self.rotation = np.zeros(0)     # 旋回速度 [rad/s]
+        self.mass = np.zeros(0)         # 質量 [kg]
+        self.bounce = np.zeros(0)       # 疑似反発係数
+        self.size = np.zeros(0)         # 車両サイズ [m]
+
+        # 車の種類の表．同じ車は1つだけ登録し，各行は表の番号で参照する
+        self.cars = []                              # 車の種類
+        self.car_number = {}                        # id(車) -> 表の番号
+        self.car_id = np.zeros(0, dtype=np.int32)   # 各行の車の種類(未設定は-1)
+
+        # 行ごとの配列は確保済みの大きな配列(buffers)の先頭count行のビュー
+        self.capacity = 0   # 確保済みの行数
+        self.buffers = {}   # 名前 -> 確保済みの配列
+
+        self.scratch = {}   # stepの作業用の配列
+        self.turn = None    # (delta_t, 1ステップ分の旋回角のcos, sin)
+
+    def add(self, car, position, velocity, direction):
+        # 配列の末尾に1行追加して，その行番号を返す
+        index = int(self.addRows(1)[0])
+        self.position[index] = position
+        self.velocity[index] = velocity
+        self.direction[index] = direction
+        self.setCar(index, car)
+        return index
+
+    def addRows(self, count):
+        # 配列の末尾にcount行まとめて追加して(状態は0，生存)，追加した行番号を返す
+        index = np.arange(self.count, self.count + count)
+        end = self.count + count
+        if end > self.capacity:
+            # 足りなくなったら倍の行数を確保して移す(1行ずつ追加しても全体のコピーは数回で済む)
+            self.capacity = max(end, 2 * self.capacity)
+            for name, width, dtype, initial in World.ROW_ARRAYS:
+                buffer = np.empty((self.capacity,) + ((width,) if width else ()), dtype)
+                buffer[:self.count] = getattr(self, name)
+                self.buffers[name] = buffer
+        for name, width, dtype, initial in World.ROW_ARRAYS:
+            buffer = self.buffers[name]
+            buffer[self.count:end] = initial
+            setattr(self, name, buffer[:end])
+        self.count = end
+        self.alive_rows = np.concatenate([self.alive_rows, index])
+        self.turn = None
+        return index
+
+    def setCar(self, index, car):
+        # 行のパラメータを車の種類に合わせて設定
+        number = self.car_number.get(id(car))
+        if number is None:
+            number = self.car_number[id(car)] = len(self.cars)
+            self.cars.append(car)
+        self.car_id[index] = number
+        self.torque[index] = car.torque
+        self.max_speed[index] = car.max_speed
+        self.rotation[index] = car.rotation
+        self.mass[index] = car.mass
+        self.bounce[index] = car.bounce
+        self.size[index] = car.size
+        self.turn = None
+
+    def car(self, index):
+        return self.cars[self.car_id[index]]    # 行の車の種類
+
+    def __getstate__(self):
+        # pickleするときは作業用の配列と計算し直せるものを含めない
+        state = self.__dict__.copy()
+        for name in ('buffers', 'scratch', 'turn', 'car_number'):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.capacity = self.count
+        self.buffers = {name: getattr(self, name) for name, width, dtype, initial in World.ROW_ARRAYS}
+        self.scratch = {}
+        self.turn = None
+        self.car_number = {id(car): number for number, car in enumerate(self.cars)}
+
+    def refreshAlive(self):
+        # aliveから生存している行番号を作り直す
+        self.alive_rows = np.flatnonzero(self.alive)
+
+    def aliveCount(self):
+        return len(self.alive_rows)
+
+    def step(self, filed_size, filed_friction, gravity, delta_t, index=None):
+        # filed_size, filed_frictionは全行共通の値か，行ごとの値の配列(長さcount)
+        # 更新する行の状態を作業用の配列に集めて計算し，書き戻す．計算はout=で作業用の配列に書き込み，
+        # 一部の行だけの計算はwhere=で行うので，ステップごとに行数に比例する配列を新しく確保しない
+        # 更新対象の行(落下済みと静止中は更新しない)．このステップで落下した行番号を返す
+        if index is None:
+            index = self.alive_rows
+        else:
+            index = np.asarray(index, dtype=np.intp)
+            index = index[self.alive[index]]
+        if jit.enabled:
+            return self.__stepCompiled(index, filed_size, filed_friction, gravity, delta_t)
+        index = self.__awake(index, filed_size)
+        n = len(index)
+        if n == 0:
+            return World.NO_ROWS
+
+        p = self.__take(self.position, index, 'position')
+        v = self.__take(self.velocity, index, 'velocity')
+        d = self.__take(self.direction, index, 'direction')
+        key = self.__take(self.input_key, index, 'input_key')
+        vector = self.__scratch('vector', n, 3)         # 作業用
+        x = self.__scratch('x', n)                      # 作業用
+        y = self.__scratch('y', n)                      # 作業用
+        mask = self.__scratch('mask', n, dtype=bool)    # 作業用
+
+        # 1ステップ分の加速
+        accel = self.__take(self.torque, index, 'accel')
+        np.divide(accel, self.__take(self.mass, index, 'mass'), out=accel)
+        accel *= delta_t
+
+        # 落下中の場合，重力加速度による落下処理
+        half_size = self.__rowValue(filed_size, index, 'half_size')
+        half_size /= 2
+        falling = self.__scratch('falling', n, dtype=bool)
+        np.greater(np.abs(p[:,0], out=x), half_size, out=falling)
+        falling |= np.greater(np.abs(p[:,1], out=x), half_size, out=mask)
+        np.subtract(v[:,2], gravity * delta_t, out=v[:,2], where=falling)
+
+        # 行動可能状態の場合，入力に従って加速・減速・旋回
+        ground = np.logical_not(falling, out=self.__scratch('ground', n, dtype=bool))
+
+        # 加速 : 車の向きの速さが最高速度未満なら，車の向きに合わせて加速
+        head_velocity = World.__dot(v, d, x, y)
+        np.maximum(head_velocity, 0, out=head_velocity)
+        np.less(head_velocity, self.__take(self.max_speed, index, 'y'), out=mask)
+        mask &= ground
+        mask &= key[:,0]
+        np.multiply(d, accel[:,None], out=vector)
+        np.add(v, vector, out=v, where=mask[:,None])
+
+        # ブレーキ : 速度があるときのみ，車の速度方向に合わせて減速
+        speed = World.__norm(v, vector, x)
+        np.greater(speed, 0, out=mask)
+        mask &= ground
+        mask &= key[:,1]
+        np.divide(v, speed[:,None], out=vector, where=mask[:,None])
+        np.multiply(vector, np.multiply(accel, World.BRAKE_COEFFICIENT, out=y)[:,None], out=vector, where=mask[:,None])
+        np.subtract(v, vector, out=v, where=mask[:,None])
+
+        # 旋回 : 1ステップ分の回転角のcos, sinで向きのベクトルを回転させる
+        cos = self.__take(self.__turn(delta_t)[0], index, 'cos')
+        sin = self.__take(self.__turn(delta_t)[1], index, 'sin')
+        for column, sign in ((2, 1), (3, -1)): # 左旋回，右旋回の順
+            np.logical_and(ground, key[:,column], out=mask)
+            signed_sin = np.multiply(sin, sign, out=vector[:,2])  # 回転方向のsin
+            np.multiply(d[:,0], cos, out=x)                         # x' = x cos - y sin
+            x -= np.multiply(d[:,1], signed_sin, out=vector[:,0])
+            np.multiply(d[:,0], signed_sin, out=y)                  # y' = x sin + y cos
+            y += np.multiply(d[:,1], cos, out=vector[:,0])
+            np.copyto(d[:,0], x, where=mask)
+            np.copyto(d[:,1], y, where=mask)
+
+        # 摩擦による減速(減速度は摩擦係数 × 重力加速度)
+        deceleration = self.__rowValue(filed_friction, index, 'deceleration')
+        deceleration *= gravity
+        if self.friction_mode == World.FRICTION_SUBSTEP:
+            World.__frictionSubstep(v, deceleration, delta_t, ground, x, vector, mask)
+        else:
+            World.__frictionAnalytic(v, deceleration, delta_t, ground, x, vector, y, mask)
+
+        # 位置座標を更新
+        p += np.multiply(v, delta_t, out=vector)
+
+        self.position[index] = p
+        self.velocity[index] = v
+        self.direction[index] = d
+        still = np.greater_equal(p[:,2], World.DEAD_HEIGHT, out=mask)
+        self.alive[index] = still
+        if still.all():
+            return World.NO_ROWS
+
+        # 落下したbitを生存している行番号から外す(落下したステップだけ計算する)
+        dead = index[~still]
+        self.alive_rows = self.alive_rows[self.alive[self.alive_rows]]
+        return dead
+
+    def __stepCompiled(self, index, filed_size, filed_friction, gravity, delta_t):
+        # stepと同じ計算をNumbaでコンパイルした関数で1行ずつ行う(jit.stepRows)
+        cos, sin = self.__turn(delta_t)
+        dead = self.__scratch('dead', len(index), dtype=np.intp)
+        dead_num = jit.stepRows(
+            index, self.position, self.velocity, self.direction, self.alive, self.input_key,
+            self.torque, self.mass, self.max_speed, cos, sin,
+            np.atleast_1d(np.asarray(filed_size, np.float64)), np.atleast_1d(np.asarray(filed_friction, np.float64)),
+            float(gravity), float(delta_t), World.BRAKE_COEFFICIENT, World.__stopSpeed(delta_t),
+            self.friction_mode == World.FRICTION_SUBSTEP, World.FRICTION_DIV, float(World.DEAD_HEIGHT), dead
+        )
+        if dead_num == 0:
+            return World.NO_ROWS
+        self.alive_rows = self.alive_rows[self.alive[self.alive_rows]]
+        return dead[:dead_num].copy()
+
+    def __awake(self, index, filed_size):
+        # index行から静止中のbit(フィールドの上で速度が0で，加速と旋回の入力がない)を除く
+        # 静止中のbitはstepで状態が変わらないので計算しない．衝突で速度が変わるか，入力があると次のstepから計算する
+        n = len(index)
+        v = self.__take(self.velocity, index, 'velocity')
+        mask = self.__scratch('mask', n, dtype=bool)
+        sleeping = np.equal(v[:,0], 0, out=self.__scratch('sleeping', n, dtype=bool))
+        sleeping &= np.equal(v[:,1], 0, out=mask)
+        sleeping &= np.equal(v[:,2], 0, out=mask)
+        if not sleeping.any():
+            return index    # 全員動いているときは速度だけで判定できる
+
+        key = self.__take(self.input_key, index, 'input_key')
+        for column in (0, 2, 3):    # ブレーキは止まっているときは何もしない
+            sleeping &= np.logical_not(key[:,column], out=mask)
+        p = self.__take(self.position, index, 'position')
+        x = self.__scratch('x', n)
+        half_size = self.__rowValue(filed_size, index, 'half_size')
+        half_size /= 2
+        sleeping &= np.less_equal(np.abs(p[:,0], out=x), half_size, out=mask)
+        sleeping &= np.less_equal(np.abs(p[:,1], out=x), half_size, out=mask)
+        if not sleeping.any():
+            return index
+        return index[~sleeping]
+
+    def __scratch(self, name, n, width=0, dtype=np.float64):
+        # 作業用の配列(先頭n行のビュー)．行数が足りないときだけ確保し直す
+        buffer = self.scratch.get(name)
+        if buffer is None or len(buffer) < n:
+            buffer = np.zeros((max(n, self.count),) + ((width,) if width else ()), dtype)
+            self.scratch[name] = buffer
+        return buffer[:n]
+
+    def __take(self, array, index, name):
+        # arrayのindex行を作業用の配列nameに集める
+        out = self.__scratch(name, len(index), array.shape[1] if array.ndim > 1 else 0, array.dtype)
+        return np.take(array, index, axis=0, out=out, mode='clip')
+
+    def __rowValue(self, value, index, name):
+        # 全行共通の値または行ごとの値の配列から，index行の値を作業用の配列nameに入れる
+        if np.ndim(value) > 0:
+            return self.__take(np.asarray(value, np.float64), index, name)
+        out = self.__scratch(name, len(index))
+        out.fill(value)
+        return out
+
+    def __turn(self, delta_t):
+        # 各行の1ステップ分の旋回角のcos, sin(車のパラメータかdelta_tが変わったときだけ計算し直す)
+        if self.turn is None or self.turn[0] != delta_t:
+            theta = self.rotation * delta_t
+            self.turn = (delta_t, np.cos(theta), np.sin(theta))
+        return self.turn[1:]
+
+    @staticmethod
+    def __dot(a, b, out, work):
+        # 行ごとの内積 a・b
+        np.multiply(a[:,0], b[:,0], out=out)
+        out += np.multiply(a[:,1], b[:,1], out=work)
+        out += np.multiply(a[:,2], b[:,2], out=work)
+        return out
+
+    @staticmethod
+    def __stopSpeed(delta_t):
+        # 完全に停止させる速さ．従来のステップ(0.1 [sec])以上では従来の値のままにする
+        # 短いステップでは1ステップの加速が従来の停止速度に届かず動き出せないので，ステップに比例して小さくする
+        return min(World.STOP_SPEED, World.STOP_ACCELERATION * delta_t)
+
+    @staticmethod
+    def __norm(v, work, out):
+        # 行ごとの長さ |v| (np.linalg.norm(v, axis=1)と同じ計算)
+        np.multiply(v, v, out=work)
+        np.add.reduce(work, axis=1, out=out)
+        return np.sqrt(out, out=out)
+
+    @staticmethod
+    def __frictionAnalytic(v, deceleration, delta_t, ground, speed, work, scale, moving):
+        # 摩擦は速度方向と逆向きの一定の減速なので，向きを変えずに速さだけを減らせばよい
+        speed = World.__norm(v, work, speed)
+        new_speed = np.multiply(deceleration, delta_t, out=deceleration)
+        np.subtract(speed, new_speed, out=new_speed)
+        np.greater(new_speed, World.__stopSpeed(delta_t), out=moving)  # 停止点を越えたら完全に停止させる
+        scale.fill(0)
+        np.divide(new_speed, speed, out=scale, where=moving)
+        np.multiply(v, scale[:,None], out=v, where=ground[:,None])
+
+    @staticmethod
+    def __frictionSubstep(v, deceleration, delta_t, ground, speed, work, moving):
+        div = World.FRICTION_DIV
+        deceleration *= delta_t/div     # 1回分の減速
+        for i in range(div):
+            speed = World.__norm(v, work, speed)
+            np.greater(speed, World.__stopSpeed(delta_t), out=moving)
+            # 速度が一定以上の場合，車の速度方向に合わせて減速する
+            moving &= ground
+            np.divide(v, speed[:,None], out=work, where=moving[:,None])
+            np.multiply(work, deceleration[:,None], out=work, where=moving[:,None])
+            np.subtract(v, work, out=v, where=moving[:,None])
+            # 速度が一定以下の場合，完全に停止させる
+            np.logical_xor(moving, ground, out=moving)
+            np.copyto(v, 0, where=moving[:,None])